@@ -0,0 +1,428 @@
+#!/usr/bin/python
+
+import sys, os, time, json, shutil, hashlib, random, struct, tempfile, zipfile, multiprocessing
+from optparse import OptionParser
+
+try:
+	import resource
+except ImportError: # Windows
+	resource = None
+
+
+'''
+ Benchmark apk-diff.py (and apk-patch.py) on a synthetic APK corpus
+
+ Every case is a pair of APKs generated from a fixed seed, so the same
+ corpus is produced on every machine:
+
+	small-assets	thousands of small assets, a few changed, added
+					and removed
+	renamed-so		large native libraries, renamed and lightly edited
+	moved			split dex files shifted by one and assets with
+					obfuscated names, moved and lightly edited
+	abi-split		the same libraries built for three ABIs, renamed
+	duplicates		the same assets under several paths, moved, and
+					new ones added several times
+	dex-churn		dex files with edits spread all over them
+	identical		the same APK twice
+
+ Each case runs in its own process (so peak RSS is per case). The phases
+ are the stages apk-diff.py times itself (see Stats there), plus
+
+	apply		rebuilding the new APK with apk-patch.py
+
+ The results are written as JSON. With --baseline, a previous result
+ file is compared against and the exit status is non-zero when a case
+ got slower or its patch got bigger by more than --tolerance.
+'''
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+	p = OptionParser(
+		usage="usage: %prog [options] [CASE ...]",
+		description="benchmark apk-diff.py on synthetic APK pairs, "
+					"cases: %s" % ', '.join(sorted(CASES)))
+
+	p.add_option('-j', '--jobs', type='int', default=1,
+				 help="--jobs passed to apk-diff.py (default 1)")
+	p.add_option('--exact', action='store_true',
+				 help="make exact patches (apk-diff.py --exact) and check "
+					  "that the new APKs are rebuilt byte for byte")
+	p.add_option('-s', '--scale', type='float', default=1.0,
+				 help="multiply entry sizes and counts by this (default 1)")
+	p.add_option('--seed', type='int', default=1,
+				 help="seed of the corpus generator (default 1)")
+	p.add_option('-o', '--output',
+				 help="write the JSON results here instead of stdout")
+	p.add_option('--baseline',
+				 help="JSON results of an earlier run to compare against")
+	p.add_option('--tolerance', type='float', default=0.2,
+				 help="allowed relative regression against the baseline "
+					  "(default 0.2)")
+	p.add_option('--keep', metavar='DIR',
+				 help="keep the generated APKs and patches in DIR")
+
+	opts, args = p.parse_args()
+
+	for name in args:
+		if name not in CASES:
+			p.error('unknown case: %s' % name)
+
+	results = {
+		'jobs': opts.jobs,
+		'scale': opts.scale,
+		'seed': opts.seed,
+		'exact': bool(opts.exact),
+		'python': sys.version.split()[0],
+		'cases': {},
+	}
+	for name in args or sorted(CASES):
+		sys.stderr.write('%s...\n' % name)
+		results['cases'][name] = run_case(name, opts)
+
+	text = json.dumps(results, indent=2, sort_keys=True)
+	if opts.output:
+		f = open(opts.output, 'w')
+		f.write(text + '\n')
+		f.close()
+	else:
+		print(text)
+
+	if opts.baseline:
+		f = open(opts.baseline)
+		baseline = json.load(f)
+		f.close()
+		regressions = compare(baseline, results, opts.tolerance)
+		for line in regressions:
+			sys.stderr.write('REGRESSION %s\n' % line)
+		if regressions:
+			sys.exit(1)
+
+
+def compare(baseline, results, tolerance):
+	regressions = []
+	for name, res in sorted(results['cases'].items()):
+		old = baseline['cases'].get(name)
+		if old is None:
+			continue
+		for key in 'total_seconds', 'patch_size', 'peak_rss_kb':
+			if old.get(key) and res.get(key) > old[key] * (1 + tolerance):
+				regressions.append('%s %s: %s -> %s' % (name, key, old[key], res[key]))
+	return regressions
+
+
+'''
+ Corpus generation. Data comes from sha256 in counter mode so it is the
+ same everywhere; "code" is made of words from a small vocabulary so it
+ compresses and diffs roughly like real dex and native code.
+'''
+
+class Generator(object):
+
+	def __init__(self, seed, scale):
+		self.rng = random.Random(seed)
+		self.scale = scale
+		self.counter = 0
+		self.vocabulary = [self.noise(self.rng.randint(4, 16)) for i in range(512)]
+
+	def size(self, n):
+		return max(1, int(n * self.scale))
+
+	def noise(self, n):
+		out = []
+		while n > 0:
+			self.counter += 1
+			block = hashlib.sha256(('%d' % self.counter).encode('ascii')).digest()
+			out.append(block[:n])
+			n -= len(block)
+		return b''.join(out)
+
+	def code(self, n):
+		words = []
+		total = 0
+		while total < n:
+			word = self.rng.choice(self.vocabulary)
+			words.append(word)
+			total += len(word)
+		return b''.join(words)[:n]
+
+	def edit(self, data, edits, span=64):
+		# replace, insert or delete 'edits' short spans at random places
+		data = bytearray(data)
+		for i in range(edits):
+			pos = self.rng.randint(0, len(data))
+			kind = self.rng.randint(0, 2)
+			if kind == 0:
+				data[pos:pos + span] = self.code(span)
+			elif kind == 1:
+				data[pos:pos] = self.code(self.rng.randint(1, span))
+			else:
+				del data[pos:pos + self.rng.randint(1, span)]
+		return bytes(data)
+
+
+def write_apk(path, entries):
+	# entries is a list of (name, data); .so files are stored, the rest
+	# deflated, all with a fixed timestamp
+	zipf = zipfile.ZipFile(path, 'w')
+	for name, data in entries:
+		info = zipfile.ZipInfo(name, (2008, 1, 1, 0, 0, 0))
+		if name.endswith('.so'):
+			info.compress_type = zipfile.ZIP_STORED
+		else:
+			info.compress_type = zipfile.ZIP_DEFLATED
+		zipf.writestr(info, data)
+	zipf.close()
+
+
+def common_entries(gen):
+	return [('AndroidManifest.xml', gen.code(gen.size(8000))),
+			('resources.arsc', gen.code(gen.size(200000)))]
+
+
+def case_small_assets(gen):
+	old = common_entries(gen)
+	new = list(old)
+	for i in range(gen.size(3000)):
+		data = gen.code(gen.rng.randint(100, 4000))
+		name = 'assets/level%d/tile%d.bin' % (i % 50, i)
+		roll = gen.rng.random()
+		if roll < 0.03:
+			old.append((name, data))					# removed
+		elif roll < 0.06:
+			new.append((name, data))					# added
+		elif roll < 0.10:
+			old.append((name, data))					# changed
+			new.append((name, gen.edit(data, 2, 16)))
+		else:
+			old.append((name, data))
+			new.append((name, data))
+	return old, new
+
+def case_renamed_so(gen):
+	old = common_entries(gen)
+	new = list(old)
+	for abi in 'arm64-v8a', 'armeabi-v7a', 'x86_64':
+		for lib in range(4):
+			data = gen.code(gen.size(gen.rng.randint(500000, 2000000)))
+			old.append(('lib/%s/libmodule%d.1.so' % (abi, lib), data))
+			new.append(('lib/%s/libmodule%d.2.so' % (abi, lib), gen.edit(data, 20)))
+	return old, new
+
+def elf_library(machine, bits, body):
+	# body behind a bare ELF header (no sections) of the given machine
+	if bits == 32:
+		header = struct.pack('<HHIIIIIHHHHHH', 3, machine, 1, 0, 0, 0, 0, 52, 0, 0, 0, 0, 0)
+	else:
+		header = struct.pack('<HHIQQQIHHHHHH', 3, machine, 1, 0, 0, 0, 0, 64, 0, 0, 0, 0, 0)
+	ident = b'\x7fELF' + struct.pack('BBB', 1 if bits == 32 else 2, 1, 1) + b'\0' * 9
+	return ident + header + body
+
+def case_abi_split(gen):
+	# the same libraries built for three ABIs, all renamed: each one
+	# looks like its builds for the other ABIs but should not be diffed
+	# against them
+	old = common_entries(gen)
+	new = list(old)
+	abis = [('arm64-v8a', 183, 64), ('armeabi-v7a', 40, 32), ('x86_64', 62, 64)]
+	for lib in range(6):
+		source = gen.code(gen.size(gen.rng.randint(300000, 1000000)))
+		for abi, machine, bits in abis:
+			data = elf_library(machine, bits, gen.edit(source, 200))
+			old.append(('lib/%s/libmodule%d.1.so' % (abi, lib), data))
+			new.append(('lib/%s/libmodule%d.2.so' % (abi, lib), gen.edit(data, 20)))
+	return old, new
+
+def case_moved(gen):
+	old = common_entries(gen)
+	new = list(old)
+	# a new classes2.dex moves the later dex files up by one
+	for i in range(2, 4):
+		data = gen.code(gen.size(1000000))
+		old.append(('classes%d.dex' % i, data))
+		new.append(('classes%d.dex' % (i + 1), gen.edit(data, 50, 32)))
+	new.append(('classes2.dex', gen.code(gen.size(300000))))
+	# obfuscated asset names change on every build
+	for i in range(gen.size(300)):
+		data = gen.code(gen.rng.randint(2000, 20000))
+		old.append(('assets/%08x.bin' % gen.rng.getrandbits(32), data))
+		if gen.rng.random() < 0.3:
+			data = gen.edit(data, 2, 16)
+		new.append(('assets/%08x.bin' % gen.rng.getrandbits(32), data))
+	return old, new
+
+def case_duplicates(gen):
+	# every theme carries its own copy of the shared images, and the new
+	# build moves some of the old ones and adds a theme
+	old = common_entries(gen)
+	new = list(old)
+	images = [gen.noise(gen.rng.randint(1000, 30000)) for i in range(gen.size(100))]
+	added = [gen.noise(gen.rng.randint(1000, 30000)) for i in range(gen.size(20))]
+	for theme in range(3):
+		for i, data in enumerate(images):
+			old.append(('res/theme%d/image%d.png' % (theme, i), data))
+			new.append(('res/theme%d/img/image%d.png' % (theme, i), data))
+	for theme in range(4):
+		for i, data in enumerate(added):
+			new.append(('res/theme%d/added%d.png' % (theme, i), data))
+	return old, new
+
+def case_dex_churn(gen):
+	old = common_entries(gen)
+	new = list(old)
+	for i in range(4):
+		name = 'classes%s.dex' % ('' if i == 0 else i + 1)
+		data = gen.code(gen.size(3000000))
+		old.append((name, data))
+		new.append((name, gen.edit(data, 2000, 32)))
+	return old, new
+
+def case_identical(gen):
+	old, new = case_small_assets(gen)
+	return old, old
+
+CASES = {
+	'small-assets': case_small_assets,
+	'renamed-so': case_renamed_so,
+	'moved': case_moved,
+	'abi-split': case_abi_split,
+	'duplicates': case_duplicates,
+	'dex-churn': case_dex_churn,
+	'identical': case_identical,
+}
+
+
+'''
+ Running a case
+'''
+
+def load_script(name, filename):
+	# the scripts have dashes in their names, so they are loaded by path
+	if sys.version_info[0] >= 3:
+		import importlib.util
+		spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, filename))
+		module = importlib.util.module_from_spec(spec)
+		# registered so that the worker processes can unpickle its functions
+		sys.modules[name] = module
+		spec.loader.exec_module(module)
+		return module
+	import imp
+	return imp.load_source(name, os.path.join(HERE, filename))
+
+
+def run_case(name, opts):
+	queue = multiprocessing.Queue()
+	proc = multiprocessing.Process(target=case_process, args=(name, opts, queue))
+	proc.start()
+	result = queue.get()
+	proc.join()
+	if 'error' in result:
+		raise RuntimeError('case %s failed:\n%s' % (name, result['error']))
+	return result
+
+
+def case_process(name, opts, queue):
+	try:
+		queue.put(measure_case(name, opts))
+	except Exception:
+		import traceback
+		queue.put({'error': traceback.format_exc()})
+
+
+def measure_case(name, opts):
+	work = tempfile.mkdtemp(prefix='apk-bench-')
+	cwd = os.getcwd()
+	stdout = sys.stdout
+	devnull = open(os.devnull, 'w')
+	try:
+		gen = Generator(opts.seed, opts.scale)
+		old, new = CASES[name](gen)
+		a_apk = os.path.join(work, 'A.apk')
+		b_apk = os.path.join(work, 'B.apk')
+		write_apk(a_apk, old)
+		write_apk(b_apk, new)
+
+		apk_diff = load_script('apk_diff', 'apk-diff.py')
+		apk_patch = load_script('apk_patch', 'apk-patch.py')
+
+		os.chdir(work)
+		sys.stdout = devnull
+		sys.argv = ['apk-diff.py', '--jobs', str(opts.jobs), a_apk, b_apk]
+		if opts.exact:
+			sys.argv.insert(1, '--exact')
+		cpu = os.times()
+		t = time.time()
+		apk_diff.main()
+		total = time.time() - t
+		cpu = sum(os.times()[:4]) - sum(cpu[:4])
+
+		out_apk = os.path.join(work, 'out.apk')
+		t = time.time()
+		apk_patch.apply_patch(a_apk, out_apk, 'patch.zip')
+		apply_seconds = time.time() - t
+		verify(b_apk, out_apk, opts.exact)
+
+		# the stage timings apk-diff.py collected itself
+		stats = apk_diff.g_stats
+		phases = dict((k, v['wall_seconds']) for k, v in stats.stages.items())
+		phases['apply'] = apply_seconds
+		result = {
+			'phases': dict((k, round(v, 4)) for k, v in phases.items()),
+			'counters': dict(stats.counters),
+			'total_seconds': round(total, 4),
+			'cpu_seconds': round(cpu, 4),
+			'entries': [len(old), len(new)],
+			'old_apk_size': os.path.getsize(a_apk),
+			'new_apk_size': os.path.getsize(b_apk),
+			'patch_size': os.path.getsize('patch.zip'),
+		}
+		result['patch_ratio'] = round(float(result['patch_size']) / result['new_apk_size'], 4)
+		if resource:
+			rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			if sys.platform == 'darwin':
+				rss //= 1024 # bytes there, kilobytes elsewhere
+			result['peak_rss_kb'] = rss
+		if opts.keep:
+			dest = os.path.join(opts.keep, name)
+			if os.path.exists(dest):
+				shutil.rmtree(dest)
+			shutil.copytree(work, dest)
+		return result
+	finally:
+		sys.stdout = stdout
+		devnull.close()
+		os.chdir(cwd)
+		shutil.rmtree(work)
+
+
+def verify(expected_apk, actual_apk, exact=False):
+	# the rebuilt APK must have the same entries with the same contents,
+	# or be the same file for an exact patch
+	if exact:
+		if read_bytes(expected_apk) != read_bytes(actual_apk):
+			raise AssertionError('rebuilt APK is not byte-identical')
+		return
+	expected = zipfile.ZipFile(expected_apk, 'r')
+	actual = zipfile.ZipFile(actual_apk, 'r')
+	names = sorted(expected.namelist())
+	if names != sorted(actual.namelist()):
+		raise AssertionError('rebuilt APK has different entries')
+	for name in names:
+		if expected.read(name) != actual.read(name):
+			raise AssertionError('rebuilt APK differs in %s' % name)
+	expected.close()
+	actual.close()
+
+
+def read_bytes(path):
+	f = open(path, 'rb')
+	try:
+		return f.read()
+	finally:
+		f.close()
+
+
+if __name__ == '__main__':
+	main()
@@ -1,6 +1,23 @@
 #!/usr/bin/python
 
-import sys, os, filecmp, shutil, bsdiff4, zipfile
+import sys, os, time, json, shutil, bisect, collections, contextlib, heapq, multiprocessing, bsdiff4, zipfile
+import apkzip, elfinfo, patchcache
+from optparse import OptionParser
+
+try:
+	import resource
+except ImportError: # Windows
+	resource = None
+
+try:
+	import tracemalloc
+except ImportError: # Python 2
+	tracemalloc = None
+
+try:
+	process_time = time.process_time
+except AttributeError: # Python 2
+	process_time = time.clock
 
 
 '''
@@ -8,8 +25,9 @@ import sys, os, filecmp, shutil, bsdiff4, zipfile
 
  gregsimon@chromium.org
 
- Rather than diff the entire file, we're going to uncompress
- the APK files and diff everything we find. 
+ Rather than diff the entire file, we're going to read the
+ entry list of each APK from its zip central directory and
+ diff the entries that differ. 
 
 	 B.apk - A.apk = patch
 	 A.apk + patch = B.apk
@@ -22,7 +40,8 @@ import sys, os, filecmp, shutil, bsdiff4, zipfile
 	4) file exists in both and is different. (diff!)
 	
 	* File is NEW but can be effectively diff'ed with another
-	  file with the same file extension.
+	  file with the same file extension (a moved or renamed one,
+	  say classes2.dex -> classes3.dex).
 
  We'll write a special instruction file that is interpreted
  on the receiving end (the patcher) so the patch can be
@@ -31,66 +50,564 @@ import sys, os, filecmp, shutil, bsdiff4, zipfile
 
 	TODO : zip the output
 	TODO : make the output dir configurable
-	TODO : cmdline args for everything.
 	TODO : filenames should be escaped; using | for now
 
 '''
 
+# similarity sketches, see sketch(): the SKETCH_SIZE smallest hashes of
+# chunks of SKETCH_MIN_CHUNK + 2 ** SKETCH_CHUNK_BITS bytes on average
+SKETCH_SIZE = 128
+SKETCH_CHUNK_BITS = 7
+SKETCH_MIN_CHUNK = 32
+SKETCH_MAX_CHUNK = 1024
+
+# new entries smaller than this are shipped whole rather than matched
+# against the old ones, and old entries are only tried for a new one
+# whose size is within RENAME_SIZE_RATIO of theirs
+RENAME_MIN_SIZE = 512
+RENAME_SIZE_RATIO = 0.25
+# a library is only trial-diffed against the old libraries which score
+# at least this fraction of the best one, on ELF or sketch similarity
+ELF_RANK_CUTOFF = 0.5
+
+# the cost model of plan_changes(): bsdiff goes through about
+# PLAN_DIFF_RATE bytes (old and new entry) a second on similar data, a
+# third of that on unrelated data, and a patch has about
+# PLAN_PATCH_OVERHEAD bytes of headers whatever the entries
+PLAN_DIFF_RATE = 16 << 20
+PLAN_PATCH_OVERHEAD = 160
+
 def main():
 	global g_output_dir; g_output_dir = "temp_out"
 	global g_patch_filename; g_patch_filename = "patch.zip"
 
-	try:
-		a_apk = sys.argv[1]
-		b_apk = sys.argv[2]
-		a_folder = 'temp_a'
-		b_folder = 'temp_b'
+	p = OptionParser(
+		usage="usage: %prog [options] <APK-from>... <APK-to>",
+		description="write a patch.zip which turns APK-from into APK-to; "
+					"with several APK-from, write one patch-<APK-from>.zip "
+					"for each of them")
 
-		print('Uncompressing APKs...')
+	p.add_option('-j', '--jobs', type='int', default=1,
+				 help="number of worker processes running bsdiff "
+					  "(0 means one per CPU, default 1)")
 
-		ensure_dir_exists(a_folder)
-		zipf = zipfile.ZipFile(a_apk, 'r');
-		zipf.extractall(a_folder)
-		zipf.close()
+	p.add_option('-k', '--trial-diffs', type='int', default=3,
+				 help="number of most similar old files to trial-diff "
+					  "against each renamed file (0 means all, default 3)")
 
-		ensure_dir_exists(b_folder)
-		zipf = zipfile.ZipFile(b_apk, 'r');
-		zipf.extractall(b_folder)
-		zipf.close()
+	p.add_option('-t', '--time-budget', type='float', default=0, metavar='SECONDS',
+				 help="estimated bsdiff time to spend on the files changed in "
+					  "place; beyond it, those which save the fewest bytes "
+					  "per second are shipped whole (default 0, no limit)")
+
+	p.add_option('-c', '--codec', default='bz2',
+				 help="bsdiff block codec: %s or auto "
+					  "(default bz2)" % ', '.join(sorted(bsdiff4.format.CODECS)))
+
+	p.add_option('-w', '--window-size', type='int', default=0, metavar='MB',
+				 help="diff entries larger than MB megabytes in windows, "
+					  "which bounds the memory bsdiff needs for them; the "
+					  "patcher has to support windowed patches (default 0, "
+					  "off)")
+
+	p.add_option('--exact', action='store_true',
+				 help="make a patch which rebuilds APK-to byte for byte, "
+					  "signature included: entries are re-deflated with the "
+					  "zlib parameters they were made with (or shipped "
+					  "compressed) and the zip layout is patched too; the "
+					  "patcher has to support it")
 
-		a_files = collect_files(a_folder)
-		b_files = collect_files(b_folder)
+	p.add_option('--cache', metavar='DIR',
+				 help="keep the patches and trial-diff sizes in DIR and "
+					  "reuse them in later runs")
 
-		compute_delta(a_folder, a_files, b_folder, b_files)
+	p.add_option('--cache-size', type='int', default=1024, metavar='MB',
+				 help="evict the least recently used files from the "
+					  "cache beyond this size (default 1024)")
 
-		shutil.rmtree(a_folder)
-		shutil.rmtree(b_folder)
+	p.add_option('--report', metavar='FILE',
+				 help="write stage timings, byte counts and memory peaks "
+					  "to FILE as JSON")
 
-		print('compressing patch file %s' % g_patch_filename)
-		zipf = zipfile.ZipFile(g_patch_filename, 'w')
-		zipdir(g_output_dir, zipf)
+	p.add_option('--prometheus', metavar='FILE',
+				 help="write the same numbers to FILE in the Prometheus "
+					  "textfile format")
+
+	p.add_option('--trace-memory', action='store_true',
+				 help="record the peak Python heap of each stage with "
+					  "tracemalloc (slow)")
+
+	opts, args = p.parse_args()
+
+	if opts.codec != 'auto' and opts.codec not in bsdiff4.format.CODECS:
+		p.error('unknown codec: %s' % opts.codec)
+
+	if len(args) < 2:
+		p.error('requires at least 2 arguments, try -h')
+
+	a_apks, b_apk = args[:-1], args[-1]
+	if len(a_apks) == 1:
+		patch_names = [g_patch_filename]
+	else:
+		patch_names = ['patch-%s.zip' % os.path.splitext(os.path.basename(a_apk))[0]
+					   for a_apk in a_apks]
+		if len(set(patch_names)) != len(patch_names):
+			p.error('the base APKs must have different names')
+	jobs = opts.jobs or multiprocessing.cpu_count()
+	global g_trial_diffs; g_trial_diffs = opts.trial_diffs
+	global g_exact; g_exact = opts.exact
+	global g_time_budget; g_time_budget = opts.time_budget
+
+	global g_stats; g_stats = Stats(opts.trace_memory)
+
+	print('Reading APK manifests...')
+
+	# the target is read once, whatever the number of bases
+	g_stats.start('manifest')
+	a_zips = [apkzip.MappedZipReader(a_apk) for a_apk in a_apks]
+	b_zip = apkzip.MappedZipReader(b_apk)
+
+	a_manifests = [Manifest(a_zip) for a_zip in a_zips]
+	b_files = Manifest(b_zip)
+	g_stats.stop('manifest')
+
+	output_dirs = [g_output_dir]
+	if len(a_apks) > 1:
+		output_dirs = ['%s/%d' % (g_output_dir, i) for i in range(len(a_apks))]
+
+	engine = DiffEngine(a_zips, b_zip, jobs, opts.codec, opts.cache,
+						opts.window_size << 20)
+	try:
+		diff_jobs = []
+		for a_zip, a_files, output_dir in zip(a_zips, a_manifests, output_dirs):
+			if len(a_apks) > 1:
+				print('\n*** %s' % a_zip.filename)
+			diff_jobs += compute_delta(engine, a_zip, a_files, b_zip, b_files,
+									   output_dir)
+		run_diffs(engine, diff_jobs, a_manifests, b_files)
+	finally:
+		engine.close()
+
+	if opts.cache:
+		cache = patchcache.PatchCache(opts.cache, opts.cache_size << 20)
+		g_stats.count('cache_evicted_bytes', cache.evict())
+
+	for a_zip in a_zips:
+		a_zip.close()
+	b_zip.close()
+
+	g_stats.info['apks'] = list(args)
+	g_stats.info['patches'] = {}
+	for patch_name, output_dir in zip(patch_names, output_dirs):
+		print('compressing patch file %s' % patch_name)
+		g_stats.start('zip')
+		zipf = zipfile.ZipFile(patch_name, 'w')
+		zipdir(output_dir, zipf)
 		zipf.close()
+		g_stats.stop('zip')
+		g_stats.count('bytes_written', os.path.getsize(patch_name))
+		g_stats.info['patches'][patch_name] = os.path.getsize(patch_name)
+
+	shutil.rmtree(g_output_dir)
+
+	g_stats.print_summary()
+	if opts.report:
+		g_stats.write_json(opts.report)
+	if opts.prometheus:
+		g_stats.write_prometheus(opts.prometheus)
 
-		shutil.rmtree(g_output_dir)
-		
-	except:
-		print('Usage: {} <APK-from> <APK-to>'.format(os.path.basename(sys.argv[0])))
-		raise
 
+# patch files which are deflated in patch.zip, the rest is stored;
+# LAYOUT.txt has a line for every entry of the new APK
+DEFLATED_PATCH_FILES = ('LAYOUT.txt',)
+# and the paths of the files shipped whole which were compressed in the
+# APK, see write_whole()
+g_deflated_files = set()
+
+# the local time zip.write() turns into the 1980-01-01 00:00:00 entry date
+ZIP_EPOCH = time.mktime((1980, 1, 1, 0, 0, 0, 0, 0, -1))
 
 def zipdir(path, zip):
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            zip.write(os.path.join(root, file))
+	# Sorted names, a fixed timestamp and mode, so the same patch contents
+	# always give a byte-identical zip. zip.write() streams each file
+	# instead of reading it into memory.
+	names = []
+	for root, dirs, files in os.walk(path):
+		for file in files:
+			names.append(os.path.relpath(os.path.join(root, file), path))
+	for name in sorted(names):
+		file = os.path.join(path, name)
+		os.chmod(file, 0o644)
+		os.utime(file, (ZIP_EPOCH, ZIP_EPOCH))
+		if (os.path.basename(name) in DEFLATED_PATCH_FILES or
+				file in g_deflated_files):
+			compress_type = zipfile.ZIP_DEFLATED
+		else:
+			compress_type = zipfile.ZIP_STORED
+		zip.write(file, name.replace(os.sep, '/'), compress_type)
 
 def ensure_dir_exists(path):
 	if os.path.exists(path):
 		shutil.rmtree(path)
 	os.makedirs(path)
 
+def read_file(path):
+	f = open(path, 'rb')
+	data = f.read()
+	f.close()
+	return data
+
+def write_file(path, data):
+	f = open(path, 'wb')
+	f.write(data)
+	f.close()
+
+
+class Stats(object):
+	'''
+	Instrumentation for one run: wall and CPU time per stage, byte
+	counters, one record per bsdiff run (including the ones done by the
+	workers, which report back their own timings) and peak memory.
+
+	Stages are timed with start()/stop() or the stage() context manager;
+	time spent in a stage nested inside another one counts for both.
+	'''
+
+	def __init__(self, trace_memory=False):
+		self.stages = collections.OrderedDict()
+		self.running = {}
+		self.counters = collections.OrderedDict([('bytes_read', 0),
+												  ('bytes_written', 0)])
+		self.diffs = []
+		self.decisions = collections.OrderedDict()
+		self.info = {}
+		self.trace_memory = trace_memory and tracemalloc is not None
+		if self.trace_memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+
+	def start(self, name):
+		self.running[name] = (time.time(), process_time())
+		if self.trace_memory and hasattr(tracemalloc, 'reset_peak'):
+			tracemalloc.reset_peak()
+
+	def stop(self, name):
+		wall, cpu = self.running.pop(name)
+		self.add(name, time.time() - wall, process_time() - cpu)
+		if self.trace_memory:
+			stage = self.stages[name]
+			stage['peak_traced_bytes'] = max(stage.get('peak_traced_bytes', 0),
+											 tracemalloc.get_traced_memory()[1])
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		self.start(name)
+		try:
+			yield
+		finally:
+			self.stop(name)
+
+	def add(self, name, wall, cpu, count=1):
+		stage = self.stages.setdefault(name, {'count': 0, 'wall_seconds': 0.0,
+											  'cpu_seconds': 0.0})
+		stage['count'] += count
+		stage['wall_seconds'] += wall
+		stage['cpu_seconds'] += cpu
+
+	def count(self, name, n):
+		self.counters[name] = self.counters.get(name, 0) + n
+
+	def record(self, stage, rec):
+		# rec is what a worker function returned about one bsdiff run
+		self.add(stage, rec['wall_seconds'], rec['cpu_seconds'])
+		self.count('bytes_read', rec['bytes_read'])
+		self.count('bytes_written', rec['bytes_written'])
+		for name in 'cache_hits', 'cache_misses', 'index_hits', 'index_misses':
+			if name in rec:
+				self.count(name, rec[name])
+		rec = dict(rec)
+		rec['stage'] = stage
+		self.diffs.append(rec)
+
+	def decide(self, apk, entry, action, base=None, reason='', **estimates):
+		'''
+		Record how the entry of the target is shipped in the patch against
+		apk: 'diff' (against the old entry of the same name), 'base'
+		(against the old entry base), 'copy' (whole) or 'copied' (from the
+		old entry base). A later decision for the same entry replaces the
+		earlier one, which is kept as 'planned'.
+		'''
+		rec = collections.OrderedDict([('apk', apk), ('entry', entry),
+									   ('action', action), ('base', base),
+									   ('reason', reason)])
+		rec.update(sorted(estimates.items()))
+		earlier = self.decisions.get((apk, entry))
+		if earlier is not None:
+			rec['planned'] = earlier['action']
+		self.decisions[(apk, entry)] = rec
 
-def compute_delta(a_folder, a_files, b_folder, b_files):
+	def memory(self):
+		mem = {}
+		if resource:
+			# kilobytes on Linux, bytes on Mac OS X
+			scale = 1 if sys.platform == 'darwin' else 1024
+			mem['peak_rss_bytes'] = scale * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			mem['peak_rss_children_bytes'] = scale * resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+		if self.trace_memory:
+			mem['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+		return mem
+
+	def report(self):
+		report = dict(self.info)
+		report['stages'] = self.stages
+		report['counters'] = self.counters
+		report['memory'] = self.memory()
+		report['diffs'] = self.diffs
+		report['decisions'] = list(self.decisions.values())
+		return report
+
+	def print_summary(self):
+		for name, stage in self.stages.items():
+			print('%-12s %4d x %8.3fs wall %8.3fs cpu' % (name, stage['count'],
+					stage['wall_seconds'], stage['cpu_seconds']))
+		actions = collections.Counter(rec['action'] for rec in self.decisions.values())
+		if actions:
+			print('decisions: %s' % ', '.join('%d %s' % (n, action)
+											  for action, n in sorted(actions.items())))
+		print('%d k read, %d k written' % (self.counters['bytes_read'] / 1024,
+										   self.counters['bytes_written'] / 1024))
+		if self.counters.get('cache_hits') or self.counters.get('cache_misses'):
+			print('cache: %d hits, %d misses, %d index files used, %d written' % (
+					self.counters['cache_hits'], self.counters['cache_misses'],
+					self.counters['index_hits'], self.counters['index_misses']))
+
+	def write_json(self, path):
+		f = open(path, 'w')
+		json.dump(self.report(), f, indent=2)
+		f.write('\n')
+		f.close()
+
+	def write_prometheus(self, path):
+		# written next to the target and renamed over it, as the textfile
+		# collector may read it at any time
+		apk = os.path.basename(self.info.get('apks', [''])[-1])
+		lines = []
+		def metric(name, help, samples):
+			lines.append('# HELP apkdiff_%s %s' % (name, help))
+			lines.append('# TYPE apkdiff_%s gauge' % name)
+			for labels, value in samples:
+				labels = dict(labels, apk=apk)
+				lines.append('apkdiff_%s{%s} %s' % (name, ','.join('%s="%s"' %
+							 (k, labels[k].replace('"', '\\"')) for k in sorted(labels)), value))
+		metric('stage_wall_seconds', 'Wall time spent in each stage.',
+			   [({'stage': k}, v['wall_seconds']) for k, v in self.stages.items()])
+		metric('stage_cpu_seconds', 'CPU time spent in each stage.',
+			   [({'stage': k}, v['cpu_seconds']) for k, v in self.stages.items()])
+		metric('stage_count', 'Number of times each stage ran.',
+			   [({'stage': k}, v['count']) for k, v in self.stages.items()])
+		for name, value in self.counters.items():
+			metric(name, 'Total %s.' % name.replace('_', ' '), [({}, value)])
+		for name, value in self.memory().items():
+			metric(name, 'Memory high-water mark.', [({}, value)])
+		metric('patch_bytes', 'Size of each patch written.',
+			   [({'patch': k}, v) for k, v in sorted(self.info.get('patches', {}).items())])
+		f = open(path + '.tmp', 'w')
+		f.write('\n'.join(lines) + '\n')
+		f.close()
+		os.rename(path + '.tmp', path)
+
+# replaced by main(), the default collects and discards
+g_stats = Stats()
+
+
+class DiffEngine(object):
+	'''
+	Runs the per-entry bsdiff work, either inline (jobs == 1) or on a
+	pool of worker processes. Each worker opens its own handles on all
+	the APKs. A job names the base APK it reads by its path and writes
+	its result into the output slot it was given, so the patch does not
+	depend on which worker ran which job. With a cache directory, the
+	workers look up and store their results there.
+	'''
+
+	def __init__(self, a_zips, b_zip, jobs=1, codec='bz2', cache_dir=None,
+				 window_size=0):
+		self.jobs = jobs
+		self.codec = codec
+		if jobs > 1:
+			self.pool = multiprocessing.Pool(jobs, open_worker,
+											 ([a_zip.filename for a_zip in a_zips],
+											  b_zip.filename, codec, cache_dir,
+											  window_size))
+		else:
+			self.pool = None
+			init_worker(a_zips, b_zip, codec, cache_dir, window_size)
+
+	def map(self, func, jobs):
+		if self.pool is None:
+			return [func(job) for job in jobs]
+		return self.pool.map(func, jobs, 1)
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+
+# the archives (the bases by path), the bsdiff codec, the patch cache
+# (or None) and the window size (or 0) used by the worker functions
+# below, one set per process
+g_a_zips = {}
+g_b_zip = None
+g_codec = 'bz2'
+g_cache = None
+g_window_size = 0
+
+def open_worker(a_apks, b_apk, codec, cache_dir=None, window_size=0):
+	init_worker([apkzip.MappedZipReader(a_apk) for a_apk in a_apks],
+				apkzip.MappedZipReader(b_apk), codec, cache_dir, window_size)
+
+def init_worker(a_zips, b_zip, codec, cache_dir=None, window_size=0):
+	global g_a_zips, g_b_zip, g_codec, g_cache, g_window_size
+	g_a_zips = dict((a_zip.filename, a_zip) for a_zip in a_zips)
+	g_b_zip, g_codec, g_window_size = b_zip, codec, window_size
+	g_cache = cache_dir and patchcache.PatchCache(cache_dir)
+
+def entry_zip(apk):
+	# apk is the path of a base APK, or None for the target
+	if apk is None:
+		return g_b_zip
+	return g_a_zips[apk]
+
+def read_entry(apk, name):
+	# a view of the APK for a STORED entry, nothing is copied until
+	# bsdiff4 (which takes any buffer) has it; DEFLATED ones are inflated
+	return entry_zip(apk).read(name)
+
+def cache_key(src_hash, dst_hash, window_size=0):
+	# everything the patch of src to dst depends on
+	return g_cache.key(src_hash, dst_hash, 'codec=%s' % (g_codec,),
+					   'window=%d' % window_size,
+					   'bsdiff4=%s' % bsdiff4.__version__)
+
+def source_index(src, src_hash, rec):
+	# the bsdiff4.SourceIndex of src: with a cache, the suffix array is
+	# mapped from its index file, or sorted and saved there for next time
+	if not g_cache:
+		return bsdiff4.SourceIndex(src)
+	index = g_cache.get_index(src_hash, src)
+	if index is not None:
+		rec['index_hits'] += 1
+		return index
+	rec['index_misses'] += 1
+	index = bsdiff4.SourceIndex(src)
+	g_cache.put_index(src_hash, index)
+	return index
+
+def trial_diffs(job):
+	# job is (base APK, src entry, [dst entries]); the source is sorted once,
+	# and only if some size is not in the cache. Returns the patch sizes
+	# and a timing record.
+	wall, cpu = time.time(), process_time()
+	src = read_entry(job[0], job[1])
+	src_hash = g_cache and patchcache.content_hash(src)
+	index = None
+	sizes = []
+	bytes_read = len(src)
+	counts = cache_counts()
+	for dst in job[2]:
+		dst_data = g_b_zip.read(dst)
+		bytes_read += len(dst_data)
+		size = None
+		if g_cache:
+			key = cache_key(src_hash, patchcache.content_hash(dst_data))
+			size = g_cache.get_size(key)
+		if size is not None:
+			counts['cache_hits'] += 1
+		else:
+			if index is None:
+				index = source_index(src, src_hash, counts)
+			size = measure_diff(index, dst_data)
+			if g_cache:
+				counts['cache_misses'] += 1
+				g_cache.put_size(key, size)
+		sizes.append(size)
+	rec = timing_record(job[1], ', '.join(job[2]), wall, cpu, bytes_read, 0)
+	rec.update(counts)
+	return sizes, rec
+
+def cache_counts():
+	# the cache lookups of one job, added to its timing record
+	if not g_cache:
+		return {}
+	return {'cache_hits': 0, 'cache_misses': 0, 'index_hits': 0,
+			'index_misses': 0}
+
+def sketch_entry(job):
+	# job is (base APK or None, entry name), returns the sketch, the ELF
+	# fingerprint (None for anything but a native library) and the
+	# number of bytes read; both read a STORED entry through the map
+	data = read_entry(*job)
+	return sketch(data), elfinfo.fingerprint(data), len(data)
+
+def deflate_params_entry(name):
+	# the zlib parameters which reproduce the DEFLATED entry name of the
+	# target, or None
+	info = g_b_zip.getinfo(name)
+	return apkzip.find_deflate_params(g_b_zip.read(info), g_b_zip.read_raw(info))
+
+def hash_entry(job):
+	# job is (base APK or None, entry name); a DEFLATED entry is inflated
+	# and hashed a piece at a time
+	return patchcache.content_hash_iter(entry_zip(job[0]).iter_read(job[1]))
+
+def diff_entry(job):
+	# job is (base APK, src entry, dst entry, output slot), returns a
+	# timing record
+	wall, cpu = time.time(), process_time()
+	apk, src_name, dst_name, out = job
+	src = read_entry(apk, src_name)
+	dst = g_b_zip.read(dst_name)
+	# only entries larger than a window are diffed in windows
+	window_size = g_window_size if len(dst) > g_window_size else 0
+	counts = cache_counts()
+	hit = False
+	if g_cache:
+		src_hash = patchcache.content_hash(src)
+		key = cache_key(src_hash, patchcache.content_hash(dst), window_size)
+		hit = g_cache.get_patch(key, out)
+	if hit:
+		counts['cache_hits'] += 1
+	else:
+		f = open(out, 'wb')
+		if g_cache and not window_size:
+			index = source_index(src, src_hash, counts)
+		else:
+			index = src
+		bsdiff4.format.write_diff(f, index, dst, g_codec, window_size)
+		f.close()
+		if g_cache:
+			counts['cache_misses'] += 1
+			g_cache.put_patch(key, out)
+	rec = timing_record(src_name, dst_name, wall, cpu, len(src) + len(dst),
+						os.path.getsize(out))
+	rec.update(counts)
+	return rec
+
+def timing_record(src, dst, wall, cpu, bytes_read, bytes_written):
+	return {'src': src, 'dst': dst,
+			'wall_seconds': time.time() - wall,
+			'cpu_seconds': process_time() - cpu,
+			'bytes_read': bytes_read, 'bytes_written': bytes_written}
+
+
+def compute_delta(engine, a_zip, a_files, b_zip, b_files, output_dir):
+	'''
+	Write the TOC and the added files of the patch from a_zip to b_zip
+	into output_dir and return the diff jobs which fill in the rest,
+	for run_diffs().
+	'''
 	print('Going from %d files %d files' % (len(a_files), len(b_files)))
+	g_stats.start('classify')
 
 	# First let's fill up these categories
 	files_new = []
@@ -99,56 +616,99 @@ def compute_delta(a_folder, a_files, b_folder, b_files):
 	files_unchanged = []
 	files_renamed = []
 
-	# First, let's remove the .so files since we're going to treat
-	# them special.
-	a_files_so = [tup for tup in a_files if tup.endswith('.so')]
-	b_files_so = [tup for tup in b_files if tup.endswith('.so')]
-
-	
-
-	# What files appear in B but not in A?
-	for elt in b_files:
-		if elt not in a_files:
-			if not elt.endswith('.so'):
-				files_new.append(elt)
-	
 	# What files appear in A but not in B?
 	for elt in a_files:
 		if elt not in b_files:
 			files_removed.append(elt)
 	
-	# What files have changed contents but not name/path?
+	# What files have changed contents but not name/path? The central
+	# directory already tells us, nothing needs to be decompressed here.
 	for elt in b_files:
 		if elt in a_files:
-			if not filecmp.cmp(a_folder+'/'+elt, b_folder+'/'+elt):
+			if a_files[elt].content != b_files[elt].content:
 				files_changed.append(elt)
 			else:
 				files_unchanged.append(elt)
+	g_stats.stop('classify')
 
+	# The same CRC and size is not proof of the same bytes: the entries
+	# whose stored bytes differ (recompressed, or a CRC collision) are
+	# confirmed by their sha256, as a wrong guess would leave the old
+	# entry in the new APK.
+	recompressed = [elt for elt in files_unchanged
+					if not same_raw(a_zip, b_zip, b_zip.getinfo(elt), elt)]
+	hash_entries(engine, {a_zip.filename: a_files, None: b_files},
+				 [(apk, elt) for elt in recompressed for apk in (a_zip.filename, None)])
+	changed = set(elt for elt in recompressed if a_files.hashes[elt] != b_files.hashes[elt])
+	if changed:
+		changed.update(files_changed)
+		files_changed = [elt for elt in b_files if elt in changed]
+		files_unchanged = [elt for elt in files_unchanged if elt not in changed]
 
 	'''
-	Special-case the .so files.
-	
-	We ultimately want to diff .so files that are built from
-	the same source even if the names have slightly changed.
-	'''
-	print('Find matches for .so files')
-	for elt in b_files_so:
-		if elt in a_files_so:
-			# this file is the same name in both!
-			files_changed.append(elt)
-		else:
-			# This one is new, but we can probably bsdiff it with one
-			# of the other .so's since it was likely renamed.
-			a_best_choice_diff = find_best_diff(b_folder+'/'+elt, a_folder, a_files_so)
+	Some of the files the patch has to carry are stored in A already,
+	under another name (moved files, swapped files, the same asset in
+	several places). They are copied from there, not diffed or shipped.
+	'''
+	b_files_new = [elt for elt in b_files if elt not in a_files]
+	files_copied = find_copies(engine, a_zip, a_files, b_files,
+							   files_changed + b_files_new)
+	files_changed = [elt for elt in files_changed if elt not in files_copied]
+	b_files_new = [elt for elt in b_files_new if elt not in files_copied]
+	for elt, src in files_copied.items():
+		g_stats.decide(a_zip.filename, elt, 'copied', src, 'same bytes')
+
+	'''
+	A file changed in place is not always worth diffing against its old
+	version: tiny files, files which changed beyond recognition (another
+	old file may do better) and, with a time budget, the diffs which save
+	the least for their time are shipped whole or rebased.
+	'''
+	g_stats.start('plan')
+	plan = plan_changes(engine, a_files, b_files, files_changed, g_time_budget)
+	g_stats.stop('plan')
+	files_rebased = [[elt, plan[elt][1]] for elt in files_changed if plan[elt][0] == 'base']
+	files_whole = [elt for elt in files_changed if plan[elt][0] == 'copy']
+	files_changed = [elt for elt in files_changed if plan[elt][0] == 'diff']
+
+	'''
+	What files appear in B but not in A? They may well be moved or
+	lightly edited copies of old files (renamed .so files, split dex
+	files, obfuscated asset names), which are diffed against the old
+	file they match best rather than shipped whole.
+	'''
+	print('Find matches for new files')
+	g_stats.start('match')
+	best_choices = find_best_diff(engine, b_files,
+								  [elt for elt in b_files_new
+								   if b_files[elt].size >= RENAME_MIN_SIZE],
+								  a_files)
 
+	for elt in b_files_new:
+		a_best_choice_diff = best_choices.get(elt)
+		if a_best_choice_diff is None:
+			# nothing worth diffing against, ship it whole
+			files_new.append(elt)
+			g_stats.decide(a_zip.filename, elt, 'copy', None,
+						   'no old file gives a patch smaller than the file'
+						   if elt in best_choices else 'new and small')
+		else:
 			# this will be a 'rename' record in the TOC
-			files_renamed.append([elt, a_best_choice_diff])
+			files_renamed.append([elt, a_best_choice_diff[0]])
+			g_stats.decide(a_zip.filename, elt, 'base', a_best_choice_diff[0],
+						   'best trial diff', trial_patch_bytes=a_best_choice_diff[1])
+	g_stats.stop('match')
+	files_new = files_whole + files_new
+	files_renamed = files_rebased + files_renamed
+
+	# new files with the same bytes as an earlier one are only shipped once
+	files_same = find_duplicates(engine, b_files, files_new)
+	files_new = [elt for elt in files_new if elt not in files_same]
 
-	
 
-	print('%d .so files to diff' % (len(b_files_so) + len(a_files_so)))
 	print('%d new files' % len(files_new))
+	print('%d files copied' % len(files_copied))
+	print('%d files duplicating a new one' % len(files_same))
 	print('%d removed files' % len(files_removed))
 	print('%d files changed' % len(files_changed))
 	print('%d files unchanged' % len(files_unchanged))
@@ -166,116 +726,683 @@ def compute_delta(a_folder, a_files, b_folder, b_files):
 	  -<filename>         					// This file should be REMOVED
 	  +<id>|<dst_filename>         			// This file should be ADDED
 	  c<id>|<filename>						// This file shouldb be patched, same name
-	  r<id>|<src_filename>|<dst_filename>		// this file should be patched to 
+	  C<id>|<src_filename>|<dst_filename>		// this file should be patched from
 												src_filename and named dst_filename
+	  =<src_filename>|<dst_filename>		// this file is a copy of src_filename
+	  &<id>|<dst_filename>					// this file is the same as the one
+												ADDED as <id>
 	'''
 
 	# temp dir where we're assembling the patch
-	ensure_dir_exists(g_output_dir)
+	g_stats.start('write_files')
+	ensure_dir_exists(output_dir)
 
 	unique_fileid = 0
 
 
-	toc = open(g_output_dir+'/TOC.txt','w')
+	toc = open(output_dir+'/TOC.txt','w')
 	# TODO write SHA1 of result
 	toc.write('sha1 97ff22e8da32324bd1c79fd7b3da8a5b0c5f6dd1\n')
 
 	for elt in files_removed:
 		toc.write('-%s\n' % elt)
 
+	added = {}
 	for elt in files_new:
 		# write an entry for the file
 		toc.write('+%d|%s\n' % (unique_fileid, elt))
+		added[elt] = unique_fileid
 		
 		# copy the file contents itself into the folder.
-		shutil.copy(b_folder+'/'+elt, '%s/f%d' % (g_output_dir, unique_fileid))
+		write_whole(b_files, elt, '%s/f%d' % (output_dir, unique_fileid))
 		unique_fileid = unique_fileid + 1
 
-	print("writing diff'ed changed files...")
+	for elt in b_files:
+		if elt in files_same:
+			toc.write('&%d|%s\n' % (added[files_same[elt]], elt))
+		elif elt in files_copied:
+			toc.write('=%s|%s\n' % (files_copied[elt], elt))
+
+	# Every diff gets its output slot up front; the workers only fill
+	# them in, in whatever order they finish.
+	diff_jobs = []
 	for elt in files_changed:
 		toc.write('c%d|%s\n' % (unique_fileid, elt))
-		bsdiff4.file_diff(b_folder+'/'+elt, a_folder+'/'+elt, 
-							'%s/f%d' % (g_output_dir, unique_fileid))
+		diff_jobs.append((a_zip.filename, elt, elt,
+						  '%s/f%d' % (output_dir, unique_fileid)))
 		unique_fileid = unique_fileid + 1
 
 	for elt in files_renamed:
 		# these files are diffed against a src file with a different name
-		src_file = a_folder+'/'+elt[1]
-		dst_file = b_folder+'/'+elt[0]
 		toc.write('C%d|%s|%s\n' % (unique_fileid, elt[1], elt[0]))
-		bsdiff4.file_diff(src_file, dst_file, 
-			'%s/f%d' % (g_output_dir, unique_fileid))
+		diff_jobs.append((a_zip.filename, elt[1], elt[0],
+						  '%s/f%d' % (output_dir, unique_fileid)))
 		unique_fileid = unique_fileid + 1
 
 	toc.close()
+	g_stats.stop('write_files')
 
-def find_best_diff(dst, prefix, filelist):
-	print('\nFinding the best file (%d files) to patch %s with:' % (len(filelist), dst))
-	winning_patch_sz = sys.maxint
-	for elt in filelist:
-		src_file = prefix+'/'+elt
-		src_sz = os.path.getsize(src_file)
-		dst_sz = os.path.getsize(dst)
-		#print('%s (%d k) ->' % (src_file, src_sz/1024))
-		if (src_sz > 0) and os.path.splitext(src_file)[1] == os.path.splitext(dst)[1]:
-			print(' ... trying %s (%dk) with %s (%dk)' % (src_file, src_sz/1024, dst, dst_sz/1024))
-			diff_sz = measure_two_filediffs(src_file, dst)
-			if diff_sz < winning_patch_sz:
-				winning_patch_sz = diff_sz
-				winning_file = elt
-
-	print('   Winner is %s -> %s, patch is only %d k!\n' % (dst, winning_file, 
-					winning_patch_sz/1024))
-	return winning_file
-
-def measure_two_filediffs(src, dst):
-	k_patch_filename = 'temp.patch'
-	bsdiff4.file_diff(src, dst, k_patch_filename)
-	result_size = os.path.getsize(k_patch_filename)
-	os.remove(k_patch_filename)
-	return result_size
-
-def collect_files(path):
-	dirs, files = listdir(path)[:2]
-	all_files = []
-	return walk(path, dirs, files, all_files, path)
-
-def walk(root, dirs, files, all_files, path_prefix_to_remove, prefix=''):
-	file_prefix = prefix + ('|' if dirs else ' ') + '   '
-	for name in files:
-		all_files.append(os.path.relpath(root+'/'+name, path_prefix_to_remove))
-		
+	if g_exact:
+		g_stats.start('layout')
+		patched = set(files_new + files_changed) | set(files_copied) | set(files_same)
+		patched.update(elt[0] for elt in files_renamed)
+		write_layout(engine, a_zip, b_zip, b_files, output_dir, unique_fileid,
+					 patched, files_copied)
+		g_stats.stop('layout')
+	return diff_jobs
 
-	dir_prefix, walk_prefix = prefix + '+---', prefix + '|   '
-	for pos, neg, name in enumerate2(dirs):
-		if neg == -1:
-			dir_prefix, walk_prefix = prefix + '\\---', prefix + '    '
-		path = os.path.join(root, name)
-		try:
-			dirs, files = listdir(path)[:2]
-		except:
-			pass
+def write_whole(b_files, elt, path):
+	# the data of the entry elt of the target into the patch file path,
+	# deflated in patch.zip if it is in the APK
+	data = b_files.zipf.read(elt)
+	write_file(path, data)
+	if b_files[elt].compress_size < b_files[elt].size:
+		g_deflated_files.add(path)
+	g_stats.count('bytes_read', len(data))
+	g_stats.count('bytes_written', len(data))
+
+def plan_changes(engine, a_files, b_files, names, budget=0):
+	'''
+	Decide how to ship each of names, files changed in place, and return
+	{name: (action, base)}: ('diff', name) against its old version,
+	('base', other) against another old file, or ('copy', None) whole.
+
+	The patch size and bsdiff time of a diff are estimated from the sizes
+	and the sketch similarity of the two versions (PLAN_DIFF_RATE,
+	PLAN_PATCH_OVERHEAD). A file whose compressed size does not cover
+	the overhead of a patch is shipped whole. One whose estimated patch
+	is not smaller than the file (it changed beyond recognition, or its
+	edits touch every chunk) goes through find_best_diff(), which
+	trial-diffs its old version and the most similar other old files,
+	and picks the best patch if any is smaller than the file. With a
+	budget (seconds), the diffs are kept in order of bytes saved per
+	second until their estimated time exceeds it, the rest are shipped
+	whole; the trial diffs are not counted. Every decision is recorded
+	with g_stats.decide().
+
+	Diffs which turn out no smaller than the file are shipped whole after
+	all, see replace_large_patches().
+	'''
+	apk = a_files.zipf.filename
+	plan = {}
+	sketch_entries(engine, b_files, names, a_files, names)
+	diffs = []
+	unlike = {}
+	for name in names:
+		src, dst = a_files[name], b_files[name]
+		if dst.compress_size <= PLAN_PATCH_OVERHEAD:
+			plan[name] = ('copy', None)
+			g_stats.decide(apk, name, 'copy', None, 'smaller than a patch header')
+			continue
+		similarity = sketch_similarity(a_files.sketches[name], b_files.sketches[name])
+		patch = int(PLAN_PATCH_OVERHEAD + (1 - similarity) * dst.compress_size)
+		seconds = (src.size + dst.size) * (3 - 2 * similarity) / PLAN_DIFF_RATE
+		if patch < dst.compress_size:
+			diffs.append((name, similarity, patch, seconds))
+		else:
+			unlike[name] = similarity
+
+	best = {}
+	if unlike:
+		best = find_best_diff(engine, b_files, [name for name in names if name in unlike],
+							  a_files)
+	for name in names:
+		if name not in unlike:
+			continue
+		why = '%d%% similar to its old version' % (100 * unlike[name])
+		if best.get(name) is None:
+			plan[name] = ('copy', None)
+			g_stats.decide(apk, name, 'copy', None,
+						   why + ', no old file gives a patch smaller than the file')
+		elif best[name][0] == name:
+			plan[name] = ('diff', name)
+			g_stats.decide(apk, name, 'diff', name, why + ', but its trial diff is small',
+						   trial_patch_bytes=best[name][1])
+		else:
+			plan[name] = ('base', best[name][0])
+			g_stats.decide(apk, name, 'base', best[name][0],
+						   why + ', another old file gives a smaller patch',
+						   trial_patch_bytes=best[name][1])
+
+	# the biggest savings for the time first, as long as the budget lasts
+	diffs.sort(key=lambda d: -(b_files[d[0]].compress_size - d[2]) / max(d[3], 1e-6))
+	spent = 0.0
+	for name, similarity, patch, seconds in diffs:
+		estimates = {'estimated_patch_bytes': patch, 'estimated_seconds': round(seconds, 3)}
+		if budget and spent + seconds > budget:
+			plan[name] = ('copy', None)
+			g_stats.decide(apk, name, 'copy', None, 'over the time budget', **estimates)
+			continue
+		spent += seconds
+		plan[name] = ('diff', name)
+		g_stats.decide(apk, name, 'diff', name, '%d%% similar to its old version' %
+					   (100 * similarity), **estimates)
+	return plan
+
+def replace_large_patches(diff_jobs, b_files):
+	'''
+	Ship whole the files whose patch came out no smaller than the file
+	(compressed): the patch file is replaced by the data and its c or C
+	record by a + record.
+	'''
+	records = collections.OrderedDict()
+	for apk, src, dst, slot in diff_jobs:
+		size = os.path.getsize(slot)
+		if size < b_files[dst].compress_size:
+			continue
+		write_whole(b_files, dst, slot)
+		output_dir, fileid = os.path.dirname(slot), os.path.basename(slot)[1:]
+		records.setdefault(output_dir, {})[fileid] = dst
+		g_stats.decide(apk, dst, 'copy', None, 'the patch (%d bytes) is not smaller '
+					   'than the file (%d)' % (size, b_files[dst].compress_size))
+	for output_dir, whole in records.items():
+		toc = read_file(output_dir + '/TOC.txt').decode('utf-8').splitlines()
+		for i, line in enumerate(toc):
+			if line[:1] in ('c', 'C') and line[1:].split('|', 1)[0] in whole:
+				fileid = line[1:].split('|', 1)[0]
+				toc[i] = '+%s|%s' % (fileid, whole[fileid])
+		write_file(output_dir + '/TOC.txt', ''.join(line + '\n' for line in toc).encode('utf-8'))
+
+def write_layout(engine, a_zip, b_zip, b_files, output_dir, fileid, patched, copies):
+	'''
+	For an exact patch, write what it takes to rebuild b_zip byte for
+	byte from the entries the TOC rebuilds (patched, the names of its
+	records; copies maps those of its = records to their old entry):
+
+	  layout        the bsdiff patch from the layout of a_zip to the
+	                one of b_zip (see apkzip.split_layout)
+	  LAYOUT.txt    sha256 <hex of b_zip>
+	                <offset>|<how>|<name>, for each entry in file order
+
+	where <how> tells how to get the stored bytes of the entry, to be put
+	at <offset> of the new layout:
+
+	  copy          those of the entry of a_zip it is a copy of (= record),
+	                or of the same name
+	  stored        the data of the entry (from the TOC, or the entry of
+	                the same name in a_zip)
+	  deflate L S M that data deflated with level L, strategy S and
+	                memory level M (apkzip.deflate)
+	  raw <id>      file f<id> of the patch: the entries which no zlib
+	                parameters reproduce, or which have no data to start
+	                from (a new directory entry)
+
+	Returns the next free file id.
+	'''
+	layout, cuts = b_files.layout()
+	# the DEFLATED entries which have to be rebuilt, their parameters
+	# are kept for the next base
+	todo = []
+	for offset, info in cuts:
+		name = info.filename
+		if (info.compress_type == zipfile.ZIP_DEFLATED and name not in b_files.deflate_params
+				and not same_raw(a_zip, b_zip, info, copies.get(name, name))):
+			todo.append(name)
+	g_stats.start('zlib_params')
+	for name, params in zip(todo, engine.map(deflate_params_entry, todo)):
+		b_files.deflate_params[name] = params
+		g_stats.count('bytes_read', b_zip.getinfo(name).file_size)
+	g_stats.stop('zlib_params')
+
+	lines = ['sha256 %s\n' % b_files.digest()]
+	for offset, info in cuts:
+		name = info.filename
+		has_data = name in patched or name in a_zip.by_name
+		params = b_files.deflate_params.get(name)
+		if same_raw(a_zip, b_zip, info, copies.get(name, name)):
+			how = 'copy'
+		elif has_data and info.compress_type == zipfile.ZIP_STORED:
+			how = 'stored'
+		elif has_data and params is not None:
+			how = 'deflate %d %d %d' % params
+		else:
+			how = 'raw %d' % fileid
+			raw = bytes(b_zip.read_raw(info))
+			write_file('%s/f%d' % (output_dir, fileid), raw)
+			g_stats.count('bytes_written', len(raw))
+			fileid += 1
+			if info.compress_type == zipfile.ZIP_DEFLATED:
+				print('   %s cannot be deflated again exactly, shipping it compressed' % name)
+		lines.append('%d|%s|%s\n' % (offset, how, name))
+	write_file(output_dir + '/LAYOUT.txt', ''.join(lines).encode('utf-8'))
+
+	old_layout = apkzip.split_layout(a_zip)[0]
+	layout_patch = bsdiff4.diff(old_layout, layout, engine.codec)
+	write_file(output_dir + '/layout', layout_patch)
+	g_stats.count('bytes_written', len(layout_patch))
+	print('layout patch is %d bytes (layout is %d)' % (len(layout_patch), len(layout)))
+	return fileid
+
+def same_raw(a_zip, b_zip, info, src):
+	# whether the entry src of a_zip has the same stored bytes as the
+	# entry info of b_zip
+	try:
+		a_info = a_zip.getinfo(src)
+	except KeyError:
+		return False
+	if (a_info.compress_type != info.compress_type or a_info.CRC != info.CRC or
+			a_info.compress_size != info.compress_size or
+			a_info.file_size != info.file_size):
+		return False
+	# compared a piece at a time as bytes, which is much faster than
+	# comparing the views
+	a_raw, b_raw = a_zip.read_raw(a_info), b_zip.read_raw(info)
+	for i in range(0, len(a_raw), apkzip.READ_CHUNK_SIZE):
+		if bytes(a_raw[i:i + apkzip.READ_CHUNK_SIZE]) != bytes(b_raw[i:i + apkzip.READ_CHUNK_SIZE]):
+			return False
+	return True
+
+def run_diffs(engine, diff_jobs, a_manifests, b_files):
+	'''
+	Run the diff jobs of one or more patches. A (base entry, target
+	entry) pair which comes up several times, typically because an entry
+	did not change between two of the bases, is diffed once and the
+	patch copied to the other slots.
+	'''
+	manifests = dict((m.zipf.filename, m) for m in a_manifests)
+	manifests[None] = b_files
+
+	# pairs can only be the same if their CRCs and sizes are, so only
+	# those get hashed
+	groups = collections.OrderedDict()
+	for job in diff_jobs:
+		key = (manifests[job[0]][job[1]].content, b_files[job[2]].content)
+		groups.setdefault(key, []).append(job)
+	to_hash = []
+	for jobs in groups.values():
+		if len(jobs) > 1:
+			for job in jobs:
+				to_hash += [(job[0], job[1]), (None, job[2])]
+	hash_entries(engine, manifests, to_hash)
+
+	unique = collections.OrderedDict()
+	for jobs in groups.values():
+		for job in jobs:
+			if len(jobs) > 1:
+				key = (manifests[job[0]].hashes[job[1]], b_files.hashes[job[2]])
+			else:
+				key = job
+			unique.setdefault(key, []).append(job)
+
+	print("writing diff'ed changed files...")
+	g_stats.start('diff')
+	firsts = [jobs[0] for jobs in unique.values()]
+	for rec in engine.map(diff_entry, firsts):
+		g_stats.record('bsdiff', rec)
+	for jobs in unique.values():
+		for job in jobs[1:]:
+			shutil.copyfile(jobs[0][3], job[3])
+			g_stats.count('diffs_shared', 1)
+	g_stats.stop('diff')
+	replace_large_patches(diff_jobs, b_files)
+
+def hash_entries(engine, manifests, entries):
+	'''
+	Fill in the sha256 of the entries, (APK, name) pairs, which are not
+	hashed yet. manifests maps the paths of the base APKs, and None for
+	the target, to their Manifest.
+	'''
+	to_hash = []
+	seen = set()
+	for apk, name in entries:
+		if name not in manifests[apk].hashes and (apk, name) not in seen:
+			seen.add((apk, name))
+			to_hash.append((apk, name))
+	if not to_hash:
+		return
+	g_stats.start('hash')
+	for (apk, name), digest in zip(to_hash, engine.map(hash_entry, to_hash)):
+		manifests[apk].hashes[name] = digest
+		g_stats.count('bytes_read', manifests[apk][name].size)
+	g_stats.stop('hash')
+
+def find_copies(engine, a_zip, a_files, b_files, dst_list):
+	'''
+	The entries of dst_list which have the same bytes as an old entry,
+	as {new entry: old entry}. Candidates come from the (CRC32, size)
+	index of the old manifest and are confirmed by their sha256, as a
+	wrong copy would be a broken APK rather than a bigger patch. An old
+	entry of the same name is preferred.
+	'''
+	src_apk = a_zip.filename
+	manifests = {src_apk: a_files, None: b_files}
+	candidates = {}
+	to_hash = []
+	for dst in dst_list:
+		same = a_files.with_content(b_files[dst].content)
+		if same:
+			candidates[dst] = sorted(same, key=lambda elt: elt != dst)
+			to_hash.append((None, dst))
+			to_hash += [(src_apk, elt) for elt in same]
+	hash_entries(engine, manifests, to_hash)
+
+	copies = {}
+	for dst, same in candidates.items():
+		for elt in same:
+			if a_files.hashes[elt] == b_files.hashes[dst]:
+				copies[dst] = elt
+				break
+	return copies
+
+def find_duplicates(engine, b_files, dst_list):
+	'''
+	The entries of dst_list which have the same bytes as one of dst_list
+	earlier in the archive, as {entry: earlier entry}; like find_copies(),
+	the (CRC32, size) matches of b_files.duplicates() are confirmed by
+	their sha256.
+	'''
+	dst_set = set(dst_list)
+	groups = [[path for path in paths if path in dst_set]
+			  for paths in b_files.duplicates()]
+	groups = [dsts for dsts in groups if len(dsts) > 1]
+	hash_entries(engine, {None: b_files},
+				 [(None, dst) for dsts in groups for dst in dsts])
+
+	same = {}
+	for dsts in groups:
+		first = {}
+		for dst in dsts:
+			digest = b_files.hashes[dst]
+			if digest in first:
+				same[dst] = first[digest]
+			else:
+				first[digest] = dst
+	return same
+
+def sketch_entries(engine, dst_files, dst_list, src_files, src_list):
+	# sketch (and fingerprint) the entries of dst_list and src_list which
+	# are not yet; they are kept in the manifests for the next base
+	src_apk = src_files.zipf.filename
+	sketch_jobs = [(None, dst) for dst in dst_list
+				   if dst not in dst_files.sketches]
+	sketch_jobs += [(src_apk, elt) for elt in src_list
+					if elt not in src_files.sketches]
+	if not sketch_jobs:
+		return
+	g_stats.start('sketch')
+	for job, (sk, fp, bytes_read) in zip(sketch_jobs, engine.map(sketch_entry, sketch_jobs)):
+		files = dst_files if job[0] is None else src_files
+		files.sketches[job[1]] = sk
+		files.fingerprints[job[1]] = fp
+		g_stats.count('bytes_read', bytes_read)
+	g_stats.stop('sketch')
+
+def find_best_diff(engine, dst_files, dst_list, src_files):
+	'''
+	For each entry of dst_list pick the entry of src_files which gives
+	the smallest patch, as (entry, trial patch size), or None when no
+	patch beats shipping the entry whole (its compressed size).
+
+	Copies of old entries are taken out beforehand (find_copies()). The
+	candidates are the old entries with the same extension, a comparable
+	size and at least one chunk in common: every entry which may take
+	part is sketched, and an inverted index from sketch hashes to old
+	entries finds them without comparing each new entry to every old
+	one. They are ranked by estimated similarity and only the best
+	g_trial_diffs of them get a real trial diff. The trial diffs for all
+	of dst_list are handed to the engine in one go.
+
+	Native libraries are matched on their ELF fingerprints instead: the
+	candidates for a new library are the old ones of the same ABI
+	directory and ELF machine (elf_group()), ranked by elfinfo.similarity()
+	before their sketches. Libraries of another ABI are never tried, and
+	the pairing grows with the number of libraries per ABI.
+
+	An entry which has an old version under its own name (one changed in
+	place, see plan_changes()) is always tried against it first, however
+	unlike their sketches are: dense small edits change every chunk but
+	still diff well.
+	'''
+	best = {}
+	pending = list(dst_list)
+
+	# the old entries which could match some new one: same extension and
+	# a size within RENAME_SIZE_RATIO of it
+	sizes_by_ext = {}
+	for dst in pending:
+		sizes_by_ext.setdefault(dst_files[dst].ext, []).append(dst_files[dst].size)
+	for sizes in sizes_by_ext.values():
+		sizes.sort()
+	def comparable(entry):
+		sizes = sizes_by_ext.get(entry.ext)
+		if not sizes or entry.size == 0:
+			return False
+		i = bisect.bisect_left(sizes, entry.size * RENAME_SIZE_RATIO)
+		return i < len(sizes) and sizes[i] * RENAME_SIZE_RATIO <= entry.size
+	sources = [elt for elt in src_files if comparable(src_files[elt])]
+	order = dict((elt, i) for i, elt in enumerate(sources))
+
+	# sketch every file which takes part in a comparison
+	src_apk = src_files.zipf.filename
+	sketch_entries(engine, dst_files, pending, src_files,
+				   sources + [dst for dst in pending if dst in src_files and dst not in order])
+
+	# old libraries by ABI, everything else by sketch hash
+	index = collections.defaultdict(list)
+	groups = collections.defaultdict(list)
+	for elt in sources:
+		fp = src_files.fingerprints[elt]
+		if fp is not None:
+			groups[elf_group(elt, fp)].append(elt)
+			continue
+		for h in src_files.sketches[elt]:
+			index[h].append(elt)
+
+	trials = []
+	for dst in pending:
+		dst_sz = dst_files[dst].size
+		dst_ext = dst_files[dst].ext
+		dst_fp = dst_files.fingerprints[dst]
+		if dst_fp is not None:
+			candidates = groups.get(elf_group(dst, dst_fp), ())
+			dst_sketch = set(dst_files.sketches[dst])
+		else:
+			shared = set()
+			for h in dst_files.sketches[dst]:
+				shared.update(index.get(h, ()))
+			candidates = sorted(shared, key=order.get)
+		if dst in src_files and dst not in candidates:
+			candidates = [dst] + list(candidates)
+		ranked = []
+		for elt in candidates:
+			src_sz = src_files[elt].size
+			ratio = size_ratio(src_sz, dst_sz)
+			own = elt == dst
+			if not own and (src_files[elt].ext != dst_ext or ratio < RENAME_SIZE_RATIO):
+				continue
+			similarity = sketch_similarity(src_files.sketches[elt],
+										   dst_files.sketches[dst])
+			elf_similarity = 0.0
+			src_fp = src_files.fingerprints[elt]
+			if dst_fp is not None and src_fp is not None:
+				# a library of the same ABI is still only worth a trial
+				# if something ties it to this one
+				if not (own or elfinfo.related(src_fp, dst_fp) or
+						set(src_files.sketches[elt]) & dst_sketch):
+					continue
+				elf_similarity = elfinfo.similarity(src_fp, dst_fp)
+			ranked.append((-elf_similarity, -similarity, -ratio, len(ranked), elt))
+		# the old version first, then the best of the others
+		first = [r for r in ranked if r[-1] == dst]
+		ranked = sorted(r for r in ranked if r[-1] != dst)
+		if dst_fp is not None and ranked:
+			ranked = prune_libraries(ranked)
+		ranked = first + ranked
+		if not ranked:
+			continue
+		print('\nFinding the best file (%d files) to patch %s with:' % (len(ranked), dst))
+		if g_trial_diffs > 0:
+			ranked = ranked[:g_trial_diffs]
+		for neg_elf_similarity, neg_similarity, neg_size_ratio, pos, elt in ranked:
+			src_sz = src_files[elt].size
+			if dst_fp is not None:
+				print(' ... trying %s (%dk) with %s (%dk), %d%% similar, ELF match %d%%' % (
+						elt, src_sz/1024, dst, dst_sz/1024, -100 * neg_similarity,
+						-100 * neg_elf_similarity))
+			else:
+				print(' ... trying %s (%dk) with %s (%dk), %d%% similar' % (elt, src_sz/1024,
+						dst, dst_sz/1024, -100 * neg_similarity))
+			trials.append((elt, dst))
+
+	# group the trials by old file, so each one is suffix-sorted once
+	# however many new files it is tried against
+	by_src = collections.OrderedDict()
+	for elt, dst in trials:
+		by_src.setdefault(elt, []).append(dst)
+	jobs = [(src_apk, elt, dsts) for elt, dsts in by_src.items()]
+	g_stats.start('trial_diffs')
+	sizes = {}
+	for (apk, elt, dsts), (diff_szs, rec) in zip(jobs, engine.map(trial_diffs, jobs)):
+		g_stats.record('trial_diff', rec)
+		for dst, diff_sz in zip(dsts, diff_szs):
+			sizes[(elt, dst)] = diff_sz
+	g_stats.stop('trial_diffs')
+
+	# ties go to the first candidate tried, however the workers finished
+	winners = {}
+	for elt, dst in trials:
+		diff_sz = sizes[(elt, dst)]
+		if dst not in winners or diff_sz < winners[dst][1]:
+			winners[dst] = (elt, diff_sz)
+
+	for dst in pending:
+		if dst not in winners:
+			print('   No candidate to patch %s with' % dst)
+			best[dst] = None
+			continue
+		winning_file, winning_patch_sz = winners[dst]
+		if winning_patch_sz >= dst_files[dst].compress_size:
+			print('   Shipping %s whole, the best patch (from %s) is %d k' % (
+				dst, winning_file, winning_patch_sz/1024))
+			best[dst] = None
 		else:
-			walk(path, dirs, files, all_files, path_prefix_to_remove, walk_prefix)
-
-	return all_files
-
-def listdir(path):
-	dirs, files, links = [], [], []
-	for name in os.listdir(path):
-		path_name = os.path.join(path, name)
-		if os.path.isdir(path_name):
-			dirs.append(name)
-		elif os.path.isfile(path_name):
-			files.append(name)
-		elif os.path.islink(path_name):
-			links.append(name)
-	return dirs, files, links
-
-def enumerate2(sequence):
-	length = len(sequence)
-	for count, value in enumerate(sequence):
-		yield count, count - length, value
+			print('   Winner is %s -> %s, patch is only %d k!' % (dst, winning_file,
+							winning_patch_sz/1024))
+			best[dst] = (winning_file, winning_patch_sz)
+	print('')
+	return best
+
+def size_ratio(a, b):
+	return float(min(a, b)) / max(a, b, 1)
+
+def prune_libraries(ranked):
+	# the ranked libraries within ELF_RANK_CUTOFF of the best one on a
+	# score which tells something (is not 0 for them all)
+	bests = [max(-r[i] for r in ranked) for i in (0, 1)]
+	if not any(bests):
+		return ranked
+	return [r for r in ranked
+			if any(best > 0 and -r[i] >= ELF_RANK_CUTOFF * best
+				   for i, best in enumerate(bests))]
+
+def elf_group(path, fp):
+	# the partition of a native library: its ABI directory (lib/<abi>/,
+	# None elsewhere), ELF machine and class
+	parts = path.split('/')
+	abi = parts[1] if len(parts) == 3 and parts[0] == 'lib' else None
+	return abi, fp.machine, fp.bits
+
+def measure_diff(src, dst_data):
+	# src is the old data or a bsdiff4.SourceIndex over it
+	return len(bsdiff4.diff(src, dst_data, g_codec))
+
+def sketch(data):
+	'''
+	Bottom-k MinHash sketch of data (bytes or any buffer). The chunks are
+	cut by content with a rolling hash (bsdiff4.core.sketch()), so an
+	edit or insertion only disturbs the chunks around it, in text as in
+	binary data, and the SKETCH_SIZE smallest chunk hashes are kept.
+	'''
+	return bsdiff4.core.sketch(data, SKETCH_SIZE, SKETCH_CHUNK_BITS,
+							   SKETCH_MIN_CHUNK, SKETCH_MAX_CHUNK)
+
+def sketch_similarity(a, b):
+	# estimated Jaccard similarity of the data behind sketches a and b
+	union = heapq.nsmallest(SKETCH_SIZE, set(a) | set(b))
+	if not union:
+		return 0.0
+	a, b = set(a), set(b)
+	shared = [h for h in union if h in a and h in b]
+	return float(len(shared)) / len(union)
+
+class Entry(object):
+	'''
+	One manifest record, taken from the zip central directory.
+
+	'content' is the (CRC32, size) pair which we use as the content hash
+	of the entry: two entries with the same content are treated as
+	identical without decompressing either of them.
+	'''
+	__slots__ = ('path', 'size', 'compress_type', 'compress_size', 'ext',
+				 'content')
+
+	def __init__(self, info):
+		self.path = info.filename
+		self.size = info.file_size
+		self.compress_type = info.compress_type
+		self.compress_size = info.compress_size
+		self.ext = os.path.splitext(info.filename)[1]
+		self.content = (info.CRC, info.file_size)
+
+class Manifest(object):
+	'''
+	The entries of one APK, indexed by path and by content hash.
+	Iterating a manifest gives the paths in archive order. Directory
+	entries are skipped.
+
+	'sketches', 'fingerprints' (elfinfo.ElfInfo, None for an entry
+	which is not ELF), 'hashes' (sha256) and 'deflate_params' are filled
+	in as entries get sketched, hashed or checked for exact
+	recompression, so a target APK diffed against several bases only
+	reads its entries once for each.
+	'''
+
+	def __init__(self, zipf):
+		self.zipf = zipf
+		self.entries = collections.OrderedDict()
+		self.by_content = {}
+		self.sketches = {}
+		self.fingerprints = {}
+		self.hashes = {}
+		self.deflate_params = {}
+		self.split = None
+		for info in zipf.infolist():
+			if info.filename.endswith('/'):
+				continue
+			entry = Entry(info)
+			self.entries[entry.path] = entry
+			self.by_content.setdefault(entry.content, []).append(entry.path)
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __iter__(self):
+		return iter(self.entries)
+
+	def __contains__(self, path):
+		return path in self.entries
+
+	def __getitem__(self, path):
+		return self.entries[path]
+
+	def with_content(self, content):
+		# paths of all entries with the given content hash
+		return self.by_content.get(content, [])
+
+	def layout(self):
+		# apkzip.split_layout() of the archive, worked out once
+		if self.split is None:
+			self.split = apkzip.split_layout(self.zipf)
+		return self.split
+
+	def digest(self):
+		# sha256 of the whole archive
+		return patchcache.content_hash(self.zipf.map)
+
+	def duplicates(self):
+		# lists of paths sharing the same content (in archive order), for
+		# every content which is stored more than once
+		return [paths for paths in self.by_content.values() if len(paths) > 1]
 
 if __name__ == '__main__':
 	main()
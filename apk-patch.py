@@ -0,0 +1,256 @@
+#!/usr/bin/python
+
+import sys, os, hashlib, zipfile, bsdiff4, apkzip
+from optparse import OptionParser
+
+
+'''
+ Apply a patch made by apk-diff.py to an APK
+
+	 A.apk + patch = B.apk
+
+ This is the reference implementation of what the on-device patcher
+ (patcher/) has to do. The new APK is written in one pass over the old
+ one, one entry at a time:
+
+	- entries listed as removed (-) are dropped
+	- entries patched under the same name (c) are rebuilt with bsdiff4
+	  and put where they were in the old APK, as is every other record
+	  which replaces an old entry of its name
+	- every other old entry is copied over as it is, without being
+	  decompressed
+	- added (+), renamed (C), copied (=) entries and duplicates of added
+	  ones (&) follow, in TOC order
+
+ Patched, renamed and copied entries keep the compression method of the
+ old entry they come from (copies are not even decompressed), added
+ entries and their duplicates are deflated, unless they replace an old
+ entry, whose compression method they keep.
+
+ An exact patch (apk-diff.py --exact, it has a LAYOUT.txt) rebuilds the
+ new APK byte for byte instead, so that its signature still holds: the
+ zip layout (headers, signing block, central directory) comes from the
+ layout patch, and every entry is copied, re-deflated with the zlib
+ parameters recorded for it or taken compressed from the patch, as
+ LAYOUT.txt says. Re-deflating only gives the same bytes with the zlib
+ the diff was made with, which is checked against the sha256 of the new
+ APK at the end.
+'''
+
+def main():
+	p = OptionParser(
+		usage="usage: %prog [options] <APK-from> <APK-to> <patch.zip>",
+		description="rebuild APK-to from APK-from and a patch.zip "
+					"written by apk-diff.py")
+
+	p.add_option('-j', '--jobs', type='int', default=1,
+		help="number of threads applying the bsdiff patches; with more than "
+			 "one, all the patched entries are rebuilt (and held in memory) "
+			 "before the new APK is written (default 1)")
+
+	opts, args = p.parse_args()
+
+	if len(args) != 3:
+		p.error('requires 3 arguments, try -h')
+
+	apply_patch(args[0], args[1], args[2], opts.jobs)
+
+
+def read_toc(patch_zip):
+	'''
+	Parse TOC.txt into (removed names, [(op, id, src, dst)]) where op
+	is one of '+', 'c', 'C', '=' and '&'; src is None for '+' and '&'
+	records, id for '=' records.
+	'''
+	removed = set()
+	records = []
+	for line in patch_zip.read('TOC.txt').decode('utf-8').splitlines():
+		if not line or line.startswith('sha1 '):
+			continue
+		op, rest = line[0], line[1:]
+		if op == '-':
+			removed.add(rest)
+		elif op == '+':
+			fileid, dst = rest.split('|', 1)
+			records.append((op, fileid, None, dst))
+		elif op == 'c':
+			fileid, name = rest.split('|', 1)
+			records.append((op, fileid, name, name))
+		elif op == 'C':
+			fileid, src, dst = rest.split('|', 2)
+			records.append((op, fileid, src, dst))
+		elif op == '=':
+			src, dst = rest.split('|', 1)
+			records.append((op, None, src, dst))
+		elif op == '&':
+			fileid, dst = rest.split('|', 1)
+			records.append((op, fileid, None, dst))
+		else:
+			raise ValueError('unknown TOC record: %r' % line)
+	return removed, records
+
+
+def read_layout(patch_zip):
+	'''
+	Parse LAYOUT.txt into (sha256 of the new APK, [(offset, how, name)])
+	where how is the list of words of the record: ['copy'], ['stored'],
+	['deflate', level, strategy, mem_level] or ['raw', id].
+	'''
+	digest = None
+	cuts = []
+	for line in patch_zip.read('LAYOUT.txt').decode('utf-8').splitlines():
+		if not line:
+			continue
+		if line.startswith('sha256 '):
+			digest = line.split(' ', 1)[1]
+			continue
+		offset, how, name = line.split('|', 2)
+		how = how.split(' ')
+		if how[0] not in ('copy', 'stored', 'deflate', 'raw'):
+			raise ValueError('unknown LAYOUT record: %r' % line)
+		cuts.append((int(offset), how, name))
+	return digest, cuts
+
+
+def apply_patch(a_apk, b_apk, patch_file, jobs=1):
+	a_zip = apkzip.MappedZipReader(a_apk)
+	patch_zip = zipfile.ZipFile(patch_file, 'r')
+	if 'LAYOUT.txt' in patch_zip.namelist():
+		try:
+			apply_exact(a_zip, patch_zip, b_apk, jobs)
+		finally:
+			patch_zip.close()
+			a_zip.close()
+		return
+	out = apkzip.ZipWriter(b_apk)
+
+	removed, records = read_toc(patch_zip)
+	# the records which rebuild an entry of the old APK in its place
+	in_place = dict((rec[3], rec) for rec in records if rec[3] in a_zip.by_name)
+	if jobs > 1:
+		patched = patch_entries(a_zip, patch_zip, records, jobs)
+	else:
+		patched = {}
+
+	for info in a_zip.infolist():
+		name = info.filename
+		if name in removed:
+			continue
+		if name in in_place:
+			write_record(out, a_zip, patch_zip, in_place[name], patched)
+		else:
+			out.write_raw(info, a_zip.read_raw(info))
+
+	for rec in records:
+		if rec[3] not in in_place:
+			write_record(out, a_zip, patch_zip, rec, patched)
+
+	out.close()
+	patch_zip.close()
+	a_zip.close()
+
+
+def apply_exact(a_zip, patch_zip, b_apk, jobs=1):
+	'''
+	Write b_apk from an exact patch: the new layout with the stored bytes
+	of each entry put back at its offset, in file order.
+	'''
+	removed, records = read_toc(patch_zip)
+	by_dst = dict((rec[3], rec) for rec in records)
+	digest, cuts = read_layout(patch_zip)
+	layout = bsdiff4.patch(apkzip.split_layout(a_zip)[0], patch_zip.read('layout'))
+	if jobs > 1:
+		patched = patch_entries(a_zip, patch_zip, records, jobs)
+	else:
+		patched = {}
+
+	h = hashlib.sha256()
+	out = open(b_apk, 'wb')
+	try:
+		pos = 0
+		for offset, how, name in cuts:
+			for data in layout[pos:offset], stored_bytes(a_zip, patch_zip, how, name,
+														 by_dst.get(name), patched):
+				h.update(data)
+				out.write(data)
+			pos = offset
+		h.update(layout[pos:])
+		out.write(layout[pos:])
+	finally:
+		out.close()
+	if digest is not None and h.hexdigest() != digest:
+		raise ValueError('%s does not match the patch (was the zlib the same?)' % b_apk)
+
+
+def stored_bytes(a_zip, patch_zip, how, name, rec, patched):
+	# the stored bytes of the entry name, as LAYOUT.txt says (how); rec is
+	# its TOC record or None
+	if how[0] == 'copy':
+		if rec is not None and rec[0] == '=':
+			name = rec[2]
+		return a_zip.read_raw(a_zip.getinfo(name))
+	if how[0] == 'raw':
+		return patch_zip.read('f' + how[1])
+	if rec is None:
+		data = a_zip.read(name)
+	elif rec[0] == '=':
+		data = a_zip.read(rec[2])
+	elif rec[0] in ('+', '&'):
+		data = patch_zip.read('f' + rec[1])
+	elif rec[1] in patched:
+		data = patched.pop(rec[1])
+	else:
+		data = bsdiff4.patch(a_zip.read(rec[2]), patch_zip.read('f' + rec[1]))
+	if how[0] == 'stored':
+		return data
+	level, strategy, mem_level = [int(x) for x in how[1:]]
+	return apkzip.deflate(data, level, strategy, mem_level)
+
+
+def patch_entries(a_zip, patch_zip, records, jobs):
+	'''
+	The new data of every patched and renamed entry, by file id, rebuilt
+	on jobs threads by bsdiff4.patch_many (which runs without the GIL).
+	'''
+	recs = [rec for rec in records if rec[0] in ('c', 'C')]
+	srcs = [a_zip.read(rec[2]) for rec in recs]
+	patches = [patch_zip.read('f' + rec[1]) for rec in recs]
+	datas = bsdiff4.patch_many(srcs, patches, jobs)
+	return dict((rec[1], data) for rec, data in zip(recs, datas))
+
+
+def write_record(out, a_zip, patch_zip, rec, patched):
+	op, fileid, src, dst = rec
+	if op in ('c', 'C'):
+		write_patched(out, a_zip, patch_zip, rec, patched)
+	elif op == '=':
+		write_copy(out, a_zip, src, dst)
+	elif dst in a_zip.by_name:
+		old = a_zip.getinfo(dst)
+		out.write(dst, patch_zip.read('f' + fileid), old.compress_type, old.date_time)
+	else:
+		out.write(dst, patch_zip.read('f' + fileid))
+
+
+def write_patched(out, a_zip, patch_zip, rec, patched):
+	op, fileid, src, dst = rec
+	src_info = a_zip.getinfo(src)
+	if fileid in patched:
+		data = patched.pop(fileid)
+	else:
+		data = bsdiff4.patch(a_zip.read(src), patch_zip.read('f' + fileid))
+	out.write(dst, data, src_info.compress_type, src_info.date_time)
+
+
+def write_copy(out, a_zip, src, dst):
+	# the old entry src under the name dst, its stored bytes as they are
+	src_info = a_zip.getinfo(src)
+	info = zipfile.ZipInfo(dst, src_info.date_time)
+	for attr in ('compress_type', 'flag_bits', 'CRC', 'compress_size',
+				 'file_size', 'external_attr'):
+		setattr(info, attr, getattr(src_info, attr))
+	out.write_raw(info, a_zip.read_raw(src_info))
+
+
+if __name__ == '__main__':
+	main()
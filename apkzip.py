@@ -0,0 +1,369 @@
+'''
+ Raw access to the entries of a zip (APK) file.
+
+ zipfile only hands out decompressed data and always compresses what it
+ writes. To rebuild an APK from an old one we want to copy the entries
+ that did not change as they are, compressed bytes and all, so this
+ module reads the raw data of an entry and has a small writer which
+ takes raw data as well as plain data.
+
+ The reader maps the whole archive and hands out views of it rather than
+ copies: APKs keep their native libraries and resources.arsc STORED, so
+ the largest entries reach bsdiff4 (which takes any buffer) without being
+ copied at all.
+
+ No zip64 and no encryption, neither of which is used in APKs.
+'''
+
+import sys, mmap, struct, zipfile, zlib
+
+
+LOCAL_HEADER = struct.Struct('<4s5H3I2H')
+LOCAL_MAGIC = b'PK\x03\x04'
+CENTRAL_HEADER = struct.Struct('<4s6H3I5H2I')
+CENTRAL_MAGIC = b'PK\x01\x02'
+END_RECORD = struct.Struct('<4s4H2IH')
+END_MAGIC = b'PK\x05\x06'
+
+# flag bit telling that sizes and CRC follow the data, and the one for
+# utf-8 names
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+# the end record is followed by a comment of up to this many bytes
+MAX_COMMENT = 0xffff
+
+# size of the pieces iter_read() yields
+READ_CHUNK_SIZE = 1 << 20
+
+
+class MappedZipReader(object):
+	'''
+	Reads a zip file through an mmap of all of it. The central directory
+	is parsed once, into zipfile.ZipInfo objects, and entries are sliced
+	out of the map:
+
+		- read_raw() returns the stored (compressed) bytes of an entry
+		- read() returns the data of an entry: the stored bytes for a
+		  STORED entry, inflated bytes for a DEFLATED one
+		- iter_read() returns the data a piece at a time, so a DEFLATED
+		  entry is never inflated all at once
+
+	Stored bytes come as a memoryview (a buffer on Python 2) of the map,
+	nothing is copied. Unlike zipfile, the CRC of STORED entries is not
+	checked, as that would mean reading all of them.
+
+	Views must be dropped before close(); a map which still has views is
+	unmapped once they are gone.
+	'''
+
+	def __init__(self, path):
+		self.filename = path
+		self.fp = open(path, 'rb')
+		try:
+			self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+			self.infos = read_central_directory(self.map)
+		except (ValueError, zipfile.BadZipfile):
+			# mmap raises ValueError for an empty file
+			self.close()
+			raise zipfile.BadZipfile('not a zip file: %s' % path)
+		self.by_name = dict((info.filename, info) for info in self.infos)
+
+	def infolist(self):
+		return self.infos
+
+	def getinfo(self, name):
+		try:
+			return self.by_name[name]
+		except KeyError:
+			raise KeyError('there is no item named %r in the archive' % name)
+
+	def data_offset(self, info):
+		# the local header may have a different extra field than the
+		# central directory, so it has to be read
+		if info.header_offset + LOCAL_HEADER.size > len(self.map):
+			raise zipfile.BadZipfile('bad local header for %s' % info.filename)
+		header = LOCAL_HEADER.unpack_from(self.map, info.header_offset)
+		if header[0] != LOCAL_MAGIC:
+			raise zipfile.BadZipfile('bad local header for %s' % info.filename)
+		return info.header_offset + LOCAL_HEADER.size + header[9] + header[10]
+
+	def view(self, start, length):
+		# map[start:start + length], without copying it
+		if start + length > len(self.map):
+			raise zipfile.BadZipfile('truncated zip file')
+		if sys.version_info[0] < 3:
+			return buffer(self.map, start, length)
+		return memoryview(self.map)[start:start + length]
+
+	def read_raw(self, info):
+		return self.view(self.data_offset(info), info.compress_size)
+
+	def read(self, name):
+		'''
+		The data of an entry (given by name or ZipInfo): a view of the
+		map for a STORED entry, bytes for a DEFLATED one.
+		'''
+		info = self.info(name)
+		if info.compress_type == zipfile.ZIP_STORED:
+			return self.read_raw(info)
+		return b''.join(self.iter_read(info))
+
+	def iter_read(self, name, size=READ_CHUNK_SIZE):
+		'''
+		Yield the data of an entry in pieces of about size bytes, views
+		of the map for a STORED entry; a DEFLATED one is inflated as the
+		pieces are asked for, and its CRC checked at the end.
+		'''
+		info = self.info(name)
+		raw = self.read_raw(info)
+		if info.compress_type == zipfile.ZIP_STORED:
+			for i in range(0, len(raw), size):
+				yield raw[i:i + size]
+			return
+		if info.compress_type != zipfile.ZIP_DEFLATED:
+			raise NotImplementedError('compression method %d' % info.compress_type)
+		d = zlib.decompressobj(-15)
+		crc = 0
+		n = 0
+		for i in range(0, len(raw), size):
+			data = raw[i:i + size]
+			while data:
+				out = d.decompress(data, size)
+				data = d.unconsumed_tail
+				if out:
+					crc = zlib.crc32(out, crc)
+					n += len(out)
+					yield out
+		out = d.flush()
+		if out:
+			crc = zlib.crc32(out, crc)
+			n += len(out)
+			yield out
+		if n != info.file_size or crc & 0xffffffff != info.CRC:
+			raise zipfile.BadZipfile('bad CRC-32 for file %r' % info.filename)
+
+	def info(self, name):
+		if isinstance(name, zipfile.ZipInfo):
+			return name
+		return self.getinfo(name)
+
+	def close(self):
+		if getattr(self, 'map', None) is not None:
+			try:
+				self.map.close()
+			except BufferError:
+				pass # views are alive, it goes when they do
+			self.map = None
+		self.fp.close()
+
+
+def read_central_directory(buf):
+	'''
+	The entries of the zip file in buf (an mmap or bytes) as ZipInfo
+	objects, in central directory order.
+	'''
+	end = buf.rfind(END_MAGIC, max(0, len(buf) - END_RECORD.size - MAX_COMMENT))
+	if end < 0 or end + END_RECORD.size > len(buf):
+		raise zipfile.BadZipfile('end of central directory not found')
+	record = END_RECORD.unpack_from(buf, end)
+	count, offset = record[4], record[6]
+	if count == 0xffff or offset == 0xffffffff:
+		raise zipfile.BadZipfile('zip64 is not supported')
+	infos = []
+	pos = offset
+	for i in range(count):
+		if pos + CENTRAL_HEADER.size > end:
+			raise zipfile.BadZipfile('truncated central directory')
+		header = CENTRAL_HEADER.unpack_from(buf, pos)
+		if header[0] != CENTRAL_MAGIC:
+			raise zipfile.BadZipfile('bad central directory entry')
+		(magic, create_version, extract_version, flags, method, dos_time,
+		 dos_date, crc, compress_size, file_size, name_len, extra_len,
+		 comment_len, disk, internal_attr, external_attr,
+		 header_offset) = header
+		pos += CENTRAL_HEADER.size
+		name = buf[pos:pos + name_len]
+		pos += name_len
+		extra = buf[pos:pos + extra_len]
+		pos += extra_len + comment_len
+		name = name.decode('utf-8' if flags & FLAG_UTF8 else 'cp437')
+		date_time = ((dos_date >> 9) + 1980, (dos_date >> 5) & 0xf,
+					 dos_date & 0x1f, dos_time >> 11, (dos_time >> 5) & 0x3f,
+					 (dos_time & 0x1f) * 2)
+		info = zipfile.ZipInfo(name, date_time)
+		info.create_version = create_version & 0xff
+		info.create_system = create_version >> 8
+		info.extract_version = extract_version
+		info.flag_bits = flags
+		info.compress_type = method
+		info.CRC = crc
+		info.compress_size = compress_size
+		info.file_size = file_size
+		info.extra = extra
+		info.internal_attr = internal_attr
+		info.external_attr = external_attr
+		info.header_offset = header_offset
+		infos.append(info)
+	return infos
+
+
+def compress(data, compress_type, level=9):
+	# raw deflate, as stored in a zip entry
+	if compress_type == zipfile.ZIP_STORED:
+		return data
+	if compress_type != zipfile.ZIP_DEFLATED:
+		raise NotImplementedError('compression method %d' % compress_type)
+	return deflate(data, level)
+
+
+'''
+ Exact recompression
+
+ A patcher which rebuilds an entry from its data has to deflate it again,
+ and the APK signature (v2/v3) covers the compressed bytes. zlib is
+ deterministic: the same data deflated by the same zlib with the same
+ level, strategy and memory level gives the same bytes. So the diff side
+ finds the parameters which reproduce each entry (find_deflate_params)
+ and the patcher deflates with those, as archive-patcher does. Entries
+ written by another deflater (7-zip, zopfli, ...) match no parameters and
+ have to be shipped compressed.
+
+ The rest of the file, local headers, data descriptors, padding, the
+ signing block, the central directory, is its layout (split_layout):
+ the bytes of the file with the entry data cut out, and where it was.
+'''
+
+# (level, strategy, memory level) in the order they are tried, the most
+# common first: zipfile and java.util.zip use level 6, aapt and zipalign
+# level 9, all with the default strategy and memory level
+DEFLATE_PARAMS = [(level, strategy, mem_level)
+				  for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED,
+								   zlib.Z_HUFFMAN_ONLY)
+				  for mem_level in (8, 9)
+				  for level in (6, 9, 1, 2, 3, 4, 5, 7, 8)]
+
+# the data is fed to the trial deflaters in pieces of this size, so a
+# wrong guess is given up after the first mismatching block
+DEFLATE_TRIAL_CHUNK = 1 << 16
+
+
+def deflate(data, level=9, strategy=zlib.Z_DEFAULT_STRATEGY, mem_level=8):
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -15, mem_level, strategy)
+	return compressor.compress(data) + compressor.flush()
+
+
+def find_deflate_params(data, raw):
+	'''
+	The (level, strategy, mem_level) for which deflate() turns data into
+	the deflate stream raw exactly, or None.
+	'''
+	for params in DEFLATE_PARAMS:
+		if deflates_to(data, raw, *params):
+			return params
+	return None
+
+
+def deflates_to(data, raw, level, strategy, mem_level):
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -15, mem_level, strategy)
+	pos = 0
+	for i in range(0, len(data), DEFLATE_TRIAL_CHUNK):
+		out = compressor.compress(data[i:i + DEFLATE_TRIAL_CHUNK])
+		if out:
+			if bytes(raw[pos:pos + len(out)]) != out:
+				return False
+			pos += len(out)
+	out = compressor.flush()
+	return pos + len(out) == len(raw) and bytes(raw[pos:]) == out
+
+
+def split_layout(reader):
+	'''
+	The layout of the zip file of reader (a MappedZipReader): the bytes
+	of the file with the stored data of every entry cut out, and the
+	cuts as (offset in the layout, ZipInfo) in file order. Putting the
+	stored bytes of each entry back at its cut gives the file again.
+	'''
+	entries = sorted((reader.data_offset(info), info) for info in reader.infolist())
+	pieces = []
+	cuts = []
+	pos = 0
+	size = 0
+	for offset, info in entries:
+		if offset < pos or offset + info.compress_size > len(reader.map):
+			raise zipfile.BadZipfile('overlapping or truncated entry %s' % info.filename)
+		pieces.append(reader.map[pos:offset])
+		size += offset - pos
+		cuts.append((size, info))
+		pos = offset + info.compress_size
+	pieces.append(reader.map[pos:])
+	return b''.join(pieces), cuts
+
+
+class ZipWriter(object):
+	'''
+	Writes a zip file entry by entry, either from plain data (write) or
+	from the raw bytes of an entry of another zip (write_raw). STORED
+	entries are padded to start on an 'align' byte boundary, as zipalign
+	does.
+	'''
+
+	def __init__(self, path, align=4):
+		self.fp = open(path, 'wb')
+		self.align = align
+		self.entries = []
+
+	def write(self, name, data, compress_type=zipfile.ZIP_DEFLATED,
+			  date_time=(1980, 1, 1, 0, 0, 0), align=None):
+		info = zipfile.ZipInfo(name, date_time)
+		info.compress_type = compress_type
+		info.file_size = len(data)
+		info.CRC = zlib.crc32(data) & 0xffffffff
+		raw = compress(data, compress_type)
+		info.compress_size = len(raw)
+		self.write_raw(info, raw, align)
+
+	def write_raw(self, info, raw, align=None):
+		'''
+		Add an entry described by the ZipInfo 'info' (CRC and sizes
+		included) whose stored bytes are 'raw'.
+		'''
+		name = info.filename.encode('utf-8')
+		flags = info.flag_bits & ~FLAG_DATA_DESCRIPTOR
+		if name != info.filename.encode('ascii', 'replace'):
+			flags |= FLAG_UTF8
+		dos_date = ((info.date_time[0] - 1980) << 9 | info.date_time[1] << 5 |
+					info.date_time[2])
+		dos_time = (info.date_time[3] << 11 | info.date_time[4] << 5 |
+					info.date_time[5] // 2)
+
+		offset = self.fp.tell()
+		extra = b''
+		align = align or self.align
+		if info.compress_type == zipfile.ZIP_STORED and align > 1:
+			pad = -(offset + LOCAL_HEADER.size + len(name)) % align
+			extra = b'\0' * pad
+
+		self.fp.write(LOCAL_HEADER.pack(LOCAL_MAGIC, 20, flags,
+										info.compress_type, dos_time, dos_date,
+										info.CRC, info.compress_size,
+										info.file_size, len(name), len(extra)))
+		self.fp.write(name)
+		self.fp.write(extra)
+		self.fp.write(raw)
+		self.entries.append((info, name, flags, dos_time, dos_date, offset))
+
+	def close(self):
+		start = self.fp.tell()
+		for info, name, flags, dos_time, dos_date, offset in self.entries:
+			self.fp.write(CENTRAL_HEADER.pack(CENTRAL_MAGIC, 20, 20, flags,
+											  info.compress_type, dos_time,
+											  dos_date, info.CRC,
+											  info.compress_size,
+											  info.file_size, len(name), 0, 0,
+											  0, 0, info.external_attr, offset))
+			self.fp.write(name)
+		end = self.fp.tell()
+		self.fp.write(END_RECORD.pack(END_MAGIC, 0, 0, len(self.entries),
+									  len(self.entries), end - start, start, 0))
+		self.fp.close()
@@ -1,64 +1,661 @@
+import os
 import bz2
 import sys
+import mmap
+import zlib
+import shutil
+import struct
+import tempfile
+from array import array
+try:
+    import lzma
+except ImportError: # Python 2
+    lzma = None
 
 is_py3k = bool(sys.version_info[0] == 3)
 
 if is_py3k:
     from io import BytesIO as StringIO
     MAGIC = bytes('BSDIFF40'.encode('latin1'))
+    MAGIC_CODECS = bytes('BSDIFFC1'.encode('latin1'))
+    MAGIC_INDEX = bytes('BSDIDX01'.encode('latin1'))
+    MAGIC_WINDOWS = bytes('BSDIFFW1'.encode('latin1'))
 else:
     from cStringIO import StringIO
     if sys.version_info[:2] >= (2, 6):
         MAGIC = bytes('BSDIFF40')
+        MAGIC_CODECS = bytes('BSDIFFC1')
+        MAGIC_INDEX = bytes('BSDIDX01')
+        MAGIC_WINDOWS = bytes('BSDIFFW1')
     else: # 2.5
         MAGIC = 'BSDIFF40'
+        MAGIC_CODECS = 'BSDIFFC1'
+        MAGIC_INDEX = 'BSDIDX01'
+        MAGIC_WINDOWS = 'BSDIFFW1'
 
 import bsdiff4.core as core
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 
-def write_patch(fo, len_dst, tcontrol, bdiff, bextra):
+# size of the pieces fed to the compressors by write_patch, and of the
+# pieces decompressed and written at a time by file_patch
+CHUNK_SIZE = 1 << 20
+
+# size of the reads from a patch file by file_patch
+PATCH_READ_SIZE = 1 << 16
+
+# an index file is this header (magic, source length, item size, byte
+# order and padding) followed by the suffix array, 8-byte aligned
+INDEX_HEADER_SIZE = 32
+BYTE_ORDER = sys.byteorder[:1].encode('ascii')
+
+# a windowed patch cuts the new data in windows of WINDOW_SIZE bytes by
+# default, and matches each one against WINDOW_SOURCE_FACTOR times as many
+# bytes of the source
+WINDOW_SIZE = 1 << 24
+WINDOW_SOURCE_FACTOR = 2
+
+# array type of the control triples, native 8-byte integers: 'q', or on
+# Python 2 (which has no 'q') 'l' where it is 8 bytes, as on 64-bit Unix;
+# None where there is no such type, and Control keeps a list of ints
+CONTROL_TYPECODE = None
+for _typecode in 'q', 'l':
+    try:
+        if array(_typecode).itemsize == 8:
+            CONTROL_TYPECODE = _typecode
+            break
+    except ValueError:
+        pass
+
+
+class StoredCompressor(object):
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return MAGIC[:0]
+
+
+class StoredDecompressor(object):
+    needs_input = True
+    eof = False
+
+    def decompress(self, data, max_length=-1):
+        return data
+
+
+class ZlibDecompressor(object):
+    """zlib.decompressobj with the needs_input/max_length interface of
+    bz2.BZ2Decompressor
+    """
+    def __init__(self):
+        self.d = zlib.decompressobj()
+        self.needs_input = True
+        self.eof = False
+
+    def decompress(self, data, max_length=-1):
+        data = self.d.unconsumed_tail + data
+        res = self.d.decompress(data, max(max_length, 0))
+        self.needs_input = not self.d.unconsumed_tail
+        self.eof = getattr(self.d, 'eof', False)
+        return res
+
+
+# The block codecs, by name: (id in the patch header, compressor factory,
+# decompressor factory, rough decoding cost in nanoseconds per byte).
+# Patches which use bz2 for all blocks are written in the classic
+# BSDIFF40 format, any other choice gives a BSDIFFC1 patch, whose header
+# records the codec of each block.
+CODECS = {
+    'stored': (0, StoredCompressor, StoredDecompressor, 0),
+    'bz2': (1, bz2.BZ2Compressor, bz2.BZ2Decompressor, 25),
+    'zlib': (2, lambda: zlib.compressobj(9), ZlibDecompressor, 3),
+}
+if lzma:
+    CODECS['lzma'] = (3, lambda: lzma.LZMACompressor(preset=9),
+                      lzma.LZMADecompressor, 10)
+
+CODEC_NAMES = dict((v[0], k) for k, v in CODECS.items())
+
+# For codec='auto': how many bytes per second the patch is expected to be
+# downloaded at.  Each block uses the codec with the lowest download plus
+# decoding time.
+AUTO_BANDWIDTH = 1 << 20
+
+
+def new_decompressor(codec_id):
+    try:
+        return CODECS[CODEC_NAMES[codec_id]][2]()
+    except KeyError:
+        raise ValueError("unknown codec id in patch: %r" % codec_id)
+
+
+def decompress(codec_id, data):
+    return new_decompressor(codec_id).decompress(data)
+
+
+class Control(object):
+    """the control triples (x, y, z) of a patch, held in a flat array of
+    native 8-byte integers: 24 bytes per triple rather than a tuple and
+    three ints.  core.diff() returns this layout, core.patch() takes it,
+    and core.encode_control() and core.decode_control() convert it to and
+    from the control block of a patch in one pass.
+
+    It is a read-only sequence of tuples too, which are only created when
+    accessed, so code written for the former lists of tuples still works.
+    'data' may be bytes in the layout of the array, or a sequence of
+    tuples.  Without an 8-byte array type (see CONTROL_TYPECODE) 'array'
+    is a list of ints, which is packed for core by packed().
+    """
+    def __init__(self, data=None):
+        self.array = array(CONTROL_TYPECODE) if CONTROL_TYPECODE else []
+        if data is not None:
+            self.extend(data)
+
+    @classmethod
+    def decode(cls, block):
+        """return the Control of the (uncompressed) control block"""
+        return cls(core.decode_control(block))
+
+    def encode(self):
+        """return the control block of the patch, in the 8-byte format"""
+        return core.encode_control(self.packed())
+
+    def packed(self):
+        """return the triples in the layout core takes: the array, or the
+        list of ints packed into bytes
+        """
+        if isinstance(self.array, list):
+            return struct.pack('=%dq' % len(self.array), *self.array)
+        return self.array
+
+    def append(self, t):
+        self.array.extend(t)
+
+    def extend(self, data):
+        if isinstance(data, Control):
+            self.array.extend(data.array)
+        elif isinstance(data, bytes):
+            if isinstance(self.array, list):
+                self.array.extend(struct.unpack('=%dq' % (len(data) // 8),
+                                                data))
+            elif is_py3k:
+                self.array.frombytes(data)
+            else:
+                self.array.fromstring(data)
+        else:
+            for t in data:
+                self.array.extend(t)
+
+    def __len__(self):
+        return len(self.array) // 3
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("control index out of range")
+        return tuple(self.array[3 * i:3 * i + 3])
+
+    def __iter__(self):
+        a = self.array
+        for i in range(0, len(a), 3):
+            yield a[i], a[i + 1], a[i + 2]
+
+    def __eq__(self, other):
+        if isinstance(other, Control):
+            return self.array == other.array
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Control(%r)' % list(self)
+
+
+def control_array(tcontrol):
+    # what core.encode_control() and core.patch() take: the packed triples
+    # of a Control, anything else (e.g. a list of tuples) as it is
+    if isinstance(tcontrol, Control):
+        return tcontrol.packed()
+    return tcontrol
+
+
+def iter_chunks(data):
+    for i in range(0, len(data), CHUNK_SIZE):
+        yield data[i:i + CHUNK_SIZE]
+
+
+def compress_block(codec, chunks):
+    """compress the pieces in 'chunks' as one stream using the codec
+    called 'codec', and yield the output as it is produced
+    """
+    compressor = CODECS[codec][1]()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def choose_codec(chunks):
+    """compress the pieces in 'chunks' with every codec, and return the
+    name and output of the one with the lowest download plus decoding time
+    """
+    raw = MAGIC[:0].join(chunks)
+    best = None
+    for name in sorted(CODECS):
+        data = MAGIC[:0].join(compress_block(name, [raw]))
+        cost = (1e9 * len(data) / AUTO_BANDWIDTH +
+                CODECS[name][3] * len(raw))
+        if best is None or cost < best[0]:
+            best = cost, name, data
+    return best[1], [best[2]]
+
+
+def write_block(fo, codec, chunks):
+    """compress the pieces in 'chunks' as one stream, writing the output
+    to stream 'fo' as it is produced, and return (codec, length);
+    codec 'auto' is resolved to the one which was chosen
+    """
+    if codec == 'auto':
+        codec, output = choose_codec(chunks)
+    else:
+        output = compress_block(codec, chunks)
+    n = 0
+    for data in output:
+        fo.write(data)
+        n += len(data)
+    return codec, n
+
+
+def write_patch(fo, len_dst, tcontrol, bdiff, bextra, codec='bz2'):
     """write a BSDIFF4-format patch to stream 'fo'
+
+    'codec' is the name of the codec used to compress all three blocks
+    ('bz2', 'zlib', 'lzma' or 'stored'), a tuple of names for the control,
+    diff and extra block, or 'auto' to choose one for each block.  Only
+    the classic all-bz2 patch can be read by bsdiff4 1.1.4 and earlier.
+
+    The blocks are compressed incrementally and written straight to 'fo',
+    the length header is filled in afterwards by seeking back, so 'fo'
+    needs to be seekable.
     """
-    fo.write(MAGIC)
-    faux = StringIO()
-    # write control tuples as series of offts
-    for c in tcontrol:
-        for x in c:
-            faux.write(core.encode_int64(x))
-    # compress each block
-    bcontrol = bz2.compress(faux.getvalue())
-    bdiff = bz2.compress(bdiff)
-    bextra = bz2.compress(bextra)
-    for n in len(bcontrol), len(bdiff), len_dst:
+    if not isinstance(codec, tuple):
+        codec = 3 * (codec,)
+    for name in codec:
+        if name != 'auto' and name not in CODECS:
+            raise ValueError("unknown codec: %r" % name)
+    classic = codec == 3 * ('bz2',)
+
+    start = fo.tell()
+    fo.write(MAGIC if classic else MAGIC_CODECS)
+    # placeholder for the codec and length headers
+    if not classic:
+        fo.write(core.encode_int64(0))
+    fo.write(3 * core.encode_int64(0))
+    bcontrol = core.encode_control(control_array(tcontrol))
+    blocks = [write_block(fo, codec[0], iter_chunks(bcontrol)),
+              write_block(fo, codec[1], iter_chunks(bdiff)),
+              write_block(fo, codec[2], iter_chunks(bextra))]
+    end = fo.tell()
+    fo.seek(start + len(MAGIC))
+    if not classic:
+        ids = [CODECS[name][0] for name, n in blocks]
+        fo.write(bytes(bytearray(ids + [0] * 5)))
+    for n in blocks[0][1], blocks[1][1], len_dst:
         fo.write(core.encode_int64(n))
-    fo.write(bcontrol)
-    fo.write(bdiff)
-    fo.write(bextra)
+    fo.seek(end)
 
 
-def read_patch(fi, header_only=False):
-    """read a BSDIFF4-format patch from stream 'fi'
+def read_header(fi):
+    """read the header of a patch from stream 'fi' and return (header size,
+    codec ids of the control, diff and extra block, len_control, len_diff,
+    len_dst)
     """
     magic = fi.read(8)
-    assert magic[:7] == MAGIC[:7]
+    if magic == MAGIC_CODECS:
+        ids = list(bytearray(fi.read(8))[:3])
+        size = 40
+    else:
+        assert magic[:7] == MAGIC[:7]
+        ids = 3 * [CODECS['bz2'][0]]
+        size = 32
     # length headers
     len_control = core.decode_int64(fi.read(8))
     len_diff = core.decode_int64(fi.read(8))
     len_dst = core.decode_int64(fi.read(8))
+    return size, ids, len_control, len_diff, len_dst
+
+
+def read_patch(fi, header_only=False):
+    """read a BSDIFF4-format patch from stream 'fi'
+
+    A windowed patch is returned as the single patch it amounts to, see
+    read_windows().
+    """
+    if fi.read(8) == MAGIC_WINDOWS:
+        return read_windows(fi, header_only)
+    fi.seek(-8, os.SEEK_CUR)
+    size, ids, len_control, len_diff, len_dst = read_header(fi)
     # read the control header
-    bcontrol = bz2.decompress(fi.read(len_control))
-    tcontrol = [(core.decode_int64(bcontrol[i:i + 8]),
-                 core.decode_int64(bcontrol[i + 8:i + 16]),
-                 core.decode_int64(bcontrol[i + 16:i + 24]))
-                for i in range(0, len(bcontrol), 24)]
+    tcontrol = Control.decode(decompress(ids[0], fi.read(len_control)))
     if header_only:
         return len_control, len_diff, len_dst, tcontrol
     # read the diff and extra blocks
-    bdiff = bz2.decompress(fi.read(len_diff))
-    bextra = bz2.decompress(fi.read())
+    bdiff = decompress(ids[1], fi.read(len_diff))
+    bextra = decompress(ids[2], fi.read())
     return len_dst, tcontrol, bdiff, bextra
 
 
+class BlockReader(object):
+    """reads one compressed block of a patch file incrementally
+
+    The block starts at 'offset' in the seekable stream 'fi' and has
+    'length' compressed bytes (None for up to the end of the stream), it
+    was compressed with the codec 'codec_id'.
+    Several readers may share the same stream, each one seeks to its own
+    position before reading.  At most about CHUNK_SIZE decompressed bytes
+    are held at any time.
+    """
+    def __init__(self, fi, codec_id, offset, length=None):
+        self.fi = fi
+        self.pos = offset
+        self.end = None if length is None else offset + length
+        self.decompressor = new_decompressor(codec_id)
+        self.buf = MAGIC[:0]
+        self.bufpos = 0
+
+    def fill(self):
+        # decompress the next piece of the block into self.buf
+        d = self.decompressor
+        while not getattr(d, 'eof', False):
+            if getattr(d, 'needs_input', True):
+                n = PATCH_READ_SIZE
+                if self.end is not None:
+                    n = min(n, self.end - self.pos)
+                if n <= 0:
+                    return False
+                self.fi.seek(self.pos)
+                data = self.fi.read(n)
+                self.pos += len(data)
+                if not data:
+                    return False
+            else:
+                data = MAGIC[:0]
+            if hasattr(d, 'needs_input'):
+                # Python 3.5+, bound the size of the output as well
+                data = d.decompress(data, CHUNK_SIZE)
+            else:
+                data = d.decompress(data)
+            if data:
+                self.buf = data
+                self.bufpos = 0
+                return True
+        return False
+
+    def read(self, n):
+        """return the next n bytes of the block, fewer at its end"""
+        parts = []
+        while n > 0:
+            if self.bufpos == len(self.buf) and not self.fill():
+                break
+            part = self.buf[self.bufpos:self.bufpos + n]
+            self.bufpos += len(part)
+            n -= len(part)
+            parts.append(part)
+        return MAGIC[:0].join(parts)
+
+
+def iter_patch(fi):
+    """read a BSDIFF4-format patch from the seekable stream 'fi' and return
+    (len_dst, control tuples, diff reader, extra reader), where everything
+    but the length header is read and decompressed lazily
+    """
+    start = fi.tell()
+    size, ids, len_control, len_diff, len_dst = read_header(fi)
+    start += size
+    fcontrol = BlockReader(fi, ids[0], start, len_control)
+    fdiff = BlockReader(fi, ids[1], start + len_control, len_diff)
+    fextra = BlockReader(fi, ids[2], start + len_control + len_diff)
+
+    def tcontrol():
+        # decoded a few thousand triples at a time
+        while True:
+            c = fcontrol.read(24 * 4096)
+            if not c:
+                return
+            for t in Control.decode(c):
+                yield t
+
+    return len_dst, tcontrol(), fdiff, fextra
+
+
+def view(data, start, stop):
+    """data[start:stop], without copying it when data supports the buffer
+    interface (bytes, mmap, ...), which the functions of core all take
+    """
+    try:
+        if is_py3k:
+            return memoryview(data)[start:stop]
+        return buffer(data, start, max(stop - start, 0))
+    except TypeError:
+        return data[start:stop]
+
+
+def add_source(bdiff, src, oldpos):
+    """return bdiff with the bytes of src starting at oldpos added to it,
+    the bytes which fall outside of src are left as they are
+    """
+    lo = max(oldpos, 0)
+    hi = min(oldpos + len(bdiff), len(src))
+    if lo >= hi:
+        return bdiff
+    # let core.patch do the adding: the first tuple moves the old position
+    # back to oldpos (it may lie before the window), the second one adds
+    # the window to all of bdiff
+    return core.patch(view(src, lo, hi), len(bdiff),
+                      [(0, 0, oldpos - lo), (len(bdiff), 0, 0)],
+                      bdiff, MAGIC[:0])
+
+
+def iter_patched(src, len_dst, tcontrol, fdiff, fextra):
+    """apply the (lazily read) patch to 'src', which only needs to support
+    len() and slicing (e.g. an mmap), and yield the new data in pieces of
+    at most CHUNK_SIZE bytes
+    """
+    oldpos = newpos = 0
+    for x, y, z in tcontrol:
+        if x < 0 or y < 0 or newpos + x + y > len_dst:
+            raise ValueError("corrupt patch (overflow)")
+        for n, f in (x, fdiff), (y, fextra):
+            while n > 0:
+                data = f.read(min(n, CHUNK_SIZE))
+                if not data:
+                    raise ValueError("corrupt patch (overflow)")
+                if f is fdiff:
+                    data = add_source(data, src, oldpos)
+                    oldpos += len(data)
+                newpos += len(data)
+                n -= len(data)
+                yield data
+        oldpos += z
+
+    # confirm that a valid patch was applied
+    if newpos != len_dst or fdiff.read(1) or fextra.read(1):
+        raise ValueError("corrupt patch (underflow)")
+
+
+def source_region(len_src, len_dst, start, length, size):
+    """return (offset, length) of the part of the source which the window
+    dst[start:start + length] is diffed against: 'size' bytes around the
+    same relative position in the source
+    """
+    if len_src <= size:
+        return 0, len_src
+    center = (start + length // 2) * len_src // max(len_dst, 1)
+    return min(max(center - size // 2, 0), len_src - size), size
+
+
+class SourceRegion(object):
+    """src[offset:offset + length], for iter_patched(), without copying it"""
+    def __init__(self, src, offset, length):
+        if offset < 0 or length < 0 or offset + length > len(src):
+            raise ValueError("corrupt patch (source region)")
+        self.src = src
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, s):
+        start, stop = s.indices(self.length)[:2]
+        return view(self.src, self.offset + start, self.offset + stop)
+
+
+def write_windows(fo, src, dst, codec='bz2', window_size=WINDOW_SIZE, jobs=1):
+    """write a windowed patch from 'src' to 'dst' to stream 'fo'
+
+    dst is cut in windows of window_size bytes, and each one is diffed
+    against the part of src given by source_region(), on 'jobs' threads.
+    src and dst only need to support len() and slicing (e.g. an mmap), so
+    memory use is bounded by the windows being diffed.
+
+    The patch is the magic 'BSDIFFW1', len_dst, the number of windows and
+    window_size, followed for each window by src_offset, src_length,
+    dst_length and the length of the BSDIFF4-format patch from
+    src[src_offset:src_offset + src_length] to the window, which comes
+    next.  All numbers are in the 8-byte format of the patch headers.
+    """
+    len_src, len_dst = len(src), len(dst)
+    starts = range(0, len_dst, window_size)
+
+    def diff_window(start):
+        length = min(window_size, len_dst - start)
+        offset, src_length = source_region(len_src, len_dst, start, length,
+                                           WINDOW_SOURCE_FACTOR * window_size)
+        faux = StringIO()
+        write_diff(faux, view(src, offset, offset + src_length),
+                   view(dst, start, start + length), codec)
+        return offset, src_length, length, faux.getvalue()
+
+    fo.write(MAGIC_WINDOWS)
+    for n in len_dst, len(starts), window_size:
+        fo.write(core.encode_int64(n))
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+        windows = pool.imap(diff_window, starts)
+    else:
+        pool = None
+        windows = (diff_window(start) for start in starts)
+    try:
+        for offset, src_length, length, data in windows:
+            for n in offset, src_length, length, len(data):
+                fo.write(core.encode_int64(n))
+            fo.write(data)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def iter_windows(fi):
+    """read a windowed patch from stream 'fi', whose magic has been read
+    already, and yield (src_offset, src_length, dst_length, patch) for each
+    window; the first item yielded is len_dst
+    """
+    len_dst, count, window_size = [core.decode_int64(fi.read(8))
+                                   for i in range(3)]
+    yield len_dst
+    total = 0
+    for i in range(count):
+        header = fi.read(32)
+        if len(header) != 32:
+            raise ValueError("corrupt patch (truncated window)")
+        offset, src_length, length, len_patch = [
+            core.decode_int64(header[j:j + 8]) for j in range(0, 32, 8)]
+        data = fi.read(len_patch)
+        if len_patch < 0 or len(data) != len_patch:
+            raise ValueError("corrupt patch (truncated window)")
+        total += length
+        yield offset, src_length, length, data
+    if total != len_dst:
+        raise ValueError("corrupt patch (underflow)")
+
+
+def read_windows(fi, header_only=False):
+    """read a windowed patch from stream 'fi', whose magic has been read
+    already, as one BSDIFF4 patch: the control tuples of the windows follow
+    each other, with a (0, 0, z) tuple moving the old position to the
+    source region of each window.  Returns what read_patch() does; the
+    compressed lengths are the totals of those of the windows.
+    """
+    windows = iter_windows(fi)
+    len_dst = next(windows)
+    tcontrol, bdiff, bextra = Control(), [], []
+    len_control = len_diff = 0
+    oldpos = 0
+    for offset, src_length, length, data in windows:
+        res = read_patch(StringIO(data), header_only)
+        if header_only:
+            len_control += res[0]
+            len_diff += res[1]
+            window_control = res[3]
+        else:
+            window_control = res[1]
+            bdiff.append(res[2])
+            bextra.append(res[3])
+        tcontrol.append((0, 0, offset - oldpos))
+        tcontrol.extend(window_control)
+        a = window_control.array
+        oldpos = offset + sum(a[0::3]) + sum(a[2::3])
+    if header_only:
+        return len_control, len_diff, len_dst, tcontrol
+    return len_dst, tcontrol, MAGIC[:0].join(bdiff), MAGIC[:0].join(bextra)
+
+
+def iter_patched_windows(src, fi):
+    """apply the windowed patch in stream 'fi', whose magic has been read
+    already, to 'src', and yield the new data in bounded pieces
+    """
+    windows = iter_windows(fi)
+    next(windows)
+    for offset, src_length, length, data in windows:
+        region = SourceRegion(src, offset, src_length)
+        len_dst, tcontrol, fdiff, fextra = iter_patch(StringIO(data))
+        if len_dst != length:
+            raise ValueError("corrupt patch (window length)")
+        for piece in iter_patched(region, len_dst, tcontrol, fdiff, fextra):
+            yield piece
+
+
+def file_patch_stream(src_path, fo, patch_path):
+    """apply the patch file patch_path to the file src_path, writing the
+    result to stream 'fo' in bounded pieces
+    """
+    fi = open(patch_path, 'rb')
+    f = open(src_path, 'rb')
+    try:
+        src = map_file(f)
+        try:
+            if fi.read(8) == MAGIC_WINDOWS:
+                pieces = iter_patched_windows(src, fi)
+            else:
+                fi.seek(0)
+                pieces = iter_patched(src, *iter_patch(fi))
+            for data in pieces:
+                fo.write(data)
+        finally:
+            close_map(src)
+    finally:
+        f.close()
+        fi.close()
+
+
 def read_data(path):
     fi = open(path, 'rb')
     data = fi.read()
@@ -66,26 +663,141 @@ def read_data(path):
     return data
 
 
-def diff(src_bytes, dst_bytes):
-    """diff(src_bytes, dst_bytes) -> bytes
+SourceIndex = core.SourceIndex
+
+
+def write_diff(fo, src_bytes, dst_bytes, codec='bz2', window_size=None,
+               jobs=1):
+    """write_diff(fo, src_bytes, dst_bytes, codec='bz2', window_size=None,
+               jobs=1)
+
+    Write a BSDIFF4-format patch (from src_bytes to dst_bytes) to the
+    seekable stream fo.  src_bytes may also be a SourceIndex, in which
+    case its suffix array is reused instead of sorting the source again.
+    See write_patch() for the choices of codec.  With a window_size, a
+    windowed patch is written instead, see write_windows().
+    """
+    if window_size:
+        write_windows(fo, src_bytes, dst_bytes, codec, window_size, jobs)
+        return
+    if isinstance(src_bytes, SourceIndex):
+        res = src_bytes.diff(dst_bytes)
+    else:
+        res = core.diff(src_bytes, dst_bytes)
+    write_patch(fo, len(dst_bytes), res[0], res[1], res[2], codec)
+
+
+def write_index(fo, index):
+    """write_index(fo, index)
+
+    Write the suffix array of the SourceIndex 'index' to the stream fo, so
+    that read_index() can load it instead of sorting the source again.
+    The array is written in the native byte order and integer size.
+    """
+    array = index.suffix_array()
+    fo.write(MAGIC_INDEX)
+    fo.write(core.encode_int64(len(index)))
+    fo.write(core.encode_int64(len(array) // (len(index) + 1)))
+    fo.write(BYTE_ORDER + bytes(bytearray(7)))
+    fo.write(array)
+
+
+def read_index(src_bytes, path):
+    """read_index(src_bytes, path) -> SourceIndex
+
+    Return the SourceIndex of src_bytes whose suffix array was written to
+    the file 'path' by write_index().  The file is memory-mapped rather
+    than read, so processes using the same index share its pages.  Every
+    entry of the array is checked to be within src_bytes; a file which
+    belongs to a source of another length, or which is truncated or
+    corrupt, raises ValueError.
+    """
+    fi = open(path, 'rb')
+    try:
+        header = fi.read(INDEX_HEADER_SIZE)
+        if (len(header) != INDEX_HEADER_SIZE or
+                header[:8] != MAGIC_INDEX):
+            raise ValueError("index file magic not found")
+        len_src = core.decode_int64(header[8:16])
+        itemsize = core.decode_int64(header[16:24])
+        if header[24:25] != BYTE_ORDER:
+            raise ValueError("index file of another byte order")
+        if len_src != len(src_bytes):
+            raise ValueError("index file of another source")
+        if (os.fstat(fi.fileno()).st_size !=
+                INDEX_HEADER_SIZE + (len_src + 1) * itemsize):
+            raise ValueError("index file truncated")
+        m = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        fi.close()
+    if is_py3k:
+        array = memoryview(m)[INDEX_HEADER_SIZE:]
+    else:
+        array = buffer(m, INDEX_HEADER_SIZE)
+    return SourceIndex(src_bytes, array)
+
+
+def diff(src_bytes, dst_bytes, codec='bz2', window_size=None, jobs=1):
+    """diff(src_bytes, dst_bytes, codec='bz2', window_size=None, jobs=1)
+        -> bytes
 
     Return a BSDIFF4-format patch (from src_bytes to dst_bytes) as bytes.
+    src_bytes may also be a SourceIndex, see write_diff().
     """
     faux = StringIO()
-    write_patch(faux, len(dst_bytes), *core.diff(src_bytes, dst_bytes))
+    write_diff(faux, src_bytes, dst_bytes, codec, window_size, jobs)
     return faux.getvalue()
 
 
-def file_diff(src_path, dst_path, patch_path):
-    """file_diff(src_path, dst_path, patch_path)
+def map_file(f):
+    # an mmap of the open file f, or empty bytes as those cannot be mapped
+    if os.fstat(f.fileno()).st_size:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return MAGIC[:0]
+
+
+def close_map(m):
+    # close what map_file() returned, unless views of it are still alive
+    # (after an error), in which case it is closed once they are gone
+    if not isinstance(m, bytes):
+        try:
+            m.close()
+        except BufferError:
+            pass
+
+
+def file_diff(src_path, dst_path, patch_path, codec='bz2', window_size=None,
+              jobs=1):
+    """file_diff(src_path, dst_path, patch_path, codec='bz2',
+              window_size=None, jobs=1)
 
     Write a BSDIFF4-format patch (from the file src_path to the file dst_path)
-    to the file patch_path.
+    to the file patch_path.  See write_patch() for the choices of codec.
+    Both files are memory-mapped rather than read, so they are not copied
+    into memory.  With a window_size, a windowed patch is written on 'jobs'
+    threads, see write_windows().
     """
-    src = read_data(src_path)
-    dst = read_data(dst_path)
+    files = [open(src_path, 'rb'), open(dst_path, 'rb')]
+    maps = []
+    try:
+        maps = [map_file(f) for f in files]
+        if window_size:
+            fo = open(patch_path, 'wb')
+            try:
+                write_windows(fo, maps[0], maps[1], codec, window_size, jobs)
+            finally:
+                fo.close()
+            return
+        len_dst = len(maps[1])
+        tcontrol, bdiff, bextra = core.diff(maps[0], maps[1])
+    finally:
+        for m in maps:
+            close_map(m)
+        for f in files:
+            f.close()
+    # only the diff output is needed from here on
     fo = open(patch_path, 'wb')
-    write_patch(fo, len(dst), *core.diff(src, dst))
+    write_patch(fo, len_dst, tcontrol, bdiff, bextra, codec)
     fo.close()
 
 
@@ -94,28 +806,88 @@ def patch(src_bytes, patch_bytes):
 
     Apply the BSDIFF4-format patch_bytes to src_bytes and return the bytes.
     """
-    return core.patch(src_bytes, *read_patch(StringIO(patch_bytes)))
+    len_dst, tcontrol, bdiff, bextra = read_patch(StringIO(patch_bytes))
+    return core.patch(src_bytes, len_dst, control_array(tcontrol), bdiff,
+                      bextra)
+
+
+def run_jobs(func, args, jobs):
+    """return [func(*a) for a in args], computed on up to 'jobs' threads
+    (the number of CPUs by default); core.diff() and core.patch() release
+    the GIL, so the threads do run in parallel
+    """
+    args = list(args)
+    if jobs is None:
+        jobs = cpu_count()
+    jobs = min(jobs, len(args))
+    if jobs <= 1:
+        return [func(*a) for a in args]
+    pool = ThreadPool(jobs)
+    try:
+        return pool.map(lambda a: func(*a), args)
+    finally:
+        pool.terminate()
+
+
+def diff_many(srcs, dsts, codec='bz2', jobs=None):
+    """diff_many(srcs, dsts, codec='bz2', jobs=None) -> list of bytes
+
+    Return the list of BSDIFF4-format patches from each of the srcs to the
+    corresponding one of dsts, diffed on 'jobs' threads (the number of
+    CPUs by default).  The same SourceIndex may be given as several srcs.
+    """
+    srcs, dsts = list(srcs), list(dsts)
+    if len(srcs) != len(dsts):
+        raise ValueError("as many sources as destinations expected")
+    return run_jobs(lambda src, dst: diff(src, dst, codec),
+                    zip(srcs, dsts), jobs)
+
+
+def patch_many(srcs, patches, jobs=None):
+    """patch_many(srcs, patches, jobs=None) -> list of bytes
+
+    Apply each of the BSDIFF4-format patches to the corresponding one of
+    srcs and return the list of the new data, patched on 'jobs' threads
+    (the number of CPUs by default).
+    """
+    srcs, patches = list(srcs), list(patches)
+    if len(srcs) != len(patches):
+        raise ValueError("as many sources as patches expected")
+    return run_jobs(patch, zip(srcs, patches), jobs)
 
 
 def file_patch_inplace(path, patch_path):
     """file_patch_inplace(path, patch_path)
 
     Apply the BSDIFF4-format file patch_path to the file 'path' in place.
+    The result is written to a temporary file next to 'path', which then
+    replaces it.
     """
-    fi = open(patch_path, 'rb')
-    f = open(path, 'r+b')
-    data = f.read()
-    f.seek(0)
-    f.write(core.patch(data, *read_patch(fi)))
-    f.close()
-    fi.close()
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    fo = os.fdopen(fd, 'wb')
+    try:
+        file_patch_stream(path, fo, patch_path)
+        fo.close()
+        shutil.copymode(path, tmp_path)
+        if hasattr(os, 'replace'):
+            os.replace(tmp_path, path)
+        else:
+            if sys.platform == 'win32':
+                os.remove(path)
+            os.rename(tmp_path, path)
+    except:
+        fo.close()
+        os.remove(tmp_path)
+        raise
 
 
 def file_patch(src_path, dst_path, patch_path):
     """file_patch(src_path, dst_path, patch_path)
 
     Apply the BSDIFF4-format file patch_path to the file src_path and
-    write the result to the file dst_path.
+    write the result to the file dst_path.  The source is memory-mapped and
+    the patch is decompressed as it is applied, so memory use does not
+    grow with the size of the files.
     """
     from os.path import abspath
 
@@ -123,8 +895,8 @@ def file_patch(src_path, dst_path, patch_path):
         file_patch_inplace(src_path, patch_path)
         return
 
-    fi = open(patch_path, 'rb')
     fo = open(dst_path, 'wb')
-    fo.write(core.patch(read_data(src_path), *read_patch(fi)))
-    fo.close()
-    fi.close()
+    try:
+        file_patch_stream(src_path, fo, patch_path)
+    finally:
+        fo.close()
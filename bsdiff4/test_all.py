@@ -7,7 +7,8 @@ import tempfile
 
 import bsdiff4.core as core
 import bsdiff4.format as format
-from bsdiff4 import diff, patch, file_diff, file_patch, file_patch_inplace
+from bsdiff4 import (diff, patch, file_diff, file_patch, file_patch_inplace,
+                     diff_many, patch_many, SourceIndex)
 
 
 def to_bytes(s):
@@ -92,6 +93,313 @@ class TestFormat(unittest.TestCase):
         self.round_trip(src, dst)
 
 
+    def test_buffers(self):
+        a = random_bytes(5000)
+        src = a + random_bytes(100)
+        dst = random_bytes(100) + a[:2000] + random_bytes(10) + a[2000:]
+        p = diff(src, dst)
+        for wrap in bytearray, memoryview:
+            self.assertEqual(diff(wrap(src), wrap(dst)), p)
+            self.assertEqual(patch(wrap(src), p), dst)
+            self.assertEqual(diff(SourceIndex(wrap(src)), dst), p)
+        # a slice of a buffer, without copying it
+        self.assertEqual(diff(format.view(to_bytes('xx') + src, 2, 5102),
+                              dst), p)
+        self.assertRaises(TypeError, diff, 3, dst)
+        self.assertRaises(TypeError, SourceIndex, [1, 2])
+
+
+class TestControl(unittest.TestCase):
+
+    def test_round_trip(self):
+        tuples = [(random.randint(-1 << 40, 1 << 40), random.randint(0, 999),
+                   random.randint(-1 << 62, 1 << 62)) for _ in range(1000)]
+        control = format.Control(tuples)
+        self.assertEqual(len(control), 1000)
+        self.assertEqual(control, tuples)
+        self.assertEqual(list(control), tuples)
+        self.assertEqual(control[0], tuples[0])
+        self.assertEqual(control[-1], tuples[-1])
+        self.assertEqual(control[10:20], tuples[10:20])
+        self.assertRaises(IndexError, lambda: control[1000])
+        # the control block of a patch
+        block = control.encode()
+        self.assertEqual(block, to_bytes('').join(
+                [core.encode_int64(x) for t in tuples for x in t]))
+        self.assertEqual(core.encode_control(tuples), block)
+        self.assertEqual(format.Control.decode(block), control)
+        self.assertEqual(format.Control.decode(to_bytes('')), [])
+
+    def test_diff_patch(self):
+        a = random_bytes(10000)
+        src = a + random_bytes(100)
+        dst = random_bytes(100) + a[:5000] + random_bytes(50) + a[5000:]
+        packed, bdiff, bextra = core.diff(src, dst)
+        control = format.Control(packed)
+        self.assertTrue(len(control) > 1)
+        for c in packed, control.array, list(control):
+            self.assertEqual(core.patch(src, len(dst), c, bdiff, bextra), dst)
+        len_dst, tcontrol, bdiff2, bextra2 = format.read_patch(
+            format.StringIO(diff(src, dst)))
+        self.assertEqual(tcontrol, control)
+
+    def test_no_array_type(self):
+        # without an 8-byte array type, the triples are kept in a list
+        typecode = format.CONTROL_TYPECODE
+        format.CONTROL_TYPECODE = None
+        try:
+            tuples = [(random.randint(0, 1 << 40), random.randint(0, 999),
+                       random.randint(-1 << 62, 1 << 62)) for _ in range(100)]
+            control = format.Control(tuples)
+            self.assertTrue(isinstance(control.array, list))
+            self.assertEqual(control, tuples)
+            self.assertEqual(control.encode(), core.encode_control(tuples))
+            decoded = format.Control.decode(control.encode())
+            self.assertTrue(isinstance(decoded.array, list))
+            self.assertEqual(decoded, tuples)
+            a = random_bytes(10000)
+            src = a + random_bytes(100)
+            dst = random_bytes(100) + a[:5000] + random_bytes(50) + a[5000:]
+            self.assertEqual(patch(src, diff(src, dst)), dst)
+        finally:
+            format.CONTROL_TYPECODE = typecode
+
+    def test_errors(self):
+        self.assertRaises(ValueError, core.decode_control, random_bytes(25))
+        self.assertRaises(ValueError, core.encode_control, random_bytes(25))
+        self.assertRaises(TypeError, core.encode_control, [(1, 2)])
+        self.assertRaises(TypeError, core.encode_control, [1, 2, 3])
+        self.assertRaises(TypeError, core.encode_control, 3)
+
+
+class TestWritePatch(unittest.TestCase):
+
+    def classic_patch(self, src, dst):
+        # patch as written by bsdiff4 1.1.4, all blocks compressed at once
+        import bz2
+        tcontrol, bdiff, bextra = core.diff(src, dst)
+        tcontrol = format.Control(tcontrol)
+        bcontrol = bz2.compress(to_bytes('').join(
+                [core.encode_int64(x) for c in tcontrol for x in c]))
+        bdiff = bz2.compress(bdiff)
+        bextra = bz2.compress(bextra)
+        return to_bytes('').join([format.MAGIC] +
+                [core.encode_int64(n) for n in (len(bcontrol), len(bdiff),
+                                                len(dst))] +
+                [bcontrol, bdiff, bextra])
+
+    def test_same_as_classic(self):
+        for n in 0, 100, 20000:
+            src = random_bytes(n)
+            dst = src[:n // 2] + random_bytes(50) + src[n // 2:]
+            self.assertEqual(diff(src, dst), self.classic_patch(src, dst))
+
+    def test_chunks(self):
+        chunk_size = format.CHUNK_SIZE
+        format.CHUNK_SIZE = 1000
+        try:
+            a = random_bytes(30000)
+            src = a + random_bytes(5000)
+            dst = random_bytes(7000) + a
+            p = diff(src, dst)
+            self.assertEqual(p, self.classic_patch(src, dst))
+            self.assertEqual(patch(src, p), dst)
+        finally:
+            format.CHUNK_SIZE = chunk_size
+
+    def test_offset(self):
+        # a patch written into the middle of a stream
+        from io import BytesIO
+        src = random_bytes(1000)
+        dst = random_bytes(1000)
+        fo = BytesIO()
+        fo.write(to_bytes('xyz'))
+        format.write_diff(fo, src, dst)
+        fo.write(to_bytes('abc'))
+        data = fo.getvalue()
+        self.assertEqual(data[3:-3], diff(src, dst))
+
+
+class TestCodecs(unittest.TestCase):
+
+    def round_trip(self, src, dst, codec):
+        p = diff(src, dst, codec)
+        self.assertEqual(patch(src, p), dst)
+        return p
+
+    def test_classic(self):
+        src = random_bytes(1000)
+        p = self.round_trip(src, src[::-1], 'bz2')
+        self.assertEqual(p[:8], format.MAGIC)
+        self.assertEqual(p, diff(src, src[::-1]))
+
+    def test_codecs(self):
+        a = random_bytes(5000)
+        src = a + random_bytes(100) + a
+        dst = a + random_bytes(100) + a[:1000]
+        for codec in list(format.CODECS) + ['auto']:
+            p = self.round_trip(src, dst, codec)
+            self.assertEqual(p[:8], format.MAGIC if codec == 'bz2' else
+                             format.MAGIC_CODECS)
+        self.round_trip(src, dst, ('stored', 'zlib', 'bz2'))
+        self.round_trip(to_bytes(''), to_bytes(''), 'zlib')
+
+    def test_auto(self):
+        # empty blocks are stored as they are, the diff block of a small
+        # change is mostly zeros and gets compressed
+        src = random_bytes(20000)
+        dst = src[:10000] + to_bytes('x') + src[10001:]
+        p = diff(src, dst, 'auto')
+        fi = format.StringIO(p)
+        ids = format.read_header(fi)[1]
+        self.assertNotEqual(ids[1], format.CODECS['stored'][0])
+        self.assertEqual(ids[2], format.CODECS['stored'][0])
+
+    def test_header(self):
+        src = random_bytes(1000)
+        p = diff(src, src[:500], ('zlib', 'stored', 'bz2'))
+        size, ids, len_control, len_diff, len_dst = format.read_header(
+            format.StringIO(p))
+        self.assertEqual(size, 40)
+        self.assertEqual([format.CODEC_NAMES[i] for i in ids],
+                         ['zlib', 'stored', 'bz2'])
+        self.assertEqual(len_dst, 500)
+
+    def test_errors(self):
+        self.assertRaises(ValueError, diff, to_bytes('a'), to_bytes('b'),
+                          'gzip')
+        p = bytearray(diff(to_bytes('a'), to_bytes('b'), 'zlib'))
+        p[8] = 99
+        self.assertRaises(ValueError, patch, to_bytes('a'), bytes(p))
+
+
+class TestSourceIndex(unittest.TestCase):
+
+    def test_same_as_diff(self):
+        a = random_bytes(20000)
+        src = a + random_bytes(100) + a[:5000]
+        index = SourceIndex(src)
+        self.assertEqual(len(index), len(src))
+        for _ in range(5):
+            dst = random_bytes(50) + a[random.randint(0, 10000):]
+            self.assertEqual(index.diff(dst), core.diff(src, dst))
+            p = diff(index, dst)
+            self.assertEqual(p, diff(src, dst))
+            self.assertEqual(patch(src, p), dst)
+
+    def test_empty(self):
+        index = SourceIndex(to_bytes(''))
+        self.assertEqual(patch(to_bytes(''), diff(index, to_bytes('abc'))),
+                         to_bytes('abc'))
+
+    def test_index_file(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'src.idx')
+            src = random_bytes(5000) + 3 * to_bytes('abc') + random_bytes(100)
+            dst = src[:3000] + random_bytes(50) + src[3000:]
+            fo = open(path, 'wb')
+            format.write_index(fo, SourceIndex(src))
+            fo.close()
+            index = format.read_index(src, path)
+            self.assertEqual(len(index), len(src))
+            self.assertEqual(index.diff(dst), core.diff(src, dst))
+            del index
+
+            self.assertRaises(ValueError, format.read_index, src[1:], path)
+            data = format.read_data(path)
+            for bad in [data[:-1], data[:8] + to_bytes('\xff') + data[9:],
+                        data[:-4] + 4 * to_bytes('\xff')]:
+                fo = open(path, 'wb')
+                fo.write(bad)
+                fo.close()
+                self.assertRaises(ValueError, format.read_index, src, path)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_suffix_sort(self):
+        # SA-IS gives exactly the suffix array of qsufsort
+        for data in [to_bytes(''), to_bytes('a'), to_bytes('banana'),
+                     10000 * to_bytes('ab'), 5000 * to_bytes('\0'),
+                     random_bytes(3000),
+                     to_bytes('').join(random.choice([to_bytes('\0'),
+                                                      to_bytes('\xff')])
+                                       for _ in range(3000))]:
+            self.assertEqual(core._suffix_sort(data),
+                             core._suffix_sort(data, True))
+
+    def test_errors(self):
+        self.assertRaises(TypeError, SourceIndex, 12345)
+        self.assertRaises(TypeError, SourceIndex(to_bytes('x')).diff, 12345)
+
+
+class TestSketch(unittest.TestCase):
+
+    def sketch(self, data, k=128):
+        return core.sketch(data, k, 7, 32, 1024)
+
+    def test_sketch(self):
+        data = random_bytes(100000)
+        sk = self.sketch(data)
+        self.assertEqual(len(sk), 128)
+        self.assertEqual(sk, sorted(set(sk)))
+        self.assertEqual(self.sketch(bytearray(data)), sk)
+        self.assertEqual(self.sketch(memoryview(data)), sk)
+        self.assertEqual(self.sketch(data, 5), sk[:5])
+        self.assertEqual(self.sketch(to_bytes('')), [])
+        self.assertEqual(len(self.sketch(to_bytes('abc'))), 1)
+
+    def test_content_defined(self):
+        # an insertion near the start only changes the chunks around it,
+        # whatever the byte values of the data
+        for data in [random_bytes(100000), 20000 * to_bytes('hello')]:
+            a = set(self.sketch(data, 10000))
+            b = set(self.sketch(data[:500] + to_bytes('XYZ') + data[500:],
+                                10000))
+            self.assertTrue(len(a & b) >= len(a) - 3)
+
+    def test_max_size(self):
+        # data without any boundary is still cut every max_size bytes
+        self.assertEqual(len(core.sketch(random_bytes(100000), 1000, 63,
+                                         32, 1000)), 100)
+
+    def test_errors(self):
+        for args in [(0, 7, 32, 1024), (10, 0, 32, 1024),
+                     (10, 64, 32, 1024), (10, 7, 0, 1024), (10, 7, 32, 16)]:
+            self.assertRaises(ValueError, core.sketch, to_bytes('abc'), *args)
+        self.assertRaises(TypeError, core.sketch, [1, 2], 10, 7, 32, 1024)
+
+
+class TestMany(unittest.TestCase):
+
+    def test_round_trip(self):
+        a = random_bytes(5000)
+        srcs = [a + random_bytes(i) for i in range(7)]
+        dsts = [random_bytes(30) + src[i * 100:] for i, src in
+                enumerate(srcs)]
+        for jobs in None, 1, 3:
+            patches = diff_many(srcs, dsts, jobs=jobs)
+            self.assertEqual(patches, [diff(s, d) for s, d in
+                                       zip(srcs, dsts)])
+            self.assertEqual(patch_many(srcs, patches, jobs=jobs), dsts)
+        # one index for several destinations
+        index = SourceIndex(a)
+        patches = diff_many(3 * [index], dsts[:3], codec='zlib')
+        self.assertEqual(patch_many(3 * [a], patches), dsts[:3])
+        self.assertEqual(diff_many([], []), [])
+
+    def test_errors(self):
+        src = random_bytes(100)
+        self.assertRaises(ValueError, diff_many, [src], [])
+        self.assertRaises(ValueError, patch_many, [src, src], [diff(src, src)])
+        # an error in any of the jobs is raised
+        self.assertRaises(ValueError, patch_many, [src, src],
+                          [diff(src, src), to_bytes('BSDIFF40')], 2)
+        # negative lengths in a control tuple
+        self.assertRaises(ValueError, core.patch, src, 10, [(-1, 11, 0)],
+                          to_bytes(''), random_bytes(11))
+
+
 class TestFile(unittest.TestCase):
 
     def setUp(self):
@@ -137,6 +445,110 @@ class TestFile(unittest.TestCase):
         self.write_data('dst', a + to_bytes('extra bytes at the end'))
         self.round_trip()
 
+    def test_chunks(self):
+        chunk_size = format.CHUNK_SIZE, format.PATCH_READ_SIZE
+        format.CHUNK_SIZE, format.PATCH_READ_SIZE = 1000, 100
+        try:
+            a = 3000 * to_bytes('ABCDE')
+            self.write_data('src', a + random_bytes(5000) + a)
+            self.write_data('dst', random_bytes(3000) + a + random_bytes(5000))
+            self.round_trip()
+        finally:
+            format.CHUNK_SIZE, format.PATCH_READ_SIZE = chunk_size
+
+    def test_empty(self):
+        self.write_data('src', to_bytes(''))
+        self.write_data('dst', random_bytes(100))
+        self.round_trip()
+        self.write_data('dst', to_bytes(''))
+        self.round_trip()
+
+    def test_shrink_inplace(self):
+        self.write_data('src', random_bytes(5000))
+        self.write_data('dst', random_bytes(100))
+        file_diff(self.path('src'), self.path('dst'), self.path('patch'))
+        file_patch_inplace(self.path('src'), self.path('patch'))
+        self.assert_same_file_content('src', 'dst')
+
+    def test_source_outside(self):
+        # control tuples may move the old position outside of the source
+        src = random_bytes(100)
+        bdiff = random_bytes(60)
+        tcontrol = [(0, 0, -20), (60, 0, 50), (0, 0, 0)]
+        fo = open(self.path('patch'), 'wb')
+        format.write_patch(fo, 60, tcontrol, bdiff, to_bytes(''))
+        fo.close()
+        self.write_data('src', src)
+        file_patch(self.path('src'), self.path('dst'), self.path('patch'))
+        self.assertEqual(format.read_data(self.path('dst')),
+                         core.patch(src, 60, tcontrol, bdiff, to_bytes('')))
+
+    def test_corrupt(self):
+        self.write_data('src', random_bytes(1000))
+        self.write_data('dst', random_bytes(1000))
+        file_diff(self.path('src'), self.path('dst'), self.path('patch'))
+        data = format.read_data(self.path('patch'))
+        # wrong length of the new data
+        self.write_data('patch', data[:24] + core.encode_int64(999) + data[32:])
+        self.assertRaises(ValueError, file_patch, self.path('src'),
+                          self.path('dst2'), self.path('patch'))
+        self.write_data('patch', data[:24] + core.encode_int64(1001) + data[32:])
+        self.assertRaises(ValueError, file_patch, self.path('src'),
+                          self.path('dst2'), self.path('patch'))
+        # a failed in place patch leaves the file alone
+        self.assertRaises(ValueError, file_patch_inplace, self.path('src'),
+                          self.path('patch'))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['dst', 'dst2', 'patch', 'src'])
+
+    def test_codecs(self):
+        a = 1000 * to_bytes('ABCDE')
+        self.write_data('src', a + random_bytes(100))
+        self.write_data('dst', random_bytes(100) + a)
+        for codec in list(format.CODECS) + ['auto']:
+            file_diff(self.path('src'), self.path('dst'), self.path('patch'),
+                      codec)
+            file_patch(self.path('src'), self.path('dst2'),
+                       self.path('patch'))
+            self.assert_same_file_content('dst', 'dst2')
+
+    def test_windows(self):
+        a = random_bytes(6000)
+        src = a + random_bytes(1000) + a[:3000]
+        dst = random_bytes(500) + a[:4000] + 2 * random_bytes(300) + a[3000:]
+        self.write_data('src', src)
+        self.write_data('dst', dst)
+        for jobs in 1, 3:
+            file_diff(self.path('src'), self.path('dst'), self.path('patch'),
+                      window_size=1000, jobs=jobs)
+            data = format.read_data(self.path('patch'))
+            self.assertEqual(data[:8], format.MAGIC_WINDOWS)
+            self.assertEqual(data, diff(src, dst, window_size=1000))
+            self.assertEqual(patch(src, data), dst)
+            file_patch(self.path('src'), self.path('dst2'), self.path('patch'))
+            self.assert_same_file_content('dst', 'dst2')
+        # empty files
+        self.write_data('dst', to_bytes(''))
+        file_diff(self.path('src'), self.path('dst'), self.path('patch'),
+                  window_size=1000)
+        file_patch(self.path('src'), self.path('dst2'), self.path('patch'))
+        self.assert_same_file_content('dst', 'dst2')
+        self.assertEqual(patch(to_bytes(''), diff(to_bytes(''), dst,
+                                                  window_size=10)), dst)
+
+    def test_windows_corrupt(self):
+        self.write_data('src', random_bytes(3000))
+        self.write_data('dst', random_bytes(3000))
+        file_diff(self.path('src'), self.path('dst'), self.path('patch'),
+                  window_size=1000)
+        data = format.read_data(self.path('patch'))
+        # source region of the first window beyond the source
+        for bad in [data[:32] + core.encode_int64(2500) + data[40:],
+                    data[:-1]]:
+            self.write_data('patch', bad)
+            self.assertRaises(ValueError, file_patch, self.path('src'),
+                              self.path('dst2'), self.path('patch'))
+
     def test_inplace(self):
         a = 1000 * to_bytes('ABCDE')
         b = 1000 * to_bytes('XYZ')
@@ -153,7 +565,8 @@ def run(verbosity=1):
     print('bsdiff4 version: ' + __version__)
 
     suite = unittest.TestSuite()
-    for cls in [TestEncode, TestFormat, TestFile]:
+    for cls in [TestEncode, TestFormat, TestControl, TestWritePatch,
+                TestCodecs, TestSourceIndex, TestSketch, TestMany, TestFile]:
         suite.addTest(unittest.makeSuite(cls))
     runner = unittest.TextTestRunner(verbosity=verbosity)
     return runner.run(suite)
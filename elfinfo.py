@@ -0,0 +1,221 @@
+'''
+ ELF fingerprints of native libraries, for matching a new library with
+ the old one it was built from.
+
+ A library which got renamed or moved (libfoo.so -> libfoo2.so) is found
+ in the new APK under a path the old APK does not have, and the best old
+ library to diff it against has to be guessed. Its contents only go so
+ far: libraries built for another ABI look alike to a byte sketch but
+ never diff well. The ELF headers say a lot more, and cost next to
+ nothing to read:
+
+	machine, bits	the ABI; libraries of different ABIs are never paired
+	soname			usually survives a rename of the file
+	build_id		the same build-id means the same code
+	sections		(name, size) of the allocated sections, which move
+					little between two builds of the same library
+	symbols			crc32 of the names of the exported dynamic symbols
+
+ Only the section headers, .dynamic, .dynsym, .dynstr and the notes are
+ read. Data may be bytes or any buffer (an mmap of the APK), nothing is
+ copied but the string tables.
+'''
+
+import collections, struct, zlib
+
+
+ELF_MAGIC = b'\x7fELF'
+
+ElfInfo = collections.namedtuple('ElfInfo', ['machine', 'bits', 'soname',
+											 'build_id', 'sections',
+											 'symbols'])
+
+# section types and flags, dynamic tags, symbol bindings and note types
+SHT_DYNAMIC = 6
+SHT_NOTE = 7
+SHT_DYNSYM = 11
+SHF_ALLOC = 0x2
+DT_NULL = 0
+DT_SONAME = 14
+STB_GLOBAL = 1
+STB_WEAK = 2
+SHN_UNDEF = 0
+NT_GNU_BUILD_ID = 3
+
+# e_machine of the Android ABIs
+MACHINES = {40: 'arm', 3: 'x86', 62: 'x86_64', 183: 'aarch64', 8: 'mips',
+			243: 'riscv'}
+
+
+class Layout(object):
+	# the struct formats of one ELF class and byte order
+
+	def __init__(self, bits, order):
+		word = 'I' if bits == 32 else 'Q'
+		self.header = struct.Struct(order + 'HHI3%sIHHHHHH' % word)
+		if bits == 32:
+			self.section = struct.Struct(order + 'IIIIIIIIII')
+			self.symbol = struct.Struct(order + 'IIIBBH')
+			self.dynamic = struct.Struct(order + 'iI')
+		else:
+			self.section = struct.Struct(order + 'IIQQQQIIQQ')
+			self.symbol = struct.Struct(order + 'IBBHQQ')
+			self.dynamic = struct.Struct(order + 'qQ')
+		self.note = struct.Struct(order + 'III')
+		self.bits = bits
+
+
+def fingerprint(data):
+	'''
+	The ElfInfo of data, or None if it is not an ELF file. Whatever is
+	missing or cannot be parsed (a stripped or truncated library) is left
+	empty rather than failing.
+	'''
+	if len(data) < 16 or bytes(data[:4]) != ELF_MAGIC:
+		return None
+	ident = bytearray(data[4:6])
+	if ident[0] not in (1, 2) or ident[1] not in (1, 2):
+		return None
+	layout = Layout(32 if ident[0] == 1 else 64, '<' if ident[1] == 1 else '>')
+	try:
+		header = layout.header.unpack_from(data, 16)
+	except struct.error:
+		return None
+	machine = header[1]
+	info = {'soname': None, 'build_id': None, 'sections': (),
+			'symbols': frozenset()}
+	try:
+		read_sections(data, layout, header, info)
+	except (struct.error, IndexError, ValueError):
+		pass
+	return ElfInfo(machine, layout.bits, info['soname'], info['build_id'],
+				   info['sections'], info['symbols'])
+
+
+def read_sections(data, layout, header, info):
+	# fill in info from the section headers; raises struct.error,
+	# IndexError or ValueError on a truncated or corrupt file
+	shoff, shentsize, shnum, shstrndx = header[5], header[10], header[11], header[12]
+	if not shoff or shentsize < layout.section.size:
+		return
+	sections = [layout.section.unpack_from(data, shoff + i * shentsize)
+				for i in range(shnum)]
+	if shstrndx >= len(sections):
+		raise ValueError('no section names')
+	names = strings(data, sections[shstrndx])
+
+	layout_sections = []
+	for sh in sections:
+		sh_name, sh_type, sh_flags, sh_size, sh_link = sh[0], sh[1], sh[2], sh[5], sh[6]
+		if sh_flags & SHF_ALLOC:
+			layout_sections.append((cstring(names, sh_name), sh_size))
+		if sh_type == SHT_NOTE:
+			read_notes(data, layout, sh, info)
+		elif sh_type == SHT_DYNAMIC and sh_link < len(sections):
+			read_dynamic(data, layout, sh, strings(data, sections[sh_link]), info)
+		elif sh_type == SHT_DYNSYM and sh_link < len(sections):
+			read_symbols(data, layout, sh, strings(data, sections[sh_link]), info)
+	info['sections'] = tuple(layout_sections)
+
+
+def section_data(data, sh):
+	offset, size = sh[4], sh[5]
+	if offset + size > len(data):
+		raise ValueError('section beyond the end of the file')
+	return offset, size
+
+
+def strings(data, sh):
+	# a string table, as bytes
+	offset, size = section_data(data, sh)
+	return bytes(data[offset:offset + size])
+
+def cstring(table, offset):
+	end = table.find(b'\0', offset)
+	if end < 0:
+		end = len(table)
+	return table[offset:end].decode('utf-8', 'replace')
+
+
+def read_notes(data, layout, sh, info):
+	offset, size = section_data(data, sh)
+	pos, end = offset, offset + size
+	while pos + layout.note.size <= end:
+		namesz, descsz, note_type = layout.note.unpack_from(data, pos)
+		pos += layout.note.size
+		name = bytes(data[pos:pos + namesz])
+		pos += (namesz + 3) & ~3
+		desc = bytes(data[pos:pos + descsz])
+		pos += (descsz + 3) & ~3
+		if note_type == NT_GNU_BUILD_ID and name.rstrip(b'\0') == b'GNU':
+			info['build_id'] = desc
+
+
+def read_dynamic(data, layout, sh, dynstr, info):
+	offset, size = section_data(data, sh)
+	for pos in range(offset, offset + size - layout.dynamic.size + 1,
+					 layout.dynamic.size):
+		tag, value = layout.dynamic.unpack_from(data, pos)
+		if tag == DT_NULL:
+			break
+		if tag == DT_SONAME:
+			info['soname'] = cstring(dynstr, value)
+
+
+def read_symbols(data, layout, sh, dynstr, info):
+	offset, size = section_data(data, sh)
+	symbols = set()
+	for pos in range(offset, offset + size - layout.symbol.size + 1,
+					 layout.symbol.size):
+		sym = layout.symbol.unpack_from(data, pos)
+		if layout.bits == 32:
+			st_name, st_info, st_shndx = sym[0], sym[3], sym[5]
+		else:
+			st_name, st_info, st_shndx = sym[0], sym[1], sym[3]
+		if st_shndx != SHN_UNDEF and st_info >> 4 in (STB_GLOBAL, STB_WEAK):
+			end = dynstr.find(b'\0', st_name)
+			symbols.add(zlib.crc32(dynstr[st_name:end]) & 0xffffffff)
+	info['symbols'] = frozenset(symbols)
+
+
+def similarity(a, b):
+	'''
+	How likely the libraries a and b (ElfInfo) are two builds of the same
+	code, from 0 to 1: 1 for the same build-id, otherwise a mix of the
+	overlap of their exported symbols, of their section layouts and of
+	their sonames.
+	'''
+	if a.build_id and a.build_id == b.build_id:
+		return 1.0
+	score = 0.5 * jaccard(a.symbols, b.symbols)
+	score += 0.3 * layout_similarity(a.sections, b.sections)
+	if a.soname and a.soname == b.soname:
+		score += 0.2
+	return score
+
+
+def related(a, b):
+	# whether a and b share a build-id, a soname or an exported symbol
+	return bool((a.build_id and a.build_id == b.build_id) or
+				(a.soname and a.soname == b.soname) or
+				a.symbols & b.symbols)
+
+
+def jaccard(a, b):
+	if not a and not b:
+		return 0.0
+	return float(len(a & b)) / len(a | b)
+
+
+def layout_similarity(a, b):
+	# 1 for the same sections with the same sizes, less as sections
+	# appear, vanish or change size
+	a, b = dict(a), dict(b)
+	names = set(a) | set(b)
+	if not names:
+		return 0.0
+	total = 0.0
+	for name in names:
+		if name in a and name in b:
+			total += float(min(a[name], b[name])) / max(a[name], b[name], 1)
+	return total / len(names)
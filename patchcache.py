@@ -0,0 +1,215 @@
+'''
+ A directory of finished bsdiff patches, trial-diff sizes and suffix
+ array index files, shared between runs of apk-diff.py.
+
+ Most entries of an APK do not change from one build to the next, so the
+ same (old entry, new entry) pairs get diffed over and over again. The
+ cache is content-addressed: a key is the sha256 of the old data, of the
+ new data and of the options the patch depends on, so a hit is always
+ the right patch whatever the entries are called. Every key also holds
+ CACHE_VERSION, so files written in an older format are never hit. Old
+ entries are diffed against many new ones (one per build), so their
+ suffix arrays are kept as well and memory-mapped instead of sorted
+ again.
+
+ Layout:
+
+	<dir>/patch/ab/abcdef...	a patch, as written by bsdiff4
+	<dir>/size/ab/abcdef...	the size of a trial diff, in decimal
+	<dir>/index/ab/abcdef...	the suffix array of an old entry, keyed by
+							the sha256 of the entry alone
+
+ Several processes (parallel CI jobs, the workers of one run) may use the
+ same directory. Files are written under a temporary name in the same
+ directory and renamed into place, so a reader sees either nothing or a
+ complete file. Reading touches the file, and evict() deletes the least
+ recently used files until the directory fits its size limit; files
+ which vanish under it (another process evicting) are not an error.
+'''
+
+import os, errno, time, shutil, hashlib, tempfile, bsdiff4
+
+
+# part of every key: bump it whenever the patches or sizes written for
+# the same data and options change (a new bsdiff4 patch format, say)
+CACHE_VERSION = 1
+
+TEMP_PREFIX = '.tmp-'
+# temporary files older than this were left by a process which died
+STALE_TEMP_SECONDS = 3600
+
+# os.rename does not replace an existing file on Windows
+replace = getattr(os, 'replace', os.rename)
+
+
+def content_hash(data):
+	return hashlib.sha256(data).hexdigest()
+
+
+def content_hash_iter(pieces):
+	# the content_hash of the data given in pieces
+	h = hashlib.sha256()
+	for data in pieces:
+		h.update(data)
+	return h.hexdigest()
+
+
+class PatchCache(object):
+
+	def __init__(self, path, max_size=None):
+		self.path = path
+		self.max_size = max_size
+
+	def key(self, *parts):
+		'''
+		The key for a list of strings, typically the content hashes of the
+		old and new data and the options of the diff, and CACHE_VERSION.
+		'''
+		parts = ('cache=%d' % CACHE_VERSION,) + parts
+		return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+	def filename(self, kind, key):
+		return os.path.join(self.path, kind, key[:2], key)
+
+	def open(self, kind, key):
+		# the open file, or None if there is no such entry
+		path = self.filename(kind, key)
+		try:
+			f = open(path, 'rb')
+		except IOError as e:
+			if e.errno == errno.ENOENT:
+				return None
+			raise
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass # evicted meanwhile, we still have it open
+		return f
+
+	def store(self, kind, key, write):
+		# write(f) fills the temporary file which then replaces the entry
+		path = self.filename(kind, key)
+		dirname = os.path.dirname(path)
+		try:
+			os.makedirs(dirname)
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+		fd, tmp = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=dirname)
+		try:
+			f = os.fdopen(fd, 'wb')
+			try:
+				write(f)
+			finally:
+				f.close()
+			replace(tmp, path)
+		except:
+			os.unlink(tmp)
+			raise
+
+	def get_patch(self, key, path):
+		'''
+		Copy the patch stored under key to the file path, return True if
+		there was one.
+		'''
+		f = self.open('patch', key)
+		if f is None:
+			return False
+		try:
+			out = open(path, 'wb')
+			shutil.copyfileobj(f, out)
+			out.close()
+		finally:
+			f.close()
+		return True
+
+	def put_patch(self, key, path):
+		# store a copy of the patch file path
+		def write(out):
+			f = open(path, 'rb')
+			shutil.copyfileobj(f, out)
+			f.close()
+		self.store('patch', key, write)
+
+	def get_size(self, key):
+		f = self.open('size', key)
+		if f is None:
+			return None
+		try:
+			return int(f.read())
+		except ValueError:
+			return None
+		finally:
+			f.close()
+
+	def put_size(self, key, size):
+		self.store('size', key, lambda f: f.write(str(size).encode('ascii')))
+
+	def get_index(self, src_hash, src):
+		'''
+		The bsdiff4.SourceIndex of src (whose sha256 is src_hash), mapped
+		from its index file, or None. An index file which does not fit
+		src is treated as missing, and will be overwritten.
+		'''
+		path = self.filename('index', src_hash)
+		try:
+			index = bsdiff4.format.read_index(src, path)
+		except IOError as e:
+			if e.errno == errno.ENOENT:
+				return None
+			raise
+		except ValueError:
+			return None
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+		return index
+
+	def put_index(self, src_hash, index):
+		self.store('index', src_hash, lambda f: bsdiff4.format.write_index(f, index))
+
+	def evict(self, max_size=None):
+		'''
+		Delete the least recently used files until the cache takes at most
+		max_size bytes (self.max_size by default). Returns the number of
+		bytes freed.
+		'''
+		if max_size is None:
+			max_size = self.max_size
+		if max_size is None:
+			return 0
+		now = time.time()
+		files = []
+		total = 0
+		for root, dirs, names in os.walk(self.path):
+			for name in names:
+				path = os.path.join(root, name)
+				try:
+					st = os.stat(path)
+				except OSError:
+					continue
+				if name.startswith(TEMP_PREFIX):
+					if st.st_mtime < now - STALE_TEMP_SECONDS:
+						remove(path)
+					continue
+				files.append((st.st_mtime, path, st.st_size))
+				total += st.st_size
+		files.sort()
+		freed = 0
+		for mtime, path, size in files:
+			if total - freed <= max_size:
+				break
+			if remove(path):
+				freed += size
+		return freed
+
+
+def remove(path):
+	try:
+		os.unlink(path)
+		return True
+	except OSError as e:
+		if e.errno != errno.ENOENT:
+			raise
+		return False
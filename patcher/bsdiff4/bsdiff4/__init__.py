@@ -1,4 +1,5 @@
-from .format import diff, patch, file_diff, file_patch, file_patch_inplace
+from .format import (diff, patch, file_diff, file_patch, file_patch_inplace,
+                     diff_many, patch_many, SourceIndex)
 
 __version__ = '1.1.5'
 
@@ -1,7 +1,9 @@
 from os.path import getsize
 from optparse import OptionParser
 
-from .format import file_diff, file_patch, read_patch
+from .core import decode_int64
+from .format import (file_diff, file_patch, read_patch, read_header,
+                     CODECS, CODEC_NAMES, MAGIC_WINDOWS)
 
 
 def human_bytes(n):
@@ -25,14 +27,40 @@ def main_bsdiff4():
     p.add_option('-v', "--verbose",
                  action="store_true")
 
+    p.add_option('-c', "--codec",
+                 action="store",
+                 default='bz2',
+                 help="block codec: %s or auto (default bz2, the only one "
+                      "understood by bsdiff4 1.1.4 and earlier)" %
+                      ', '.join(sorted(CODECS)))
+
+    p.add_option('-w', "--window",
+                 action="store",
+                 type="int",
+                 metavar="MB",
+                 help="write a windowed patch: cut DST in windows of MB "
+                      "megabytes, each diffed against a part of SRC, which "
+                      "bounds memory use (not understood by bsdiff4 1.1.4 "
+                      "and earlier)")
+
+    p.add_option('-j', "--jobs",
+                 action="store",
+                 type="int",
+                 default=1,
+                 help="number of windows diffed at the same time (default 1)")
+
     opts, args = p.parse_args()
 
     if len(args) != 3:
         p.error('requies 3 arguments, try -h')
 
-    file_diff(*args)
+    if opts.codec != 'auto' and opts.codec not in CODECS:
+        p.error('unknown codec: %s' % opts.codec)
+
+    file_diff(args[0], args[1], args[2], opts.codec,
+              opts.window and opts.window << 20, opts.jobs)
     if opts.verbose:
-        size = [getsize(args[i]) for i in xrange(3)]
+        size = [getsize(args[i]) for i in range(3)]
         print('src: %s' % human_bytes(size[0]))
         print('dst: %s' % human_bytes(size[1]))
         print('patch: %s (%.2f%% of dst)' % (human_bytes(size[2]),
@@ -42,14 +70,29 @@ def main_bsdiff4():
 def show_patch(patch_path):
     s_total = getsize(patch_path)
     fi = open(patch_path, 'rb')
+    header = fi.read(32)
+    fi.seek(0)
+    windowed = header[:8] == MAGIC_WINDOWS
+    if windowed:
+        # the window headers are counted as extra
+        s_header, ids = 32, []
+    else:
+        s_header, ids = read_header(fi)[:2]
+        fi.seek(0)
     s_control, s_diff, s_dst, tcontrol = read_patch(fi, header_only=True)
     fi.close()
-    s_extra = s_total - 32 - s_control - s_diff
+    s_extra = s_total - s_header - s_control - s_diff
 
     for var_name in 'total', 'control', 'diff', 'extra', 'dst':
         size = eval('s_' + var_name)
         print('%s size: %d (%s)' % (var_name, size, human_bytes(size)))
-    print('total / dst = %.2f%%' % (100.0 * s_total / s_dst))
+    if windowed:
+        print('windows: %d of %s' % (decode_int64(header[16:24]),
+                                     human_bytes(decode_int64(header[24:]))))
+    else:
+        print('codecs (control, diff, extra): %s' %
+              ', '.join(CODEC_NAMES.get(i, '?') for i in ids))
+    print('total / dst = %.2f%%' % (100.0 * s_total / max(s_dst, 1)))
     print('number of control tuples: %d' % len(tcontrol))
     #for t in tcontrol:
     #    print('%20d %10d %10d' % t)
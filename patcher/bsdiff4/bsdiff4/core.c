@@ -5,18 +5,30 @@
   which can be found at http://www.daemonology.net/bsdiff.
 */
 
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 
 #if PY_MAJOR_VERSION >= 3
 #define IS_PY3K
 #endif
 
+/* the data arguments are parsed into a Py_buffer, so any object with the
+   buffer interface (bytes, bytearray, mmap, memoryview) is taken without
+   copying it, and lengths are Py_ssize_t */
+#ifdef IS_PY3K
+#define BUFFER_FORMAT  "y*"
+#else
+#define BUFFER_FORMAT  "s*"
+#endif
+
 #ifdef IS_PY3K
 #include "bytesobject.h"
 #define PyString_FromStringAndSize  PyBytes_FromStringAndSize
 #define PyString_Check  PyBytes_Check
 #define PyString_Size  PyBytes_Size
 #define PyString_AsString  PyBytes_AsString
+#define PyString_AS_STRING  PyBytes_AS_STRING
+#define PyString_GET_SIZE  PyBytes_GET_SIZE
 #endif
 
 #define MIN(x, y)  (((x) < (y)) ? (x) : (y))
@@ -154,6 +166,182 @@ static void qsufsort(off_t *I, off_t *V, unsigned char *old, off_t oldsize)
 }
 
 
+/* SA-IS (Nong, Zhang and Chan, "Two Efficient Algorithms for Linear Time
+   Suffix Array Construction", 2011) sorts the n suffixes of s into SA in
+   linear time.  s[n - 1] must be the unique smallest symbol.
+
+   At the top level (cs == 1) s holds the n - 1 bytes of the original data
+   and the smallest symbol is a virtual one after them, so SA comes out
+   the same as the I array of qsufsort: the empty suffix first, followed
+   by the other suffixes in lexicographic order.  The reduced problem of
+   the recursion (cs == sizeof(int)) is a string of ints held in SA.
+
+   Besides SA, only the type bits and the buckets are allocated, with
+   malloc() as this runs without the GIL.  Returns -1 when out of memory.
+*/
+#define SAIS_CHR(i)  (cs == 1 ? ((i) == n - 1 ? 0 : \
+                                 ((unsigned char *) s)[i] + 1) : \
+                      ((int *) s)[i])
+#define SAIS_TGET(i)  ((t[(i) / 8] >> ((i) % 8)) & 1)
+#define SAIS_TSET(i, b)  (t[(i) / 8] = (b) ? t[(i) / 8] | 1 << ((i) % 8) : \
+                                            t[(i) / 8] & ~(1 << ((i) % 8)))
+#define SAIS_ISLMS(i)  ((i) > 0 && SAIS_TGET(i) && !SAIS_TGET((i) - 1))
+
+static void sais_buckets(const void *s, int *bkt, int n, int K, int cs,
+                         int end)
+{
+    int i, sum = 0;
+
+    for (i = 0; i <= K; i++)
+        bkt[i] = 0;
+    for (i = 0; i < n; i++)
+        bkt[SAIS_CHR(i)]++;
+    for (i = 0; i <= K; i++) {
+        sum += bkt[i];
+        bkt[i] = end ? sum : sum - bkt[i];
+    }
+}
+
+static void sais_induce(const unsigned char *t, int *SA, const void *s,
+                        int *bkt, int n, int K, int cs)
+{
+    int i, j;
+
+    /* L-type suffixes from the start of their buckets, left to right */
+    sais_buckets(s, bkt, n, K, cs, 0);
+    for (i = 0; i < n; i++) {
+        j = SA[i] - 1;
+        if (j >= 0 && !SAIS_TGET(j))
+            SA[bkt[SAIS_CHR(j)]++] = j;
+    }
+    /* then S-type suffixes from the end of their buckets, right to left */
+    sais_buckets(s, bkt, n, K, cs, 1);
+    for (i = n - 1; i >= 0; i--) {
+        j = SA[i] - 1;
+        if (j >= 0 && SAIS_TGET(j))
+            SA[--bkt[SAIS_CHR(j)]] = j;
+    }
+}
+
+static int sais(const void *s, int *SA, int n, int K, int cs)
+{
+    unsigned char *t;
+    int *bkt, *s1, *SA1;
+    int i, j, d, n1, name, prev, pos, diff;
+
+    if (n == 1) {
+        SA[0] = 0;
+        return 0;
+    }
+    t = calloc(n / 8 + 1, 1);
+    bkt = malloc((K + 1) * sizeof(int));
+    if (!t || !bkt) {
+        free(t);
+        free(bkt);
+        return -1;
+    }
+
+    /* classify the suffixes as S-type (1) or L-type (0) */
+    SAIS_TSET(n - 2, 0);
+    SAIS_TSET(n - 1, 1);
+    for (i = n - 3; i >= 0; i--)
+        SAIS_TSET(i, SAIS_CHR(i) < SAIS_CHR(i + 1) ||
+                  (SAIS_CHR(i) == SAIS_CHR(i + 1) && SAIS_TGET(i + 1)));
+
+    /* sort the LMS substrings */
+    sais_buckets(s, bkt, n, K, cs, 1);
+    for (i = 0; i < n; i++)
+        SA[i] = -1;
+    for (i = 1; i < n; i++)
+        if (SAIS_ISLMS(i))
+            SA[--bkt[SAIS_CHR(i)]] = i;
+    sais_induce(t, SA, s, bkt, n, K, cs);
+    free(bkt);
+
+    /* move them to the first n1 items of SA and name them, equal
+       substrings getting the same name */
+    for (i = 0, n1 = 0; i < n; i++)
+        if (SAIS_ISLMS(SA[i]))
+            SA[n1++] = SA[i];
+    for (i = n1; i < n; i++)
+        SA[i] = -1;
+    name = 0;
+    prev = -1;
+    for (i = 0; i < n1; i++) {
+        pos = SA[i];
+        diff = 0;
+        for (d = 0; d < n; d++) {
+            if (prev == -1 || SAIS_CHR(pos + d) != SAIS_CHR(prev + d) ||
+                    SAIS_TGET(pos + d) != SAIS_TGET(prev + d)) {
+                diff = 1;
+                break;
+            }
+            if (d > 0 && (SAIS_ISLMS(pos + d) || SAIS_ISLMS(prev + d)))
+                break;
+        }
+        if (diff) {
+            name++;
+            prev = pos;
+        }
+        /* LMS positions are at least two apart */
+        SA[n1 + pos / 2] = name - 1;
+    }
+    for (i = n - 1, j = n - 1; i >= n1; i--)
+        if (SA[i] >= 0)
+            SA[j--] = SA[i];
+
+    /* sort the reduced string s1, recursing unless all names differ */
+    SA1 = SA;
+    s1 = SA + n - n1;
+    if (name < n1) {
+        if (sais(s1, SA1, n1, name - 1, sizeof(int)) < 0) {
+            free(t);
+            return -1;
+        }
+    } else {
+        for (i = 0; i < n1; i++)
+            SA1[s1[i]] = i;
+    }
+
+    /* induce the order of all suffixes from the sorted LMS suffixes */
+    bkt = malloc((K + 1) * sizeof(int));
+    if (!bkt) {
+        free(t);
+        return -1;
+    }
+    sais_buckets(s, bkt, n, K, cs, 1);
+    for (i = 1, j = 0; i < n; i++)
+        if (SAIS_ISLMS(i))
+            s1[j++] = i;
+    for (i = 0; i < n1; i++)
+        SA1[i] = s1[SA1[i]];
+    for (i = n1; i < n; i++)
+        SA[i] = -1;
+    for (i = n1 - 1; i >= 0; i--) {
+        j = SA[i];
+        SA[i] = -1;
+        SA[--bkt[SAIS_CHR(j)]] = j;
+    }
+    sais_induce(t, SA, s, bkt, n, K, cs);
+
+    free(bkt);
+    free(t);
+    return 0;
+}
+
+
+/* the sorted suffixes of the original data, oldsize + 1 entries: 32-bit
+   ones built by SA-IS when the data is shorter than 2 GiB, and off_t ones
+   built by qsufsort otherwise (exactly one of I32 and I64 is set)
+*/
+typedef struct {
+    int *I32;
+    off_t *I64;
+} SuffixArray;
+
+#define SA_GET(sa, k)  ((sa)->I32 ? (off_t) (sa)->I32[k] : (sa)->I64[k])
+
+
 static off_t matchlen(unsigned char *old, off_t oldsize,
                       unsigned char *new, off_t newsize)
 {
@@ -166,93 +354,256 @@ static off_t matchlen(unsigned char *old, off_t oldsize,
 }
 
 
-static off_t search(off_t *I,
+static off_t search(const SuffixArray *sa,
                     unsigned char *old, off_t oldsize,
                     unsigned char *new, off_t newsize,
                     off_t st, off_t en, off_t *pos)
 {
-    off_t x, y;
+    off_t x, y, ist, ien, ix;
 
     if (en - st < 2) {
-        x = matchlen(old + I[st], oldsize - I[st], new, newsize);
-        y = matchlen(old + I[en], oldsize - I[en], new, newsize);
+        ist = SA_GET(sa, st);
+        ien = SA_GET(sa, en);
+        x = matchlen(old + ist, oldsize - ist, new, newsize);
+        y = matchlen(old + ien, oldsize - ien, new, newsize);
 
         if (x > y) {
-            *pos = I[st];
+            *pos = ist;
             return x;
         } else {
-            *pos = I[en];
+            *pos = ien;
             return y;
         }
     }
 
     x = st + (en - st) / 2;
-    if (memcmp(old + I[x], new, MIN(oldsize - I[x], newsize)) < 0) {
-        return search(I, old, oldsize, new, newsize, x, en, pos);
+    ix = SA_GET(sa, x);
+    if (memcmp(old + ix, new, MIN(oldsize - ix, newsize)) < 0) {
+        return search(sa, old, oldsize, new, newsize, x, en, pos);
     } else {
-        return search(I, old, oldsize, new, newsize, st, x, pos);
+        return search(sa, old, oldsize, new, newsize, st, x, pos);
     }
 }
 
 
-/* performs a diff between the two data streams and returns a tuple
-   containing the control, diff and extra blocks that bsdiff produces
+/* sorts the suffixes of the original data into sa, with qsufsort if
+   use_qsufsort is set or the data is too long for SA-IS; returns 0, or -1
+   with an exception set
 */
-static PyObject* diff(PyObject* self, PyObject* args)
+static int build_index(char *origData, off_t origDataLength, SuffixArray *sa,
+                       int use_qsufsort)
 {
-    off_t lastscan, lastpos, lastoffset, oldscore, scsc, overlap, Ss, lens;
-    off_t *I, *V, dblen, eblen, scan, pos, len, s, Sf, lenf, Sb, lenb, i;
-    PyObject *controlTuples, *tuple, *results, *temp;
-    int origDataLength, newDataLength;
-    char *origData, *newData;
-    unsigned char *db, *eb;
-
-    if (!PyArg_ParseTuple(args, "s#s#",
-                          &origData, &origDataLength,
-                          &newData, &newDataLength))
-        return NULL;
-
-    /* create the control tuple */
-    controlTuples = PyList_New(0);
-    if (!controlTuples)
-        return NULL;
+    off_t *V;
+    int err;
+
+    sa->I32 = NULL;
+    sa->I64 = NULL;
+    if (!use_qsufsort && origDataLength < INT_MAX) {
+        sa->I32 = PyMem_Malloc((origDataLength + 1) * sizeof(int));
+        if (!sa->I32) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        Py_BEGIN_ALLOW_THREADS  /* release GIL */
+        err = sais(origData, sa->I32, (int) origDataLength + 1, 256, 1);
+        Py_END_ALLOW_THREADS
+        if (err < 0) {
+            PyMem_Free(sa->I32);
+            sa->I32 = NULL;
+            PyErr_NoMemory();
+            return -1;
+        }
+        return 0;
+    }
 
-    /* perform sort on original data */
-    I = PyMem_Malloc((origDataLength + 1) * sizeof(off_t));
-    if (!I) {
-        Py_DECREF(controlTuples);
-        return PyErr_NoMemory();
+    sa->I64 = PyMem_Malloc((origDataLength + 1) * sizeof(off_t));
+    if (!sa->I64) {
+        PyErr_NoMemory();
+        return -1;
     }
     V = PyMem_Malloc((origDataLength + 1) * sizeof(off_t));
     if (!V) {
-        Py_DECREF(controlTuples);
-        PyMem_Free(I);
-        return PyErr_NoMemory();
+        PyMem_Free(sa->I64);
+        sa->I64 = NULL;
+        PyErr_NoMemory();
+        return -1;
     }
     Py_BEGIN_ALLOW_THREADS  /* release GIL */
-    qsufsort(I, V, (unsigned char *) origData, origDataLength);
+    qsufsort(sa->I64, V, (unsigned char *) origData, origDataLength);
     Py_END_ALLOW_THREADS
     PyMem_Free(V);
+    return 0;
+}
 
-    /* allocate memory for the diff and extra blocks */
-    db = PyMem_Malloc(newDataLength + 1);
-    if (!db) {
-        Py_DECREF(controlTuples);
-        PyMem_Free(I);
-        return PyErr_NoMemory();
+static void free_index(SuffixArray *sa)
+{
+    PyMem_Free(sa->I32);
+    PyMem_Free(sa->I64);
+    sa->I32 = NULL;
+    sa->I64 = NULL;
+}
+
+
+/* the control triples of a patch, in a growing array of 3 * len native
+   8-byte integers (the layout of format.Control), which is allocated with
+   malloc() as it is filled without the GIL
+*/
+typedef struct {
+    long long *v;
+    Py_ssize_t len, alloc;
+} Control;
+
+/* appends the triple (x, y, z); returns 0, or -1 when out of memory */
+static int control_append(Control *ctrl, off_t x, off_t y, off_t z)
+{
+    long long *v;
+
+    if (ctrl->len == ctrl->alloc) {
+        ctrl->alloc = ctrl->alloc ? 2 * ctrl->alloc : 64;
+        v = realloc(ctrl->v, 3 * ctrl->alloc * sizeof(long long));
+        if (!v)
+            return -1;
+        ctrl->v = v;
     }
-    eb = PyMem_Malloc(newDataLength + 1);
-    if (!eb) {
-        Py_DECREF(controlTuples);
-        PyMem_Free(I);
-        PyMem_Free(db);
-        return PyErr_NoMemory();
+    v = ctrl->v + 3 * ctrl->len++;
+    v[0] = x;
+    v[1] = y;
+    v[2] = z;
+    return 0;
+}
+
+/* returns the control triples as bytes, in the layout of Control */
+static PyObject *control_bytes(const Control *ctrl)
+{
+    return PyString_FromStringAndSize((char *) ctrl->v,
+                                      3 * ctrl->len * sizeof(long long));
+}
+
+/* gets the contents of obj, which supports the buffer interface; the
+   buffer must be released with release_buffer() */
+static int get_buffer(PyObject *obj, Py_buffer *view)
+{
+#ifndef IS_PY3K
+    const void *buf;
+
+    /* on Python 2, buffer objects and mmap only have the old interface */
+    if (!PyObject_CheckBuffer(obj)) {
+        if (PyObject_AsReadBuffer(obj, &buf, &view->len) < 0)
+            return -1;
+        view->buf = (void *) buf;
+        view->obj = NULL;
+        return 0;
     }
+#endif
+    return PyObject_GetBuffer(obj, view, PyBUF_SIMPLE);
+}
+
+static void release_buffer(Py_buffer *view)
+{
+    /* does nothing for an old-style buffer, whose obj is NULL */
+    PyBuffer_Release(view);
+}
+
+static int is_buffer(PyObject *obj)
+{
+#ifdef IS_PY3K
+    return PyObject_CheckBuffer(obj);
+#else
+    return PyObject_CheckBuffer(obj) || PyObject_CheckReadBuffer(obj);
+#endif
+}
+
+/* fills ctrl (which is empty) from obj, either an object holding control
+   triples in the layout of Control (bytes, an array('q'), ...) or a
+   sequence of (x, y, z) tuples; returns 0, or -1 with an exception set
+*/
+static int control_from_object(PyObject *obj, Control *ctrl)
+{
+    PyObject *seq, *tuple;
+    Py_buffer view;
+    Py_ssize_t i, n;
+    int k;
+
+    if (is_buffer(obj)) {
+        if (get_buffer(obj, &view) < 0)
+            return -1;
+        if (view.len % (3 * sizeof(long long))) {
+            release_buffer(&view);
+            PyErr_SetString(PyExc_ValueError,
+                            "control triples of 8-byte integers expected");
+            return -1;
+        }
+        n = view.len / (3 * sizeof(long long));
+        ctrl->v = malloc(view.len + 1);
+        if (ctrl->v)
+            memcpy(ctrl->v, view.buf, view.len);
+        release_buffer(&view);
+        if (!ctrl->v) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        ctrl->len = ctrl->alloc = n;
+        return 0;
+    }
+
+    seq = PySequence_Fast(obj, "expecting list of tuples");
+    if (!seq)
+        return -1;
+    n = PySequence_Fast_GET_SIZE(seq);
+    ctrl->v = malloc((3 * n + 1) * sizeof(long long));
+    if (!ctrl->v) {
+        Py_DECREF(seq);
+        PyErr_NoMemory();
+        return -1;
+    }
+    ctrl->len = ctrl->alloc = n;
+    for (i = 0; i < n; i++) {
+        tuple = PySequence_Fast_GET_ITEM(seq, i);
+        if (!PyTuple_Check(tuple)) {
+            PyErr_SetString(PyExc_TypeError, "expecting tuple");
+            goto error;
+        }
+        if (PyTuple_GET_SIZE(tuple) != 3) {
+            PyErr_SetString(PyExc_TypeError, "expecting tuple of size 3");
+            goto error;
+        }
+        for (k = 0; k < 3; k++)
+            ctrl->v[3 * i + k] =
+                PyLong_AsLongLong(PyTuple_GET_ITEM(tuple, k));
+        if (PyErr_Occurred())
+            goto error;
+    }
+    Py_DECREF(seq);
+    return 0;
+
+error:
+    Py_DECREF(seq);
+    free(ctrl->v);
+    ctrl->v = NULL;
+    return -1;
+}
+
+
+/* the scan of bsdiff: finds the matches of the new data in the original
+   data, using its suffix array sa, and fills ctrl and the diff and extra
+   blocks db and eb (newDataLength bytes each); runs without the GIL and
+   returns 0, or -1 when out of memory
+*/
+static int diff_scan(const SuffixArray *sa,
+                     char *origData, off_t origDataLength,
+                     char *newData, off_t newDataLength,
+                     Control *ctrl, unsigned char *db, off_t *dblenp,
+                     unsigned char *eb, off_t *eblenp)
+{
+    off_t lastscan, lastpos, lastoffset, oldscore, scsc, overlap, Ss, lens;
+    off_t dblen, eblen, scan, pos, len, s, Sf, lenf, Sb, lenb, i;
+
     dblen = 0;
     eblen = 0;
 
     /* perform the diff */
     len = 0;
+    pos = 0;
     scan = 0;
     lastscan = 0;
     lastpos = 0;
@@ -260,9 +611,8 @@ static PyObject* diff(PyObject* self, PyObject* args)
     while (scan < newDataLength) {
         oldscore = 0;
 
-        Py_BEGIN_ALLOW_THREADS  /* release GIL */
         for (scsc = scan += len; scan < newDataLength; scan++) {
-            len = search(I, (unsigned char *) origData, origDataLength,
+            len = search(sa, (unsigned char *) origData, origDataLength,
                          (unsigned char *) newData + scan,
                          newDataLength - scan, 0, origDataLength, &pos);
             for (; scsc < scan + len; scsc++)
@@ -275,7 +625,6 @@ static PyObject* diff(PyObject* self, PyObject* args)
                       (origData[scan + lastoffset] == newData[scan]))
                 oldscore--;
         }
-        Py_END_ALLOW_THREADS
 
         if ((len != oldscore) || (scan == newDataLength)) {
             s = 0;
@@ -335,28 +684,10 @@ static PyObject* diff(PyObject* self, PyObject* args)
             dblen += lenf;
             eblen += (scan - lenb) - (lastscan + lenf);
 
-            tuple = PyTuple_New(3);
-            if (!tuple) {
-                Py_DECREF(controlTuples);
-                PyMem_Free(I);
-                PyMem_Free(db);
-                PyMem_Free(eb);
-                return NULL;
-            }
-            PyTuple_SET_ITEM(tuple, 0, PyLong_FromLong(lenf));
-            PyTuple_SET_ITEM(tuple, 1,
-                    PyLong_FromLong((scan - lenb) - (lastscan + lenf)));
-            PyTuple_SET_ITEM(tuple, 2,
-                    PyLong_FromLong((pos - lenb) - (lastpos + lenf)));
-            if (PyList_Append(controlTuples, tuple) < 0) {
-                Py_DECREF(controlTuples);
-                Py_DECREF(tuple);
-                PyMem_Free(I);
-                PyMem_Free(db);
-                PyMem_Free(eb);
-                return NULL;
-            }
-            Py_DECREF(tuple);
+            if (control_append(ctrl, lenf,
+                               (scan - lenb) - (lastscan + lenf),
+                               (pos - lenb) - (lastpos + lenf)) < 0)
+                return -1;
 
             lastscan = scan - lenb;
             lastpos = pos - lenb;
@@ -364,84 +695,307 @@ static PyObject* diff(PyObject* self, PyObject* args)
         }
     }
 
-    PyMem_Free(I);
-    results = PyTuple_New(3);
-    if (!results) {
-        PyMem_Free(db);
-        PyMem_Free(eb);
-        return NULL;
+    *dblenp = dblen;
+    *eblenp = eblen;
+    return 0;
+}
+
+
+/* performs a diff between the two data streams, using the suffix array sa
+   of the original data, and returns a tuple containing the control
+   triples (as bytes in the layout of format.Control), diff and extra
+   blocks that bsdiff produces; the GIL is released for the whole scan
+*/
+static PyObject* diff_index(const SuffixArray *sa,
+                            char *origData, off_t origDataLength,
+                            char *newData, off_t newDataLength)
+{
+    PyObject *results = NULL, *control, *bdiff, *bextra;
+    Control ctrl = {NULL, 0, 0};
+    unsigned char *db, *eb;
+    off_t dblen, eblen;
+    int err;
+
+    /* allocate memory for the diff and extra blocks */
+    db = malloc(newDataLength + 1);
+    eb = malloc(newDataLength + 1);
+    if (!db || !eb) {
+        free(db);
+        free(eb);
+        return PyErr_NoMemory();
     }
-    PyTuple_SET_ITEM(results, 0, controlTuples);
-    temp = PyString_FromStringAndSize((char *) db, dblen);
-    PyMem_Free(db);
-    if (!temp) {
-        PyMem_Free(eb);
-        Py_DECREF(results);
-        return NULL;
+
+    Py_BEGIN_ALLOW_THREADS  /* release GIL */
+    err = diff_scan(sa, origData, origDataLength, newData, newDataLength,
+                    &ctrl, db, &dblen, eb, &eblen);
+    Py_END_ALLOW_THREADS
+
+    if (err < 0) {
+        PyErr_NoMemory();
+        goto done;
     }
-    PyTuple_SET_ITEM(results, 1, temp);
-    temp = PyString_FromStringAndSize((char *) eb, eblen);
-    PyMem_Free(eb);
-    if (!temp) {
-        Py_DECREF(results);
-        return NULL;
+    control = control_bytes(&ctrl);
+    bdiff = PyString_FromStringAndSize((char *) db, dblen);
+    bextra = PyString_FromStringAndSize((char *) eb, eblen);
+    if (control && bdiff && bextra)
+        results = Py_BuildValue("(NNN)", control, bdiff, bextra);
+    else {
+        Py_XDECREF(control);
+        Py_XDECREF(bdiff);
+        Py_XDECREF(bextra);
     }
-    PyTuple_SET_ITEM(results, 2, temp);
 
+done:
+    free(ctrl.v);
+    free(db);
+    free(eb);
     return results;
 }
 
 
-/* takes the original data and the control, diff and extra blocks produced
-   by bsdiff and returns the new data
+/* performs a diff between the two data streams and returns a tuple
+   containing the control, diff and extra blocks that bsdiff produces
 */
-static PyObject* patch(PyObject* self, PyObject* args)
+static PyObject* diff(PyObject* self, PyObject* args)
 {
-    char *origData, *newData, *diffBlock, *extraBlock, *diffPtr, *extraPtr;
-    int origDataLength, newDataLength, diffBlockLength, extraBlockLength;
-    PyObject *controlTuples, *tuple, *results;
-    off_t oldpos, newpos, x, y, z;
-    int i, j, numTuples;
-
-    if (!PyArg_ParseTuple(args, "s#iO!s#s#",
-                          &origData, &origDataLength,
-                          &newDataLength, &PyList_Type, &controlTuples,
-                          &diffBlock, &diffBlockLength, &extraBlock,
-                          &extraBlockLength))
+    PyObject *results = NULL;
+    Py_buffer orig, new;
+    SuffixArray sa;
+
+    if (!PyArg_ParseTuple(args, BUFFER_FORMAT BUFFER_FORMAT ":diff",
+                          &orig, &new))
         return NULL;
 
-    /* allocate the memory for the new data */
-    newData = PyMem_Malloc(newDataLength + 1);
-    if (!newData)
-        return PyErr_NoMemory();
+    /* perform sort on original data */
+    if (build_index(orig.buf, orig.len, &sa, 0) == 0) {
+        results = diff_index(&sa, orig.buf, orig.len, new.buf, new.len);
+        free_index(&sa);
+    }
+    PyBuffer_Release(&orig);
+    PyBuffer_Release(&new);
+    return results;
+}
 
-    oldpos = 0;
-    newpos = 0;
-    diffPtr = diffBlock;
-    extraPtr = extraBlock;
-    numTuples = PyList_GET_SIZE(controlTuples);
-    for (i = 0; i < numTuples; i++) {
-        tuple = PyList_GET_ITEM(controlTuples, i);
-        if (!PyTuple_Check(tuple)) {
-            PyMem_Free(newData);
-            PyErr_SetString(PyExc_TypeError, "expecting tuple");
+
+/* sorts the suffixes of the data with SA-IS or, if use_qsufsort is true,
+   with qsufsort, and returns them as native 8-byte integers, or None if
+   keep is false; used by the tests and the suffix sort benchmark only
+*/
+static PyObject* suffix_sort(PyObject* self, PyObject* args)
+{
+    PyObject *results = NULL;
+    int use_qsufsort = 0, keep = 1;
+    Py_buffer orig;
+    long long *out;
+    SuffixArray sa;
+    off_t i;
+
+    if (!PyArg_ParseTuple(args, BUFFER_FORMAT "|ii:_suffix_sort",
+                          &orig, &use_qsufsort, &keep))
+        return NULL;
+
+    if (build_index(orig.buf, orig.len, &sa, use_qsufsort) < 0)
+        goto done;
+    if (!keep) {
+        Py_INCREF(Py_None);
+        results = Py_None;
+    } else {
+        results = PyString_FromStringAndSize(NULL, (orig.len + 1) *
+                                             sizeof(long long));
+        if (results) {
+            out = (long long *) PyString_AS_STRING(results);
+            for (i = 0; i <= orig.len; i++)
+                out[i] = SA_GET(&sa, i);
+        }
+    }
+    free_index(&sa);
+done:
+    PyBuffer_Release(&orig);
+    return results;
+}
+
+
+/* points sa at the suffix array of n bytes held in buf (as returned by
+   SourceIndex.suffix_array), after checking that every entry is within
+   the data, as the array may come from a file; returns 0, or -1 with an
+   exception set
+*/
+static int use_index(const void *buf, Py_ssize_t len, off_t n,
+                     SuffixArray *sa)
+{
+    off_t i, x;
+
+    sa->I32 = NULL;
+    sa->I64 = NULL;
+    if (n < INT_MAX && len == (n + 1) * (Py_ssize_t) sizeof(int) &&
+            (size_t) buf % sizeof(int) == 0) {
+        sa->I32 = (int *) buf;
+    } else if (len == (n + 1) * (Py_ssize_t) sizeof(off_t) &&
+               (size_t) buf % sizeof(off_t) == 0) {
+        sa->I64 = (off_t *) buf;
+    } else {
+        PyErr_SetString(PyExc_ValueError,
+                        "suffix array does not match the source");
+        return -1;
+    }
+    for (i = 0; i <= n; i++) {
+        x = SA_GET(sa, i);
+        if (x < 0 || x > n) {
+            sa->I32 = NULL;
+            sa->I64 = NULL;
+            PyErr_SetString(PyExc_ValueError, "corrupt suffix array");
+            return -1;
+        }
+    }
+    return 0;
+}
+
+
+/* SourceIndex keeps the original data together with its sorted suffix
+   array, so that it can be diffed against many new data streams while
+   paying for the sort only once.  The array is either built here or
+   taken, without copying, from a buffer such as a memory-mapped file
+*/
+typedef struct {
+    PyObject_HEAD
+    PyObject *src;  /* the object the index was built from */
+    Py_buffer srcview;  /* its contents */
+    SuffixArray sa;
+    PyObject *array;  /* the object holding sa, when it was given */
+    Py_buffer view;
+} SourceIndexObject;
+
+static PyObject *SourceIndex_new(PyTypeObject *type, PyObject *args,
+                                 PyObject *kwds)
+{
+    SourceIndexObject *self;
+    PyObject *src, *array = Py_None;
+
+    if (!PyArg_ParseTuple(args, "O|O:SourceIndex", &src, &array))
+        return NULL;
+
+    self = (SourceIndexObject *) type->tp_alloc(type, 0);
+    if (!self)
+        return NULL;
+    if (get_buffer(src, &self->srcview) < 0) {
+        Py_DECREF(self);
+        return NULL;
+    }
+    Py_INCREF(src);
+    self->src = src;
+    if (array == Py_None) {
+        if (build_index(self->srcview.buf, self->srcview.len,
+                        &self->sa, 0) < 0) {
+            Py_DECREF(self);
             return NULL;
         }
-        if (PyTuple_GET_SIZE(tuple) != 3) {
-            PyMem_Free(newData);
-            PyErr_SetString(PyExc_TypeError, "expecting tuple of size 3");
+    } else {
+        if (get_buffer(array, &self->view) < 0) {
+            Py_DECREF(self);
             return NULL;
         }
-        x = PyLong_AsLong(PyTuple_GET_ITEM(tuple, 0));
-        y = PyLong_AsLong(PyTuple_GET_ITEM(tuple, 1));
-        z = PyLong_AsLong(PyTuple_GET_ITEM(tuple, 2));
-        if (newpos + x > newDataLength ||
-                diffPtr + x > diffBlock + diffBlockLength ||
-                extraPtr + y > extraBlock + extraBlockLength) {
-            PyMem_Free(newData);
-            PyErr_SetString(PyExc_ValueError, "corrupt patch (overflow)");
+        Py_INCREF(array);
+        self->array = array;
+        if (use_index(self->view.buf, self->view.len, self->srcview.len,
+                      &self->sa) < 0) {
+            Py_DECREF(self);
             return NULL;
         }
+    }
+    return (PyObject *) self;
+}
+
+static void SourceIndex_dealloc(SourceIndexObject *self)
+{
+    if (self->array) {
+        release_buffer(&self->view);
+        Py_DECREF(self->array);
+    } else {
+        free_index(&self->sa);
+    }
+    if (self->src) {
+        release_buffer(&self->srcview);
+        Py_DECREF(self->src);
+    }
+    Py_TYPE(self)->tp_free((PyObject *) self);
+}
+
+/* the suffix array as bytes, which SourceIndex(src, array) takes back */
+static PyObject *SourceIndex_suffix_array(SourceIndexObject *self)
+{
+    Py_ssize_t n = self->srcview.len + 1;
+
+    if (self->sa.I32)
+        return PyString_FromStringAndSize((char *) self->sa.I32,
+                                          n * sizeof(int));
+    return PyString_FromStringAndSize((char *) self->sa.I64,
+                                      n * sizeof(off_t));
+}
+
+static PyObject *SourceIndex_diff(SourceIndexObject *self, PyObject *args)
+{
+    PyObject *results;
+    Py_buffer new;
+
+    if (!PyArg_ParseTuple(args, BUFFER_FORMAT ":diff", &new))
+        return NULL;
+
+    results = diff_index(&self->sa, self->srcview.buf, self->srcview.len,
+                         new.buf, new.len);
+    PyBuffer_Release(&new);
+    return results;
+}
+
+static Py_ssize_t SourceIndex_length(SourceIndexObject *self)
+{
+    return self->srcview.len;
+}
+
+static PyMethodDef SourceIndex_methods[] = {
+    {"diff", (PyCFunction) SourceIndex_diff, METH_VARARGS,
+     "diff(dst_bytes) -> (control, diff block, extra block)"},
+    {"suffix_array", (PyCFunction) SourceIndex_suffix_array, METH_NOARGS,
+     "suffix_array() -> the sorted suffixes, as native 4 or 8-byte integers"},
+    {NULL, NULL, 0, NULL}  /* Sentinel */
+};
+
+static PySequenceMethods SourceIndex_as_sequence = {
+    (lenfunc) SourceIndex_length,  /* sq_length */
+};
+
+static PyTypeObject SourceIndex_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "bsdiff4.core.SourceIndex",     /* tp_name */
+    sizeof(SourceIndexObject),      /* tp_basicsize */
+};
+
+
+/* applies the control triples, diff and extra blocks to the original data,
+   writing the new data; runs without the GIL and returns 0, or -1 when
+   the patch does not fit the blocks and newDataLength (1 for overflow, 2
+   for underflow in *what)
+*/
+static int patch_apply(const Control *ctrl,
+                       char *origData, off_t origDataLength,
+                       char *newData, off_t newDataLength,
+                       char *diffBlock, off_t diffBlockLength,
+                       char *extraBlock, off_t extraBlockLength, int *what)
+{
+    char *diffPtr = diffBlock, *extraPtr = extraBlock;
+    off_t oldpos = 0, newpos = 0, x, y, z, j;
+    Py_ssize_t i;
+
+    for (i = 0; i < ctrl->len; i++) {
+        x = ctrl->v[3 * i];
+        y = ctrl->v[3 * i + 1];
+        z = ctrl->v[3 * i + 2];
+        if (x < 0 || y < 0 ||
+                newpos + x + y > newDataLength ||
+                x > diffBlock + diffBlockLength - diffPtr ||
+                y > extraBlock + extraBlockLength - extraPtr) {
+            *what = 1;
+            return -1;
+        }
         memcpy(newData + newpos, diffPtr, x);
         diffPtr += x;
         for (j = 0; j < x; j++)
@@ -459,27 +1013,72 @@ static PyObject* patch(PyObject* self, PyObject* args)
     if (newpos != newDataLength ||
             diffPtr != diffBlock + diffBlockLength ||
             extraPtr != extraBlock + extraBlockLength) {
-        PyMem_Free(newData);
-        PyErr_SetString(PyExc_ValueError, "corrupt patch (underflow)");
+        *what = 2;
+        return -1;
+    }
+    return 0;
+}
+
+
+/* takes the original data and the control, diff and extra blocks produced
+   by bsdiff and returns the new data; the control triples may be given as
+   a list of tuples or in the layout of format.Control, they are read
+   first, so that the GIL is released for the whole reconstruction
+*/
+static PyObject* patch(PyObject* self, PyObject* args)
+{
+    PyObject *control, *results = NULL;
+    Py_buffer orig, diffBlock, extraBlock;
+    Py_ssize_t newDataLength;
+    Control ctrl = {NULL, 0, 0};
+    int err, what = 0;
+
+    if (!PyArg_ParseTuple(args, BUFFER_FORMAT "nO" BUFFER_FORMAT
+                          BUFFER_FORMAT ":patch", &orig, &newDataLength,
+                          &control, &diffBlock, &extraBlock))
         return NULL;
+
+    if (newDataLength < 0) {
+        PyErr_SetString(PyExc_ValueError, "corrupt patch (overflow)");
+        goto done;
     }
+    if (control_from_object(control, &ctrl) < 0)
+        goto done;
+
+    /* the new data is written straight into the bytes object returned */
+    results = PyString_FromStringAndSize(NULL, newDataLength);
+    if (!results)
+        goto done;
+
+    Py_BEGIN_ALLOW_THREADS  /* release GIL */
+    err = patch_apply(&ctrl, orig.buf, orig.len,
+                      PyString_AS_STRING(results), newDataLength,
+                      diffBlock.buf, diffBlock.len,
+                      extraBlock.buf, extraBlock.len, &what);
+    Py_END_ALLOW_THREADS
 
-    results = PyString_FromStringAndSize(newData, newDataLength);
-    PyMem_Free(newData);
+    if (err < 0) {
+        Py_CLEAR(results);
+        PyErr_SetString(PyExc_ValueError, what == 1 ?
+                        "corrupt patch (overflow)" :
+                        "corrupt patch (underflow)");
+    }
+done:
+    free(ctrl.v);
+    PyBuffer_Release(&orig);
+    PyBuffer_Release(&diffBlock);
+    PyBuffer_Release(&extraBlock);
     return results;
 }
 
 
-/* encode an integer value as a string of 8 bytes */
-static PyObject *encode_int64(PyObject *self, PyObject *value)
+/* the 8-byte format of the patch headers and control block: little
+   endian magnitude, with the sign in the top bit */
+static void put_int64(char *bs, long long x)
 {
-    long long x;
-    char bs[8], sign = 0x00;
+    char sign = 0x00;
     int i;
 
-    if (!PyArg_Parse(value, "L", &x))
-        return NULL;
-
     if (x < 0) {
         x = -x;
         sign = 0x80;
@@ -489,6 +1088,33 @@ static PyObject *encode_int64(PyObject *self, PyObject *value)
         x >>= 8;  /* x /= 256 */
     }
     bs[7] |= sign;
+}
+
+static long long get_int64(const char *bs)
+{
+    long long x;
+    int i;
+
+    x = bs[7] & 0x7F;
+    for (i = 6; i >= 0; i--) {
+        x <<= 8;  /* x = x * 256 + (unsigned char) bs[i]; */
+        x |= (unsigned char) bs[i];
+    }
+    if (bs[7] & 0x80)
+        x = -x;
+    return x;
+}
+
+
+/* encode an integer value as a string of 8 bytes */
+static PyObject *encode_int64(PyObject *self, PyObject *value)
+{
+    long long x;
+    char bs[8];
+
+    if (!PyArg_Parse(value, "L", &x))
+        return NULL;
+    put_int64(bs, x);
     return PyString_FromStringAndSize(bs, 8);
 }
 
@@ -496,10 +1122,6 @@ static PyObject *encode_int64(PyObject *self, PyObject *value)
 /* decode an off_t value from an 8 byte string */
 static PyObject *decode_int64(PyObject *self, PyObject *string)
 {
-    long long x;
-    char *bs;
-    int i;
-
     if (!PyString_Check(string)) {
         PyErr_SetString(PyExc_TypeError, "string expected");
         return NULL;
@@ -508,16 +1130,181 @@ static PyObject *decode_int64(PyObject *self, PyObject *string)
         PyErr_SetString(PyExc_ValueError, "8 bytes expected");
         return NULL;
     }
-    bs = PyString_AsString(string);
+    return PyLong_FromLongLong(get_int64(PyString_AsString(string)));
+}
 
-    x = bs[7] & 0x7F;
-    for (i = 6; i >= 0; i--) {
-        x <<= 8;  /* x = x * 256 + (unsigned char) bs[i]; */
-        x |= (unsigned char) bs[i];
+
+/* encode control triples (given as for patch) into the control block of
+   a patch, 24 bytes per triple */
+static PyObject *encode_control(PyObject *self, PyObject *control)
+{
+    Control ctrl = {NULL, 0, 0};
+    PyObject *results;
+    Py_ssize_t i;
+    char *bs;
+
+    if (control_from_object(control, &ctrl) < 0)
+        return NULL;
+    results = PyString_FromStringAndSize(NULL, 3 * 8 * ctrl.len);
+    if (results) {
+        bs = PyString_AS_STRING(results);
+        for (i = 0; i < 3 * ctrl.len; i++)
+            put_int64(bs + 8 * i, ctrl.v[i]);
     }
-    if (bs[7] & 0x80)
-        x = -x;
-    return PyLong_FromLongLong(x);
+    free(ctrl.v);
+    return results;
+}
+
+
+/* decode a control block into bytes in the layout of format.Control */
+static PyObject *decode_control(PyObject *self, PyObject *block)
+{
+    PyObject *results;
+    Py_buffer view;
+    Py_ssize_t i, n;
+    long long *v;
+
+    if (get_buffer(block, &view) < 0)
+        return NULL;
+    if (view.len % 24) {
+        release_buffer(&view);
+        PyErr_SetString(PyExc_ValueError, "corrupt patch (control block)");
+        return NULL;
+    }
+    n = view.len / 8;
+    results = PyString_FromStringAndSize(NULL, n * sizeof(long long));
+    if (results) {
+        v = (long long *) PyString_AS_STRING(results);
+        for (i = 0; i < n; i++)
+            v[i] = get_int64((char *) view.buf + 8 * i);
+    }
+    release_buffer(&view);
+    return results;
+}
+
+
+/* the table of the gear hash of sketch(), filled by init_gear() */
+static unsigned long long gear[256];
+
+#define FNV_OFFSET  0xcbf29ce484222325ULL
+#define FNV_PRIME   0x100000001b3ULL
+
+/* fills the gear table with splitmix64 values: any random table does, but
+   it must never change, or sketches of the same data would not match */
+static void init_gear(void)
+{
+    unsigned long long x = 0, z;
+    int i;
+
+    for (i = 0; i < 256; i++) {
+        z = (x += 0x9e3779b97f4a7c15ULL);
+        z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+        z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+        gear[i] = z ^ (z >> 31);
+    }
+}
+
+/* adds h to heap, a max-heap of the n (at most k) smallest distinct
+   values so far */
+static void heap_add(unsigned long long *heap, Py_ssize_t *n, Py_ssize_t k,
+                     unsigned long long h)
+{
+    Py_ssize_t i, child;
+
+    if (*n == k && h >= heap[0])
+        return;
+    for (i = 0; i < *n; i++)
+        if (heap[i] == h)
+            return;
+    if (*n < k) {
+        for (i = (*n)++; i > 0 && heap[(i - 1) / 2] < h; i = (i - 1) / 2)
+            heap[i] = heap[(i - 1) / 2];
+    }
+    else {
+        for (i = 0; (child = 2 * i + 1) < k; i = child) {
+            if (child + 1 < k && heap[child + 1] > heap[child])
+                child++;
+            if (heap[child] <= h)
+                break;
+            heap[i] = heap[child];
+        }
+    }
+    heap[i] = h;
+}
+
+static int compare_hashes(const void *a, const void *b)
+{
+    unsigned long long x = *(const unsigned long long *) a;
+    unsigned long long y = *(const unsigned long long *) b;
+
+    return (x > y) - (x < y);
+}
+
+/* sketch(data, k, bits, min_size, max_size) -> list of the k smallest
+   distinct chunk hashes of data, in increasing order (a bottom-k MinHash
+   sketch)
+
+   The chunks are content-defined: a gear hash, which after each byte
+   depends on the last 64 bytes only, ends a chunk where its top bits
+   (bits of them) are all zero, so chunks are min_size + 2 ** bits bytes
+   on average and never longer than max_size.  An edit only changes the
+   chunks around it, whatever the data (text included), and two sketches
+   share about as many hashes as their data shares chunks.  Each chunk is
+   hashed with 64-bit FNV-1a.
+*/
+static PyObject *sketch(PyObject *self, PyObject *args)
+{
+    PyObject *results = NULL, *value;
+    Py_buffer data;
+    Py_ssize_t k, min_size, max_size, n = 0, i, start = 0;
+    unsigned long long *heap, h = 0, fnv = FNV_OFFSET;
+    const unsigned char *p;
+    int bits;
+
+    if (!PyArg_ParseTuple(args, BUFFER_FORMAT "ninn:sketch", &data, &k,
+                          &bits, &min_size, &max_size))
+        return NULL;
+    if (k < 1 || bits < 1 || bits > 63 || min_size < 1 ||
+            max_size < min_size) {
+        PyBuffer_Release(&data);
+        PyErr_SetString(PyExc_ValueError, "invalid sketch parameters");
+        return NULL;
+    }
+    heap = (unsigned long long *) malloc(k * sizeof(unsigned long long));
+    if (heap == NULL) {
+        PyBuffer_Release(&data);
+        return PyErr_NoMemory();
+    }
+
+    p = (const unsigned char *) data.buf;
+    Py_BEGIN_ALLOW_THREADS  /* release GIL */
+    for (i = 0; i < data.len; i++) {
+        h = (h << 1) + gear[p[i]];
+        fnv = (fnv ^ p[i]) * FNV_PRIME;
+        if ((i + 1 - start >= min_size && (h >> (64 - bits)) == 0) ||
+                i + 1 - start >= max_size) {
+            heap_add(heap, &n, k, fnv);
+            fnv = FNV_OFFSET;
+            start = i + 1;
+        }
+    }
+    if (start < data.len)
+        heap_add(heap, &n, k, fnv);
+    qsort(heap, n, sizeof(unsigned long long), compare_hashes);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&data);
+
+    results = PyList_New(n);
+    for (i = 0; results && i < n; i++) {
+        value = PyLong_FromUnsignedLongLong(heap[i]);
+        if (value == NULL) {
+            Py_CLEAR(results);
+            break;
+        }
+        PyList_SET_ITEM(results, i, value);
+    }
+    free(heap);
+    return results;
 }
 
 
@@ -527,9 +1314,31 @@ static PyMethodDef module_functions[] = {
     {"patch", patch, METH_VARARGS},
     {"encode_int64", encode_int64, METH_O},
     {"decode_int64", decode_int64, METH_O},
+    {"encode_control", encode_control, METH_O},
+    {"decode_control", decode_control, METH_O},
+    {"sketch", sketch, METH_VARARGS},
+    {"_suffix_sort", suffix_sort, METH_VARARGS},
     {NULL, NULL, 0, NULL}  /* Sentinel */
 };
 
+/* fills in and readies the SourceIndex type, and adds it to module m */
+static int add_types(PyObject *m)
+{
+    SourceIndex_Type.tp_dealloc = (destructor) SourceIndex_dealloc;
+    SourceIndex_Type.tp_as_sequence = &SourceIndex_as_sequence;
+    SourceIndex_Type.tp_flags = Py_TPFLAGS_DEFAULT;
+    SourceIndex_Type.tp_doc = "SourceIndex(src_bytes, suffix_array=None) -> "
+        "suffix-sorted src_bytes";
+    SourceIndex_Type.tp_methods = SourceIndex_methods;
+    SourceIndex_Type.tp_new = SourceIndex_new;
+    if (PyType_Ready(&SourceIndex_Type) < 0)
+        return -1;
+
+    Py_INCREF(&SourceIndex_Type);
+    return PyModule_AddObject(m, "SourceIndex",
+                              (PyObject *) &SourceIndex_Type);
+}
+
 /* initialization routine for the shared libary */
 #ifdef IS_PY3K
 static PyModuleDef moduledef = {
@@ -541,15 +1350,26 @@ PyInit_core(void)
 {
     PyObject *m;
 
+    init_gear();
     m = PyModule_Create(&moduledef);
     if (m == NULL)
         return NULL;
+    if (add_types(m) < 0) {
+        Py_DECREF(m);
+        return NULL;
+    }
     return m;
 }
 #else
 PyMODINIT_FUNC
 initcore(void)
 {
-    Py_InitModule("core", module_functions);
+    PyObject *m;
+
+    init_gear();
+    m = Py_InitModule("core", module_functions);
+    if (m == NULL)
+        return;
+    add_types(m);
 }
 #endif
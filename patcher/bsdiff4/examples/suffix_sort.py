@@ -0,0 +1,77 @@
+"""
+Compare the suffix sorts of bsdiff4.core on real files, typically the
+native libraries of an APK:
+
+    python suffix_sort.py lib/arm64-v8a/*.so
+
+For each file, both SA-IS (what diff() uses) and the former qsufsort are
+run in a fresh process, which reports the sort time and how much the peak
+RSS grew during the sort.  The two suffix arrays are checked to be equal.
+"""
+import os
+import sys
+import time
+import multiprocessing
+
+from bsdiff4 import core
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+def sort_child(path, use_qsufsort, queue):
+    data = open(path, 'rb').read()
+    before = peak_rss()
+    t0 = time.time()
+    core._suffix_sort(data, use_qsufsort, False)
+    queue.put((time.time() - t0, peak_rss() - before))
+
+
+def measure(path, use_qsufsort):
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=sort_child,
+                                args=(path, use_qsufsort, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit('usage: %s FILE...' % sys.argv[0])
+
+    print('%-40s %10s %18s %18s %7s' % ('file', 'size', 'qsufsort',
+                                         'SA-IS', 'speedup'))
+    total = [0.0, 0.0]
+    for path in sys.argv[1:]:
+        data = open(path, 'rb').read()
+        if core._suffix_sort(data) != core._suffix_sort(data, True):
+            sys.exit('%s: the suffix arrays differ' % path)
+        del data
+
+        q_time, q_mem = measure(path, True)
+        s_time, s_mem = measure(path, False)
+        total[0] += q_time
+        total[1] += s_time
+        size = os.path.getsize(path)
+        print('%-40s %10d %7.3fs %7.1fMB %7.3fs %7.1fMB %6.2fx' % (
+            path[-40:], size, q_time, q_mem / 1e6, s_time, s_mem / 1e6,
+            q_time / max(s_time, 1e-9)))
+
+    print('total: qsufsort %.3fs, SA-IS %.3fs' % tuple(total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,884 @@
+#!/usr/bin/python
+
+import sys, os, re, time, json, random, shutil, struct, tempfile, threading, unittest, zipfile, zlib
+import bsdiff4, apkzip, elfinfo, patchcache
+
+
+'''
+ Tests of apk-diff.py and the modules it uses
+
+ Run from this directory, with bsdiff4 importable:
+
+	python test_apk.py
+'''
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def load_script(name, filename):
+	# the scripts have dashes in their names, so they are loaded by path
+	if sys.version_info[0] >= 3:
+		import importlib.util
+		spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, filename))
+		module = importlib.util.module_from_spec(spec)
+		sys.modules[name] = module
+		spec.loader.exec_module(module)
+		return module
+	import imp
+	return imp.load_source(name, os.path.join(HERE, filename))
+
+apk_diff = load_script('apk_diff', 'apk-diff.py')
+apk_patch = load_script('apk_patch', 'apk-patch.py')
+
+# what apkzip returns for a STORED entry
+if sys.version_info[0] >= 3:
+	view = memoryview
+else:
+	view = buffer
+
+
+def random_text(rnd, n_words):
+	# ASCII text from a small vocabulary, like the assets of an app
+	words = [''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rnd.randint(2, 10)))
+			 for _ in range(2000)]
+	return ' '.join(rnd.choice(words) for _ in range(n_words)).encode('ascii')
+
+
+class TestSketch(unittest.TestCase):
+
+	def similarity(self, a, b):
+		return apk_diff.sketch_similarity(apk_diff.sketch(a), apk_diff.sketch(b))
+
+	def test_text_edit(self):
+		rnd = random.Random(1)
+		text = random_text(rnd, 60000)
+		edited = text[:200000] + b'EDITED!' + text[200007:]
+		self.assertGreater(self.similarity(text, edited), 0.9)
+		inserted = text[:1000] + random_text(rnd, 50) + text[1000:]
+		self.assertGreater(self.similarity(text, inserted), 0.9)
+
+	def test_small_text_edit(self):
+		rnd = random.Random(2)
+		text = random_text(rnd, 2000)
+		edited = text[:5000] + b'#' + text[5001:]
+		self.assertGreater(self.similarity(text, edited), 0.8)
+
+	def test_unrelated(self):
+		rnd = random.Random(3)
+		self.assertLess(self.similarity(random_text(rnd, 20000), random_text(rnd, 20000)), 0.1)
+		a = bytes(bytearray(rnd.getrandbits(8) for _ in range(50000)))
+		self.assertEqual(self.similarity(a, a), 1.0)
+		self.assertEqual(self.similarity(a, a[::-1]), 0.0)
+
+	def test_buffers(self):
+		rnd = random.Random(4)
+		data = random_text(rnd, 5000)
+		sk = apk_diff.sketch(data)
+		self.assertEqual(len(sk), apk_diff.SKETCH_SIZE)
+		self.assertEqual(sk, sorted(set(sk)))
+		self.assertEqual(apk_diff.sketch(memoryview(data)), sk)
+		self.assertEqual(apk_diff.sketch(bytearray(data)), sk)
+		self.assertEqual(apk_diff.sketch(b''), [])
+		self.assertEqual(apk_diff.sketch_similarity([], []), 0.0)
+
+
+class TestPatchCache(unittest.TestCase):
+
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+		self.cache = patchcache.PatchCache(self.path)
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def put_aged(self, key, size, age):
+		# a size entry of size bytes last used age seconds ago
+		self.cache.store('size', key, lambda f: f.write(b'1' * size))
+		then = time.time() - age
+		os.utime(self.cache.filename('size', key), (then, then))
+
+	def cached_keys(self):
+		return sorted(name for root, dirs, names in os.walk(self.path) for name in names)
+
+	def test_patch_and_size(self):
+		key = self.cache.key('a', 'b', 'codec=bz2')
+		self.assertNotEqual(key, self.cache.key('a', 'b', 'codec=lzma'))
+		self.assertNotEqual(self.cache.key('ab', 'c'), self.cache.key('a', 'bc'))
+		version = patchcache.CACHE_VERSION
+		try:
+			patchcache.CACHE_VERSION += 1
+			self.assertNotEqual(key, self.cache.key('a', 'b', 'codec=bz2'))
+		finally:
+			patchcache.CACHE_VERSION = version
+		out = os.path.join(self.path, 'out')
+		self.assertFalse(self.cache.get_patch(key, out))
+		self.assertFalse(os.path.exists(out))
+		src = os.path.join(self.path, 'src')
+		with open(src, 'wb') as f:
+			f.write(b'patch data')
+		self.cache.put_patch(key, src)
+		self.assertTrue(self.cache.get_patch(key, out))
+		with open(out, 'rb') as f:
+			self.assertEqual(f.read(), b'patch data')
+
+		self.assertEqual(self.cache.get_size(key), None)
+		self.cache.put_size(key, 1234)
+		self.assertEqual(self.cache.get_size(key), 1234)
+		self.cache.put_size(key, 99)
+		self.assertEqual(self.cache.get_size(key), 99)
+
+	def test_evict_lru(self):
+		for i, key in enumerate(['aa1', 'bb2', 'cc3', 'dd4']):
+			self.put_aged(key, 1000, 400 - 100 * i)
+		self.assertEqual(self.cache.evict(), 0) # no limit
+		self.assertEqual(self.cache.evict(2500), 2000)
+		self.assertEqual(self.cached_keys(), ['cc3', 'dd4'])
+		self.assertEqual(self.cache.evict(2000), 0)
+		self.cache.max_size = 0
+		self.assertEqual(self.cache.evict(), 2000)
+		self.assertEqual(self.cached_keys(), [])
+
+	def test_read_refreshes(self):
+		self.put_aged('aa1', 1000, 300)
+		self.put_aged('bb2', 1000, 200)
+		# reading the oldest makes it the most recently used
+		self.assertTrue(self.cache.get_size('aa1'))
+		self.assertEqual(self.cache.evict(1000), 1000)
+		self.assertEqual(self.cached_keys(), ['aa1'])
+
+	def test_stale_temp(self):
+		self.put_aged('aa1', 10, 0)
+		dirname = os.path.dirname(self.cache.filename('size', 'aa1'))
+		for name, age in [('stale', patchcache.STALE_TEMP_SECONDS + 60), ('live', 0)]:
+			path = os.path.join(dirname, patchcache.TEMP_PREFIX + name)
+			with open(path, 'wb') as f:
+				f.write(b'x' * 100000)
+			then = time.time() - age
+			os.utime(path, (then, then))
+		# temporary files are never counted nor evicted, only cleared once stale
+		self.assertEqual(self.cache.evict(10), 0)
+		self.assertEqual(self.cached_keys(), [patchcache.TEMP_PREFIX + 'live', 'aa1'])
+
+	def test_failed_store(self):
+		def write(f):
+			f.write(b'partial')
+			raise IOError('disk full')
+		self.assertRaises(IOError, self.cache.store, 'patch', 'aa1', write)
+		self.assertEqual(self.cached_keys(), [])
+
+	def test_concurrent_store(self):
+		# writers of the same key never leave a mix of their data behind
+		datas = [bytes(bytearray([i])) * 100000 for i in range(8)]
+		def store(data):
+			def write(f):
+				for i in range(0, len(data), 1000):
+					f.write(data[i:i + 1000])
+			for _ in range(5):
+				self.cache.store('patch', 'aa1', write)
+		threads = [threading.Thread(target=store, args=(data,)) for data in datas]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		with open(self.cache.filename('patch', 'aa1'), 'rb') as f:
+			self.assertIn(f.read(), datas)
+		self.assertEqual(self.cached_keys(), ['aa1'])
+
+	def test_index(self):
+		rnd = random.Random(5)
+		src = random_text(rnd, 5000)
+		dst = src[:3000] + b'new' + src[3000:]
+		src_hash = patchcache.content_hash(src)
+		self.assertEqual(self.cache.get_index(src_hash, src), None)
+		self.cache.put_index(src_hash, bsdiff4.SourceIndex(src))
+		index = self.cache.get_index(src_hash, src)
+		self.assertEqual(len(index), len(src))
+		self.assertEqual(bsdiff4.diff(index, dst), bsdiff4.diff(src, dst))
+		# an index file of another source is a miss
+		self.assertEqual(self.cache.get_index(src_hash, src[:-1]), None)
+
+	def test_content_hash(self):
+		data = random_text(random.Random(6), 1000)
+		self.assertEqual(patchcache.content_hash_iter([data[:10], data[10:], b'']),
+						 patchcache.content_hash(data))
+		self.assertEqual(patchcache.content_hash(memoryview(data)),
+						 patchcache.content_hash(data))
+
+
+def elf_library(machine=183, bits=64, order='<', soname='libfoo.so', build_id=None,
+				symbols=(), undefined=(), text=b''):
+	'''
+	A small shared library: an ELF header, the sections .note.gnu.build-id
+	(if build_id), .dynstr, .dynsym (symbols defined in .text, a local
+	symbol and the undefined ones), .dynamic (DT_SONAME if soname), .text
+	and .shstrtab, then the section headers.
+	'''
+	w = 'I' if bits == 32 else 'Q'
+	dynstr = bytearray(b'\0')
+	def add_string(table, name):
+		table += name.encode('ascii') + b'\0'
+		return len(table) - len(name) - 1
+
+	sym = struct.Struct(order + ('IIIBBH' if bits == 32 else 'IBBHQQ'))
+	def symbol(name, info, shndx):
+		if bits == 32:
+			return sym.pack(add_string(dynstr, name), 0, 0, info, 0, shndx)
+		return sym.pack(add_string(dynstr, name), info, 0, shndx, 0, 0)
+	text_index = 5 if build_id else 4
+	dynsym = sym.pack(*([0] * 6))
+	dynsym += b''.join(symbol(name, 0x12, text_index) for name in symbols)
+	dynsym += symbol('local_helper', 0x02, text_index)
+	dynsym += b''.join(symbol(name, 0x12, 0) for name in undefined)
+	dyn = struct.Struct(order + ('iI' if bits == 32 else 'qQ'))
+	dynamic = dyn.pack(14, add_string(dynstr, soname)) if soname else b''
+	dynamic += dyn.pack(0, 0)
+
+	# (name, type, flags, data, link, entsize)
+	sections = []
+	if build_id:
+		sections.append(('.note.gnu.build-id', 7, 2, struct.pack(order + 'III', 4, len(build_id), 3) +
+						 b'GNU\0' + build_id, 0, 0))
+	dynstr_index = len(sections) + 1
+	sections += [('.dynstr', 3, 2, bytes(dynstr), 0, 0),
+				 ('.dynsym', 11, 2, dynsym, dynstr_index, sym.size),
+				 ('.dynamic', 6, 3, dynamic, dynstr_index, dyn.size),
+				 ('.text', 1, 6, text, 0, 0)]
+	shstrtab = bytearray(b'\0')
+	names = [add_string(shstrtab, name) for name, _, _, _, _, _ in sections]
+	names.append(add_string(shstrtab, '.shstrtab'))
+	sections.append(('.shstrtab', 3, 0, bytes(shstrtab), 0, 0))
+
+	ehsize = 52 if bits == 32 else 64
+	header = struct.Struct(order + 'HHI3%sIHHHHHH' % w)
+	section = struct.Struct(order + ('IIIIIIIIII' if bits == 32 else 'IIQQQQIIQQ'))
+	body = bytearray()
+	table = [section.pack(*([0] * 10))]
+	for name, (_, sh_type, flags, data, link, entsize) in zip(names, sections):
+		offset = ehsize + len(body)
+		table.append(section.pack(name, sh_type, flags, offset, offset, len(data),
+								  link, 0, 1, entsize))
+		body += data
+	shoff = ehsize + len(body)
+	ident = b'\x7fELF' + struct.pack('BBB', 1 if bits == 32 else 2, 1 if order == '<' else 2, 1)
+	return (ident + b'\0' * 9 +
+			header.pack(3, machine, 1, 0, 0, shoff, 0, ehsize, 0, 0, section.size,
+						len(table), len(table) - 1) +
+			bytes(body) + b''.join(table))
+
+def crc32(name):
+	return zlib.crc32(name.encode('ascii')) & 0xffffffff
+
+
+class TestElfInfo(unittest.TestCase):
+
+	def test_fingerprint(self):
+		for machine, bits, order in [(183, 64, '<'), (40, 32, '<'), (8, 32, '>')]:
+			data = elf_library(machine, bits, order, 'libfoo.so', b'\x12\x34' * 10,
+							   ['foo_init', 'foo_run'], ['malloc'], b'\x90' * 1000)
+			fp = elfinfo.fingerprint(data)
+			self.assertEqual((fp.machine, fp.bits), (machine, bits))
+			self.assertEqual(fp.soname, 'libfoo.so')
+			self.assertEqual(fp.build_id, b'\x12\x34' * 10)
+			# the defined global symbols only
+			self.assertEqual(fp.symbols, frozenset([crc32('foo_init'), crc32('foo_run')]))
+			sections = dict(fp.sections)
+			self.assertEqual(sorted(sections), ['.dynamic', '.dynstr', '.dynsym',
+												'.note.gnu.build-id', '.text'])
+			self.assertEqual(sections['.text'], 1000)
+			self.assertEqual(elfinfo.fingerprint(view(data)), fp)
+
+	def test_missing(self):
+		fp = elfinfo.fingerprint(elf_library(soname=None, symbols=['foo']))
+		self.assertEqual((fp.soname, fp.build_id), (None, None))
+		self.assertEqual(fp.symbols, frozenset([crc32('foo')]))
+		self.assertEqual(elfinfo.fingerprint(b'not an ELF file at all'), None)
+		self.assertEqual(elfinfo.fingerprint(b'\x7fELF\x03\x01' + b'\0' * 60), None)
+		self.assertEqual(elfinfo.fingerprint(b'\x7fELF\x02\x01'), None)
+		# a truncated library keeps its header, and nothing else
+		data = elf_library(soname='libfoo.so', symbols=['foo'], text=b'\0' * 1000)
+		fp = elfinfo.fingerprint(data[:500])
+		self.assertEqual((fp.machine, fp.bits, fp.soname, fp.sections, fp.symbols),
+						 (183, 64, None, (), frozenset()))
+
+	def test_similarity(self):
+		symbols = ['sym%d' % i for i in range(20)]
+		old = elfinfo.fingerprint(elf_library(soname='libfoo.so', build_id=b'1' * 20,
+											  symbols=symbols, text=b'\0' * 1000))
+		rebuilt = elfinfo.fingerprint(elf_library(soname='libfoo.so', build_id=b'1' * 20))
+		self.assertEqual(elfinfo.similarity(old, rebuilt), 1.0)
+		# another build of the same code, renamed and with a symbol more
+		new = elfinfo.fingerprint(elf_library(soname='libfoo2.so', build_id=b'2' * 20,
+											  symbols=symbols + ['extra'], text=b'\0' * 1100))
+		self.assertTrue(0.7 < elfinfo.similarity(old, new) < 0.8)
+		self.assertTrue(elfinfo.related(old, new))
+		same_name = elfinfo.fingerprint(elf_library(soname='libfoo.so', symbols=['other']))
+		self.assertTrue(elfinfo.related(old, same_name))
+		other = elfinfo.fingerprint(elf_library(soname='libbar.so', build_id=b'3' * 20,
+												symbols=['bar%d' % i for i in range(20)],
+												text=b'\0' * 50000))
+		self.assertFalse(elfinfo.related(old, other))
+		self.assertLess(elfinfo.similarity(old, other), elfinfo.similarity(old, new))
+		self.assertEqual(elfinfo.jaccard(frozenset(), frozenset()), 0.0)
+		self.assertEqual(elfinfo.layout_similarity((), ()), 0.0)
+
+
+class ApkTestCase(unittest.TestCase):
+	# writes APKs into a temporary directory and runs apk-diff.py stages
+	# on them inline, with their chatter on stdout silenced
+
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+		apk_diff.g_trial_diffs = 3
+		self.stdout = sys.stdout
+		sys.stdout = open(os.devnull, 'w')
+
+	def tearDown(self):
+		sys.stdout.close()
+		sys.stdout = self.stdout
+		shutil.rmtree(self.path)
+
+	def write_apk(self, name, entries, compression=zipfile.ZIP_STORED):
+		# entries are (name, data) or (name, data, compression)
+		path = os.path.join(self.path, name)
+		z = zipfile.ZipFile(path, 'w', compression)
+		for entry in entries:
+			z.writestr(*entry)
+		z.close()
+		return apkzip.MappedZipReader(path)
+
+	def run_stage(self, stage, old, new, names, compression=zipfile.ZIP_STORED):
+		# stage(engine, a_files, b_files, names) on the APKs old and new
+		a_zip = self.write_apk('A.apk', old, compression)
+		b_zip = self.write_apk('B.apk', new, compression)
+		engine = apk_diff.DiffEngine([a_zip], b_zip)
+		try:
+			return stage(engine, apk_diff.Manifest(a_zip), apk_diff.Manifest(b_zip), names)
+		finally:
+			engine.close()
+
+
+	def diff_apks(self, *args):
+		# run apk-diff.py with the command line args in the temporary
+		# directory, which is where it writes its patches
+		cwd, argv = os.getcwd(), sys.argv
+		os.chdir(self.path)
+		sys.argv = ['apk-diff.py'] + list(args)
+		try:
+			apk_diff.main()
+		finally:
+			os.chdir(cwd)
+			sys.argv = argv
+
+	def toc_ops(self, patch):
+		z = zipfile.ZipFile(os.path.join(self.path, patch))
+		toc = z.read('TOC.txt').decode('utf-8').splitlines()
+		z.close()
+		return set(line[0] for line in toc if line and not line.startswith('sha1 '))
+
+	def assertPatches(self, old, patch, new):
+		# apply patch to the APK old and check that it gives the entries of
+		# the APK new, with their compression, and STORED data 4-aligned
+		out = os.path.join(self.path, 'out.apk')
+		apk_patch.apply_patch(os.path.join(self.path, old),
+							  out, os.path.join(self.path, patch))
+		expected = zipfile.ZipFile(os.path.join(self.path, new))
+		result = zipfile.ZipFile(out)
+		self.assertEqual(sorted(result.namelist()), sorted(expected.namelist()))
+		for info in expected.infolist():
+			self.assertEqual(result.read(info.filename), expected.read(info), info.filename)
+		expected.close()
+		result.close()
+		reader = apkzip.MappedZipReader(out)
+		for info in reader.infolist():
+			if info.compress_type == zipfile.ZIP_STORED:
+				self.assertEqual(reader.data_offset(info) % 4, 0, info.filename)
+		reader.close()
+		return out
+
+
+class TestMappedZipReader(ApkTestCase):
+
+	def setUp(self):
+		ApkTestCase.setUp(self)
+		rnd = random.Random(15)
+		self.entries = [('stored.bin', bytes(bytearray(rnd.getrandbits(8) for _ in range(5000)))),
+						('deflated.txt', random_text(rnd, 50000), zipfile.ZIP_DEFLATED),
+						('empty', b''),
+						('empty-deflated', b'', zipfile.ZIP_DEFLATED)]
+		self.reader = self.write_apk('A.apk', self.entries)
+
+	def tearDown(self):
+		self.reader.close()
+		ApkTestCase.tearDown(self)
+
+	def test_read(self):
+		z = zipfile.ZipFile(os.path.join(self.path, 'A.apk'))
+		self.assertEqual([info.filename for info in self.reader.infolist()], z.namelist())
+		for info in z.infolist():
+			data = z.read(info)
+			self.assertEqual(bytes(self.reader.read(info.filename)), data)
+			self.assertEqual(bytes(self.reader.read(self.reader.getinfo(info.filename))), data)
+			self.assertEqual(b''.join(bytes(piece) for piece in
+									  self.reader.iter_read(info.filename, 1000)), data)
+			raw = self.reader.read_raw(self.reader.getinfo(info.filename))
+			self.assertTrue(isinstance(raw, view))
+			self.assertEqual(len(raw), info.compress_size)
+		z.close()
+		self.assertTrue(isinstance(self.reader.read('stored.bin'), view))
+		self.assertTrue(isinstance(self.reader.read('deflated.txt'), bytes))
+		self.assertRaises(KeyError, self.reader.read, 'missing')
+
+	def test_pieces(self):
+		pieces = list(self.reader.iter_read('deflated.txt', 1000))
+		self.assertTrue(len(pieces) > 1)
+		self.assertTrue(max(len(piece) for piece in pieces) <= 1000)
+		pieces = list(self.reader.iter_read('stored.bin', 1000))
+		self.assertEqual([len(piece) for piece in pieces], [1000] * 5)
+
+	def test_bad_crc(self):
+		info = self.reader.getinfo('deflated.txt')
+		info.CRC ^= 1
+		self.assertRaises(zipfile.BadZipfile, self.reader.read, 'deflated.txt')
+
+	def test_corrupt(self):
+		# the deflated data overwritten in the middle
+		self.reader.close()
+		path = os.path.join(self.path, 'A.apk')
+		z = zipfile.ZipFile(path)
+		info = z.getinfo('deflated.txt')
+		z.close()
+		f = open(path, 'r+b')
+		f.seek(info.header_offset + apkzip.LOCAL_HEADER.size + len(info.filename) +
+			   info.compress_size // 2)
+		f.write(b'\xff' * 16)
+		f.close()
+		self.reader = apkzip.MappedZipReader(path)
+		self.assertRaises((zlib.error, zipfile.BadZipfile), self.reader.read, 'deflated.txt')
+		self.assertEqual(bytes(self.reader.read('stored.bin')), self.entries[0][1])
+
+	def test_not_a_zip(self):
+		for data in b'', b'PK\x03\x04' + b'x' * 100:
+			path = os.path.join(self.path, 'bad.apk')
+			f = open(path, 'wb')
+			f.write(data)
+			f.close()
+			self.assertRaises(zipfile.BadZipfile, apkzip.MappedZipReader, path)
+
+	def test_close_with_views(self):
+		stored = self.reader.read('stored.bin')
+		pieces = list(self.reader.iter_read('stored.bin', 1000))
+		self.reader.close()
+		self.reader.close()
+		if sys.version_info[0] >= 3:
+			# the map stays until the views are gone
+			self.assertEqual(bytes(stored), self.entries[0][1])
+			self.assertEqual(b''.join(pieces), self.entries[0][1])
+		del stored, pieces
+
+
+class TestApplyPatch(ApkTestCase):
+
+	def test_records(self):
+		rnd = random.Random(11)
+		text = random_text(rnd, 3000)
+		dex = random_text(rnd, 3000)
+		doc = random_text(rnd, 3000)
+		unchanged = random_text(rnd, 500)
+		old = [('assets/strings.txt', text),
+			   ('classes.dex', dex, zipfile.ZIP_DEFLATED),
+			   ('assets/doc-1.txt', doc),
+			   ('res/unchanged.txt', unchanged),
+			   ('assets/removed.txt', random_text(rnd, 500))]
+		new = [('assets/strings.txt', text[:5000] + b'EDITED!' + text[5007:]),
+			   ('classes.dex', dex[:100] + b'inserted' + dex[100:], zipfile.ZIP_DEFLATED),
+			   ('assets/doc-2.txt', doc[:-100] + b'appended'),
+			   ('res/unchanged.txt', unchanged),
+			   ('assets/added.bin', bytes(bytearray(rnd.getrandbits(8) for _ in range(3000)))),
+			   ('assets/small.txt', b'new and small', zipfile.ZIP_DEFLATED)]
+		self.write_apk('A.apk', old).close()
+		self.write_apk('B.apk', new).close()
+		self.diff_apks('A.apk', 'B.apk')
+		self.assertEqual(self.toc_ops('patch.zip'), set('-+cC'))
+		self.assertPatches('A.apk', 'patch.zip', 'B.apk')
+
+	def test_jobs(self):
+		# with several threads, the patched entries are rebuilt first
+		rnd = random.Random(12)
+		texts = [random_text(rnd, 2000) for _ in range(3)]
+		old = [('assets/%d.txt' % i, text) for i, text in enumerate(texts)]
+		new = [('assets/%d.txt' % i, b'v2 ' + text) for i, text in enumerate(texts)]
+		self.write_apk('A.apk', old, zipfile.ZIP_DEFLATED).close()
+		self.write_apk('B.apk', new, zipfile.ZIP_DEFLATED).close()
+		self.diff_apks('A.apk', 'B.apk')
+		out = os.path.join(self.path, 'out.apk')
+		apk_patch.apply_patch(os.path.join(self.path, 'A.apk'), out,
+							  os.path.join(self.path, 'patch.zip'), jobs=3)
+		result = zipfile.ZipFile(out)
+		for name, data in new:
+			self.assertEqual(result.read(name), data)
+		result.close()
+
+	def test_bases(self):
+		# the strings did not change between the two bases, so their
+		# diff against the target is made once for both patches
+		rnd = random.Random(14)
+		text = random_text(rnd, 3000)
+		doc = random_text(rnd, 3000)
+		self.write_apk('A1.apk', [('assets/strings.txt', text), ('assets/doc.txt', doc)]).close()
+		self.write_apk('A2.apk', [('assets/strings.txt', text),
+								  ('assets/doc.txt', doc[:5000] + b'v2' + doc[5000:])]).close()
+		self.write_apk('B.apk', [('assets/strings.txt', b'v3 ' + text),
+								 ('assets/doc.txt', doc[:5000] + b'v3' + doc[5000:])]).close()
+		self.diff_apks('A1.apk', 'A2.apk', 'B.apk')
+		self.assertEqual(apk_diff.g_stats.counters['diffs_shared'], 1)
+		self.assertEqual(apk_diff.g_stats.stages['bsdiff']['count'], 3)
+		self.assertFalse(os.path.exists(os.path.join(self.path, 'patch.zip')))
+		self.assertPatches('A1.apk', 'patch-A1.zip', 'B.apk')
+		self.assertPatches('A2.apk', 'patch-A2.zip', 'B.apk')
+
+
+def read_file(path):
+	f = open(path, 'rb')
+	data = f.read()
+	f.close()
+	return data
+
+
+class TestDeflateParams(unittest.TestCase):
+
+	def test_find(self):
+		# some settings give the same stream, and the first of them in
+		# DEFLATE_PARAMS is found; on this data levels 6 and 9 differ
+		rnd = random.Random(16)
+		data = bytes(bytearray(rnd.choice(b'abcd') for _ in range(70000)))
+		self.assertTrue(len(data) > apkzip.DEFLATE_TRIAL_CHUNK)
+		for params in [(6, zlib.Z_DEFAULT_STRATEGY, 8), (9, zlib.Z_DEFAULT_STRATEGY, 8),
+					   (1, zlib.Z_DEFAULT_STRATEGY, 9), (4, zlib.Z_FILTERED, 8),
+					   (6, zlib.Z_HUFFMAN_ONLY, 8)]:
+			raw = apkzip.deflate(data, *params)
+			found = apkzip.find_deflate_params(data, view(raw))
+			self.assertEqual(apkzip.deflate(data, *found), raw)
+			self.assertTrue(apkzip.DEFLATE_PARAMS.index(found) <=
+							apkzip.DEFLATE_PARAMS.index(params))
+			if params[0] in (6, 9):
+				self.assertEqual(found, params)
+		self.assertEqual(apkzip.find_deflate_params(b'', apkzip.deflate(b'')),
+						 apkzip.DEFLATE_PARAMS[0])
+
+	def test_foreign(self):
+		# stored blocks (level 0), as no level in DEFLATE_PARAMS writes
+		# them, and a stream of other data
+		data = random_text(random.Random(17), 3000)
+		self.assertEqual(apkzip.find_deflate_params(data, apkzip.deflate(data, 0)), None)
+		raw = apkzip.deflate(data)
+		self.assertEqual(apkzip.find_deflate_params(data[:-1] + b'!', raw), None)
+		self.assertEqual(apkzip.find_deflate_params(data, raw[:-1]), None)
+
+
+class TestExact(ApkTestCase):
+
+	def write_signed_apk(self, apk, entries, signature):
+		# entries (name, data, level) are written with a data descriptor,
+		# as a streaming zip writer does, DEFLATED at level (0 makes a
+		# stream only another deflater would) or STORED for None; an APK
+		# signing block holding signature sits before the central directory
+		f = open(os.path.join(self.path, apk), 'wb')
+		central = []
+		for entry, data, level in entries:
+			if level is None:
+				method, raw = zipfile.ZIP_STORED, data
+			else:
+				method, raw = zipfile.ZIP_DEFLATED, apkzip.deflate(data, level)
+			crc = zlib.crc32(data) & 0xffffffff
+			name = entry.encode('ascii')
+			central.append((method, crc, len(raw), len(data), name, f.tell()))
+			f.write(apkzip.LOCAL_HEADER.pack(apkzip.LOCAL_MAGIC, 20, apkzip.FLAG_DATA_DESCRIPTOR,
+											 method, 0, 33, 0, 0, 0, len(name), 0))
+			f.write(name)
+			f.write(raw)
+			f.write(struct.pack('<4s3I', b'PK\x07\x08', crc, len(raw), len(data)))
+		pair = struct.pack('<QI', 4 + len(signature), 0x7109871a) + signature
+		block_size = struct.pack('<Q', len(pair) + 8 + 16)
+		f.write(block_size + pair + block_size + b'APK Sig Block 42')
+		start = f.tell()
+		for method, crc, compress_size, size, name, offset in central:
+			f.write(apkzip.CENTRAL_HEADER.pack(apkzip.CENTRAL_MAGIC, 20, 20,
+											   apkzip.FLAG_DATA_DESCRIPTOR, method, 0, 33,
+											   crc, compress_size, size, len(name), 0, 0,
+											   0, 0, 0, offset))
+			f.write(name)
+		end = f.tell()
+		f.write(apkzip.END_RECORD.pack(apkzip.END_MAGIC, 0, 0, len(central), len(central),
+									   end - start, start, 0))
+		f.close()
+
+	def setUp(self):
+		ApkTestCase.setUp(self)
+		rnd = random.Random(18)
+		text, dex, lib, doc = [random_text(rnd, 3000) for _ in range(4)]
+		self.write_signed_apk('A.apk', [
+				('AndroidManifest.xml', doc, 9),
+				('assets/strings.txt', text, None),
+				('classes.dex', dex, 6),
+				('lib/foo.txt', lib, 0),
+				('assets/removed.txt', doc[:2000], 6)], b'\x01' * 64)
+		self.write_signed_apk('B.apk', [
+				('AndroidManifest.xml', doc, 9),
+				('assets/strings.txt', text[:5000] + b'EDITED!' + text[5007:], None),
+				('classes.dex', b'v2 ' + dex, 6),
+				('lib/foo.txt', lib + b'v2', 0),
+				('assets/added.txt', text[:3000], 6)], b'\x02' * 64)
+		self.diff_apks('--exact', 'A.apk', 'B.apk')
+		z = zipfile.ZipFile(os.path.join(self.path, 'patch.zip'))
+		self.patch = dict((name, z.read(name)) for name in z.namelist())
+		z.close()
+
+	def apply(self, patch):
+		z = zipfile.ZipFile(os.path.join(self.path, 'tampered.zip'), 'w')
+		for name in sorted(patch):
+			z.writestr(name, patch[name])
+		z.close()
+		out = os.path.join(self.path, 'out.apk')
+		apk_patch.apply_patch(os.path.join(self.path, 'A.apk'), out,
+							  os.path.join(self.path, 'tampered.zip'))
+		return read_file(out)
+
+	def test_round_trip(self):
+		layout = self.patch['LAYOUT.txt'].decode('utf-8').splitlines()
+		hows = dict((line.split('|')[2], line.split('|')[1].split(' ')[0])
+					for line in layout[1:])
+		self.assertEqual(hows, {'AndroidManifest.xml': 'copy', 'assets/strings.txt': 'stored',
+								'classes.dex': 'deflate', 'lib/foo.txt': 'raw',
+								'assets/added.txt': 'deflate'})
+		self.assertEqual(self.apply(self.patch), read_file(os.path.join(self.path, 'B.apk')))
+		out = os.path.join(self.path, 'out.apk')
+		apk_patch.apply_patch(os.path.join(self.path, 'A.apk'), out,
+							  os.path.join(self.path, 'patch.zip'), jobs=2)
+		self.assertEqual(read_file(out), read_file(os.path.join(self.path, 'B.apk')))
+
+	def test_tampered(self):
+		layout = self.patch['LAYOUT.txt'].decode('utf-8').splitlines()
+		digest = layout[0].split(' ')[1]
+		layout[0] = 'sha256 ' + digest[::-1]
+		self.assertRaises(ValueError, self.apply,
+						  dict(self.patch, **{'LAYOUT.txt': '\n'.join(layout).encode('utf-8')}))
+		raw = [line.split('|')[1] for line in layout[1:] if line.split('|')[1].startswith('raw ')]
+		name = 'f' + raw[0].split(' ')[1]
+		data = self.patch[name]
+		self.assertRaises(ValueError, self.apply,
+						  dict(self.patch, **{name: data[:100] + b'!' + data[101:]}))
+
+
+class TestReport(ApkTestCase):
+
+	def test_report(self):
+		rnd = random.Random(13)
+		text = random_text(rnd, 3000)
+		self.write_apk('A.apk', [('assets/strings.txt', text)]).close()
+		self.write_apk('B.apk', [('assets/strings.txt', b'v2 ' + text),
+								 ('assets/new.txt', text[:1000])]).close()
+		self.diff_apks('--report', 'report.json', '--prometheus', 'metrics.prom',
+					   'A.apk', 'B.apk')
+
+		f = open(os.path.join(self.path, 'report.json'))
+		report = json.load(f)
+		f.close()
+		for key in 'stages', 'counters', 'memory', 'decisions':
+			self.assertIn(key, report)
+		self.assertIn('diff', report['stages'])
+		self.assertGreater(report['counters']['bytes_written'], 0)
+		self.assertEqual(sorted(rec['entry'] for rec in report['decisions']),
+						 ['assets/new.txt', 'assets/strings.txt'])
+
+		self.assertFalse(os.path.exists(os.path.join(self.path, 'metrics.prom.tmp')))
+		f = open(os.path.join(self.path, 'metrics.prom'))
+		lines = f.read().splitlines()
+		f.close()
+		# name{label="value",...} value, with quotes escaped in the values
+		sample = re.compile(r'^(apkdiff_\w+)\{(.*)\} (\S+)$')
+		label = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"(,|$)')
+		names = set()
+		for line in lines:
+			if line.startswith('#'):
+				self.assertTrue(re.match(r'^# (HELP|TYPE) apkdiff_\w+ ', line), line)
+				continue
+			m = sample.match(line)
+			self.assertTrue(m, line)
+			names.add(m.group(1))
+			float(m.group(3))
+			labels = m.group(2)
+			self.assertEqual(''.join(x.group(0) for x in label.finditer(labels)), labels, line)
+			self.assertIn('apk="B.apk"', labels)
+		self.assertIn('apkdiff_bytes_written', names)
+		self.assertIn('apkdiff_patch_bytes', names)
+
+
+def crc_collision(data, prefix):
+	# prefix and 4 more bytes, as long as data and with the same CRC-32:
+	# the CRC is an affine function of the last 4 bytes, solved for them
+	# bit by bit over an xor basis
+	prefix = prefix[:len(data) - 4].ljust(len(data) - 4, b'\0')
+	zero = zlib.crc32(prefix + b'\0' * 4) & 0xffffffff
+	basis = []
+	for i in range(32):
+		v, bits = (zlib.crc32(prefix + struct.pack('<I', 1 << i)) & 0xffffffff) ^ zero, 1 << i
+		for bv, bb in basis:
+			if v ^ bv < v:
+				v, bits = v ^ bv, bits ^ bb
+		basis.append((v, bits))
+		basis.sort(reverse=True)
+	v, bits = (zlib.crc32(data) & 0xffffffff) ^ zero, 0
+	for bv, bb in basis:
+		if v ^ bv < v:
+			v, bits = v ^ bv, bits ^ bb
+	assert v == 0
+	return prefix + struct.pack('<I', bits)
+
+
+class TestCopies(ApkTestCase):
+
+	def test_crc_collision(self):
+		# the same CRC and size are not the same bytes: nothing is copied
+		# or duplicated, and the entries are shipped as they are
+		rnd = random.Random(19)
+		data = random_text(rnd, 1000)
+		other = crc_collision(data, random_text(rnd, 1000))
+		self.assertNotEqual(other, data)
+		self.assertEqual(zlib.crc32(other), zlib.crc32(data))
+		old = [('assets/data.txt', data)]
+		new = [('assets/data2.txt', other), ('assets/data3.txt', data)]
+		names = [name for name, data in new]
+		def stage(engine, a_files, b_files, names):
+			return (apk_diff.find_copies(engine, a_files.zipf, a_files, b_files, names),
+					apk_diff.find_duplicates(engine, b_files, names))
+		copies, duplicates = self.run_stage(stage, old, new, names)
+		self.assertEqual(copies, {'assets/data3.txt': 'assets/data.txt'})
+		self.assertEqual(duplicates, {})
+
+		self.write_apk('A.apk', old).close()
+		self.write_apk('B.apk', [('assets/data.txt', other), ('assets/data2.txt', data),
+								 ('assets/data3.txt', other)]).close()
+		self.diff_apks('A.apk', 'B.apk')
+		self.assertPatches('A.apk', 'patch.zip', 'B.apk')
+
+	def test_records(self):
+		# two entries swapped, which is done in place, one copied under a
+		# new name, and an added entry with a duplicate
+		rnd = random.Random(20)
+		foo, bar, added = [random_text(rnd, 500) for _ in range(3)]
+		old = [('assets/foo.txt', foo), ('assets/bar.txt', bar, zipfile.ZIP_DEFLATED)]
+		new = [('assets/foo.txt', bar), ('assets/bar.txt', foo, zipfile.ZIP_DEFLATED),
+			   ('assets/copy.txt', foo), ('assets/added.txt', added),
+			   ('assets/added2.txt', added, zipfile.ZIP_DEFLATED)]
+		self.write_apk('A.apk', old).close()
+		self.write_apk('B.apk', new).close()
+		self.diff_apks('A.apk', 'B.apk')
+		self.assertEqual(self.toc_ops('patch.zip'), set('=+&'))
+		self.assertPatches('A.apk', 'patch.zip', 'B.apk')
+
+
+class TestFindBestDiff(ApkTestCase):
+
+	def find_best_diff(self, old, new, names):
+		def stage(engine, a_files, b_files, names):
+			return apk_diff.find_best_diff(engine, b_files, names, a_files)
+		return self.run_stage(stage, old, new, names)
+
+	def test_abi_split(self):
+		# the builds of one library for each ABI look alike, but only the
+		# one of the same ABI is ever tried
+		rnd = random.Random(7)
+		code = bytes(bytearray(rnd.getrandbits(8) for _ in range(50000)))
+		symbols = ['sym%d' % i for i in range(50)]
+		abis = [('arm64-v8a', 183, 64), ('armeabi-v7a', 40, 32), ('x86', 3, 32)]
+		old, new = [], []
+		for abi, machine, bits in abis[:2]:
+			old.append(('lib/%s/libfoo.so' % abi,
+						elf_library(machine, bits, soname='libfoo.so', symbols=symbols, text=code)))
+		for abi, machine, bits in abis:
+			new.append(('lib/%s/libfoo2.so' % abi,
+						elf_library(machine, bits, soname='libfoo2.so', symbols=symbols,
+									text=code[:20000] + b'new' + code[20000:])))
+		# the same bytes in another machine, under an ABI directory
+		old.append(('lib/x86/libfoo.so', elf_library(40, 32, soname='libfoo.so',
+													 symbols=symbols, text=code)))
+		best = self.find_best_diff(old, new, [name for name, data in new])
+		self.assertEqual(best['lib/arm64-v8a/libfoo2.so'][0], 'lib/arm64-v8a/libfoo.so')
+		self.assertEqual(best['lib/armeabi-v7a/libfoo2.so'][0], 'lib/armeabi-v7a/libfoo.so')
+		self.assertEqual(best['lib/x86/libfoo2.so'], None)
+
+	def test_elf_group(self):
+		fp64 = elfinfo.fingerprint(elf_library(183, 64))
+		fp32 = elfinfo.fingerprint(elf_library(40, 32))
+		self.assertEqual(apk_diff.elf_group('lib/arm64-v8a/libfoo.so', fp64),
+						 ('arm64-v8a', 183, 64))
+		self.assertNotEqual(apk_diff.elf_group('lib/arm64-v8a/libfoo.so', fp64),
+							apk_diff.elf_group('lib/armeabi-v7a/libfoo.so', fp32))
+		self.assertNotEqual(apk_diff.elf_group('lib/arm64-v8a/libfoo.so', fp64),
+							apk_diff.elf_group('lib/arm64-v8a/libfoo.so', fp32))
+		self.assertEqual(apk_diff.elf_group('assets/libfoo.so', fp64), (None, 183, 64))
+
+
+class TestPlanChanges(ApkTestCase):
+
+	def plan(self, old, new, compression=zipfile.ZIP_DEFLATED):
+		apk_diff.g_stats = apk_diff.Stats()
+		names = [name for name, data in new]
+		return self.run_stage(apk_diff.plan_changes, old, new, names, compression)
+
+	def test_small_edit(self):
+		text = random_text(random.Random(8), 60000)
+		edited = text[:200000] + b'EDITED!' + text[200007:]
+		plan = self.plan([('assets/strings.txt', text)], [('assets/strings.txt', edited)])
+		self.assertEqual(plan, {'assets/strings.txt': ('diff', 'assets/strings.txt')})
+
+	def test_edits_everywhere(self):
+		# every line of the asset is renumbered, so no chunk survives and
+		# the sketches say it is another file, but it diffs well against
+		# its old version
+		rnd = random.Random(9)
+		words = random_text(rnd, 16000).split(b' ')
+		lines = [b' '.join(words[i:i + 8]) for i in range(0, len(words), 8)]
+		text = b''.join(b'%06d ' % i + line + b'\n' for i, line in enumerate(lines))
+		edited = b''.join(b'%06d ' % (i + 1) + line + b'\n' for i, line in enumerate(lines))
+		other = random_text(rnd, len(lines) * 8)
+		old = [('assets/strings.txt', text), ('assets/other.txt', other)]
+		plan = self.plan(old, [('assets/strings.txt', edited)])
+		self.assertEqual(plan, {'assets/strings.txt': ('diff', 'assets/strings.txt')})
+		decision = apk_diff.g_stats.decisions[(os.path.join(self.path, 'A.apk'), 'assets/strings.txt')]
+		self.assertLess(decision['trial_patch_bytes'], 10000)
+
+	def test_unrelated(self):
+		rnd = random.Random(10)
+		old = [('assets/data.bin', bytes(bytearray(rnd.getrandbits(8) for _ in range(20000))))]
+		new = [('assets/data.bin', bytes(bytearray(rnd.getrandbits(8) for _ in range(20000))))]
+		self.assertEqual(self.plan(old, new), {'assets/data.bin': ('copy', None)})
+
+	def test_replace_large_patches(self):
+		# the patch of a.txt came out larger than the entry, so a.txt is
+		# shipped whole and its c record becomes a + one
+		rnd = random.Random(21)
+		a, b = random_text(rnd, 500), random_text(rnd, 500)
+		b_zip = self.write_apk('B.apk', [('assets/a.txt', a), ('assets/b.txt', b)],
+							   zipfile.ZIP_DEFLATED)
+		b_files = apk_diff.Manifest(b_zip)
+		output_dir = os.path.join(self.path, 'out')
+		os.mkdir(output_dir)
+		toc = b'c0|assets/a.txt\nC1|assets/old.txt|assets/b.txt\n'
+		apk_diff.write_file(output_dir + '/TOC.txt', toc)
+		apk_diff.write_file(output_dir + '/f0', b'x' * b_files['assets/a.txt'].compress_size)
+		apk_diff.write_file(output_dir + '/f1', b'x' * 100)
+		apk_diff.g_stats = apk_diff.Stats()
+		apk = os.path.join(self.path, 'A.apk')
+		apk_diff.replace_large_patches([(apk, 'assets/a.txt', 'assets/a.txt', output_dir + '/f0'),
+										(apk, 'assets/old.txt', 'assets/b.txt', output_dir + '/f1')],
+									   b_files)
+		self.assertEqual(read_file(output_dir + '/TOC.txt'), b'+0' + toc[2:])
+		self.assertEqual(read_file(output_dir + '/f0'), a)
+		self.assertEqual(read_file(output_dir + '/f1'), b'x' * 100)
+		self.assertIn(output_dir + '/f0', apk_diff.g_deflated_files)
+		self.assertEqual(apk_diff.g_stats.decisions[(apk, 'assets/a.txt')]['action'], 'copy')
+		b_zip.close()
+
+
+if __name__ == '__main__':
+	unittest.main()